@@ -49,6 +49,7 @@ var toBeShown = false;
 var winrateTime = 12;
 var showingWinrateStats = false;
 var last_shown_file = '';
+var card_data = null; // replay card waiting for the full analysis
 var do_not_use_websocket = false;
 var minimum_kills = 1; // minimum number of kills for a unit to be shown
 var show_charts = true;
@@ -257,6 +258,17 @@ function mutatorInfo(data) {
 function postGameStatsTimed(data) {
     //This is a wrapper for postGameStats
     //The goal is to nicely update the data if it's already showing
+
+    // Full analysis of a replay shown as a card. Merge it into the card and update in place.
+    if ((data['card'] == null) && (card_data != null) && (card_data['file'] == data['file'])) {
+        let merged = Object.assign({}, card_data, data);
+        delete merged['card'];
+        card_data = null;
+        postGameStats(merged, showing = true, show = toBeShown);
+        return
+    }
+    card_data = (data['card'] != null) ? data : null;
+
     if ((document.getElementById('stats').style.right != '-50.5vh') && (document.getElementById('stats').style.right != '')) {
 
         // If we are about to show the same data, hide instead
@@ -306,7 +318,7 @@ function fillCommander(el, commander, commander_level) {
 }
 
 
-function postGameStats(data, showing = false) {
+function postGameStats(data, showing = false, show = true) {
     //initial change
     document.getElementById('killbar').style.display = 'block';
     document.getElementById('nodata').style.display = 'none';
@@ -442,6 +454,9 @@ function postGameStats(data, showing = false) {
     fill('CMname3', 'Amon');
     fillunits('CMunits3', data['amon_units'], null, 'red', totalkills);
 
+    // only update the data if the overlay was hidden in the meantime
+    if (!(show)) return;
+
     // add a tiny delay before updating. This can smooth out things on some systems.
     setTimeout(showstats, 10);
 
@@ -43,6 +43,7 @@ from SCOFunctions.MLogging import catch_exceptions, logclass
 from SCOFunctions.MSystemInfo import SystemInfo
 from SCOFunctions.MTheming import MColors, set_dark_theme
 from SCOFunctions.MTwitchBot import TwitchBot
+from SCOFunctions.MWorkerPool import worker_pool
 from SCOFunctions.Settings import Setting_manager as SM
 
 logger = logclass('SCO', 'INFO')
@@ -657,12 +658,20 @@ class UI_TabWidget(object):
         self.thread_server = threading.Thread(target=MF.server_thread, daemon=True)
         self.thread_server.start()
 
+        # Start worker processes used for replay parsing, so they are ready when needed
+        worker_pool.start()
+
         # Init replays, names & handles. This should be fast
         MF.initialize_replays_names_handles()
 
         # PyQt threadpool
         self.threadpool = QtCore.QThreadPool()
 
+        # Check for new games. Shows player winrates and pauses background analysis during games.
+        thread_check_for_newgame = MUI.Worker(MF.check_for_new_game, progress_callback=True)
+        thread_check_for_newgame.signals.progress.connect(self.map_identified)
+        self.threadpool.start(thread_check_for_newgame)
+
         # Check for new replays
         thread_replays = MUI.Worker(MF.check_replays)
         thread_replays.signals.result.connect(self.check_replays_finished)
@@ -868,12 +877,6 @@ class UI_TabWidget(object):
         MF.check_names_handles()
         MF.CAnalysis = self.CAnalysis
 
-        # Show player winrates
-        if SM.settings['show_player_winrates']:
-            thread_check_for_newgame = MUI.Worker(MF.check_for_new_game, progress_callback=True)
-            thread_check_for_newgame.signals.progress.connect(self.map_identified)
-            self.threadpool.start(thread_check_for_newgame)
-
         # Connect & run full analysis if set
         self.TAB_Stats.BT_FA_run.setEnabled(True)
         self.TAB_Stats.BT_FA_run.clicked.connect(self.run_f_analysis)
@@ -1145,6 +1148,7 @@ if __name__ == "__main__":
         logger.error(traceback.format_exc())
         TabWidget.tray_icon.hide()
         MF.stop_threads()
+        worker_pool.shutdown()
         sys.exit()
 
     # Do stuff before the app is closed
@@ -1152,6 +1156,7 @@ if __name__ == "__main__":
     TabWidget.tray_icon.hide()
     ui.stop_full_analysis()
     MF.stop_threads()
+    worker_pool.shutdown()
     ui.saveSettings()
     logger.info('Exit')
     sys.exit(exit_event)
@@ -1,8 +1,11 @@
 import hashlib
 import json
+import mmap
 import os
+import pickle
 import string
 import sys
+import threading
 import traceback
 import zipfile
 from pathlib import Path
@@ -37,17 +40,83 @@ def isFrozen():
     return getattr(sys, 'frozen', False)
 
 
+def hash_file(file, sha=False, chunk_size=1 << 20):
+    """ Returns MD5/SHA256 file hash. The file is memory-mapped and hashed in chunks, so it's never fully read into memory."""
+    hasher = hashlib.sha3_256() if sha else hashlib.md5()
+    with open(file, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size > 0:  # Empty files can't be mapped
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                for start in range(0, size, chunk_size):
+                    hasher.update(view[start:start + chunk_size])
+    return hasher.hexdigest()
+
+
+class FingerprintIndex:
+    """ Persistent index of file hashes.
+
+    Files are identified by (size, mtime, inode). The hash is calculated only for new or changed files."""
+    def __init__(self, file):
+        self.file = file
+        self.index = dict()  # path: (size, mtime_ns, inode, hash)
+        self.changed = False
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        """ Loads the index from the disk """
+        self.loaded = True
+        try:
+            if os.path.isfile(self.file):
+                with open(self.file, 'rb') as f:
+                    self.index = pickle.load(f)
+        except Exception:
+            logger.error(f'Failed to load file hashes\n{traceback.format_exc()}')
+
+    def save(self):
+        """ Saves the index if there are any changes """
+        with self.lock:
+            if not self.changed:
+                return
+            try:
+                temp_file = f"{self.file}_temp"
+                with open(temp_file, 'wb') as f:
+                    pickle.dump(self.index, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(temp_file, self.file)
+                self.changed = False
+            except Exception:
+                logger.error(f'Failed to save file hashes\n{traceback.format_exc()}')
+
+    def get(self, file):
+        """ Returns MD5 hash of the file """
+        path = os.path.normpath(file)
+        stat = os.stat(path)
+        fingerprint = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            entry = self.index.get(path)
+            if entry is not None and entry[:3] == fingerprint:
+                return entry[3]
+
+        rhash = hash_file(path)
+        with self.lock:
+            self.index[path] = (*fingerprint, rhash)
+            self.changed = True
+        return rhash
+
+
+hash_index = FingerprintIndex(truePath('cache_hashes'))
+
+
 def get_hash(file, sha=False):
-    """ Returns MD5/SHA256 file hash for a file """
+    """ Returns MD5/SHA256 file hash for a file.
+    MD5 hashes are taken from the fingerprint index if the file hasn't changed."""
     try:
-        with open(file, "rb") as f:
-            bytesread = f.read()
-            if sha:
-                readable_hash = hashlib.sha3_256(bytesread).hexdigest()
-            else:
-                readable_hash = hashlib.md5(bytesread).hexdigest()
-
-        return readable_hash
+        if sha:
+            return hash_file(file, sha=True)
+        return hash_index.get(file)
     except Exception:
         logger.error(traceback.format_exc())
         return None
@@ -0,0 +1,243 @@
+"""
+Persistent cache of decoded replay streams.
+
+Entries are keyed by the replay hash (`get_hash`) and contain everything `s2_parse_replay` needs:
+header builds, details, init data, metadata, messages and decoded events.
+Events are stored in a columnar form (one typed column per field for each event type) and compressed.
+Re-analysing a cached replay skips MPQ decompression and protocol decoding entirely.
+
+The cache is bounded. Loading an entry updates its modification time, least recently used entries are removed
+when the cache grows over the size limit. Entries of replays that are no longer in replay data are removed as well.
+Pruning goes over the whole cache folder, so it's done once after the full analysis finishes (see `prune`).
+
+"""
+import os
+import pickle
+import time
+import zlib
+from array import array
+
+from SCOFunctions.MFilePath import truePath
+from SCOFunctions.MLogging import logclass, catch_exceptions
+
+logger = logclass('EVCA', 'INFO')
+
+CACHE_FOLDER = truePath('cache_events')
+CACHE_VERSION = 2  # Increase when the stored data or the parser changes, old entries are ignored then
+MAGIC = b'SCOEVC'
+MAX_CACHE_SIZE = 20 * 1024**3  # Bytes, default limit (the `event_cache_size` setting is used by the app)
+TEMP_FILE_AGE = 3600  # Unfinished temporary files older than this (seconds) are removed
+
+
+def _typecode(low, high):
+    """ Returns the smallest array typecode for integers in the range """
+    for typecode in ('b', 'h', 'i', 'q'):
+        limit = 2**(array(typecode).itemsize * 8 - 1)
+        if -limit <= low and high < limit:
+            return typecode
+    return None
+
+
+def _encode_column(values):
+    """ Returns `(values, categories)`. Values are a typed array for integer columns, codes of `categories` for other values
+    (names, bytes, None, small dictionaries like `_userid`) and the list itself for unhashable values.
+    `categories` is None if the column isn't dictionary encoded. Equal dictionaries share one instance, events are read-only. """
+    types = set(map(type, values))
+    if types == {int}:
+        typecode = _typecode(min(values), max(values))
+        if typecode is not None:
+            return array(typecode, values), None
+
+    # Keys include the type when types are mixed, so `1`, `1.0` and `True` are different categories
+    if types == {dict}:
+        keys = (tuple(value.items()) for value in values)
+    elif len(types) == 1:
+        keys = values
+    else:
+        keys = ((type(value), value) for value in values)
+
+    try:
+        categories = dict()
+        codes = [categories.setdefault(key, (len(categories), value))[0] for key, value in zip(keys, values)]
+        return array(_typecode(0, len(categories)), codes), tuple(value for _, value in categories.values())
+    except TypeError:  # Unhashable values
+        return values, None
+
+
+class EventColumns:
+    """ Events stored column-wise. Events with the same type and fields share one schema.
+    Each field is a typed array, a dictionary encoded column or a list (see `_encode_column`).
+    Iterating over it recreates event dictionaries in the original order. """
+    def __init__(self, events):
+        self.schemas = list()  # (event name, field names)
+        self.columns = list()  # columns for each schema
+        self.order = array('H')  # schema index for each event
+        schema_index = dict()
+
+        for event in events:
+            key = (event['_event'], tuple(event))
+            idx = schema_index.get(key)
+            if idx is None:
+                idx = len(self.schemas)
+                schema_index[key] = idx
+                self.schemas.append(key)
+                self.columns.append(tuple(list() for _ in key[1]))
+
+            for column, value in zip(self.columns[idx], event.values()):
+                column.append(value)
+            self.order.append(idx)
+
+        self.columns = [tuple(_encode_column(column) for column in columns) for columns in self.columns]
+
+    def __len__(self):
+        return len(self.order)
+
+    def _iterate(self, prefix=None):
+        positions = [0] * len(self.schemas)
+        for idx in self.order:
+            pos = positions[idx]
+            positions[idx] += 1
+            name, fields = self.schemas[idx]
+            if prefix is not None and not name.startswith(prefix):
+                continue
+            yield dict(zip(fields, [values[pos] if categories is None else categories[values[pos]] for values, categories in self.columns[idx]]))
+
+    def __iter__(self):
+        return self._iterate()
+
+    def game_events(self):
+        """ Yields game events only """
+        return self._iterate('NNet.Game.')
+
+    def tracker_events(self):
+        """ Yields tracker events only """
+        return self._iterate('NNet.Replay.Tracker.')
+
+
+class CachedReplay:
+    """ Replay loaded from the event cache. Has the same interface as `S2Replay`. """
+    protocol = True  # No protocol is needed, but the parser checks that there is one
+
+    def __init__(self, file, data):
+        self.file = file
+        self.replay_build = data['replay_build']
+        self.used_build = data['used_build']
+        self.event_filter = data['event_filter']
+        self.details = data['details']
+        self.init_data = data['init_data']
+        self.metadata = data['metadata']
+        self.messages = data['messages']
+        self.events = data['events']
+
+
+def _cache_file(rhash):
+    return os.path.join(CACHE_FOLDER, rhash[:2], f'{rhash}.bin')
+
+
+def load(rhash, file, event_filter=None, need_events=True):
+    """ Returns `CachedReplay` if the cache has an entry for given hash containing all events in `event_filter`.
+    Returns `None` otherwise. Events aren't checked with `need_events=False`. """
+    cfile = _cache_file(rhash)
+    if not os.path.isfile(cfile):
+        return None
+
+    try:
+        with open(cfile, 'rb') as f:
+            contents = f.read()
+        if not contents.startswith(MAGIC):
+            return None
+        data = pickle.loads(zlib.decompress(contents[len(MAGIC):]))
+    except Exception:
+        logger.error(f'Failed to load cached replay ({file})')
+        return None
+
+    if data.get('version') != CACHE_VERSION:
+        return None
+
+    # Entries are usable only if they contain every requested event type
+    stored_filter = data['event_filter']
+    if need_events and stored_filter is not None and (event_filter is None or not set(event_filter) <= stored_filter):
+        return None
+
+    # Modification time is used as the last access time for eviction
+    try:
+        os.utime(cfile)
+    except OSError:
+        pass
+
+    return CachedReplay(file, data)
+
+
+def save(rhash, archive):
+    """ Decodes everything from the archive (`S2Replay`) and saves it to the cache.
+    Returns `CachedReplay` to be used instead of the archive, so nothing is decoded twice. """
+    data = {
+        'version': CACHE_VERSION,
+        'replay_build': archive.replay_build,
+        'used_build': archive.used_build,
+        'event_filter': archive.events.event_filter,
+        'details': archive.details,
+        'init_data': archive.init_data,
+        'metadata': archive.metadata,
+        'messages': archive.messages,
+        'events': EventColumns(archive.events)
+    }
+
+    cfile = _cache_file(rhash)
+    temp_file = f'{cfile}_temp{os.getpid()}'
+    try:
+        os.makedirs(os.path.dirname(cfile), exist_ok=True)
+        with open(temp_file, 'wb') as f:
+            f.write(MAGIC)
+            f.write(zlib.compress(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)))
+        os.replace(temp_file, cfile)
+    except Exception:
+        logger.error(f'Failed to save replay to the cache ({archive.file})')
+
+    return CachedReplay(archive.file, data)
+
+
+def _remove(path):
+    """ Removes a file, returns False if it can't be removed (e.g. it's being read on Windows) """
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        return False
+
+
+@catch_exceptions(logger)
+def prune(keep_hashes=None, max_size=MAX_CACHE_SIZE):
+    """ Removes entries of replays with hashes not in `keep_hashes` (`None` keeps all),
+    then least recently used entries until the cache is at most `max_size` bytes large. """
+    if not os.path.isdir(CACHE_FOLDER):
+        return
+
+    entries = list()  # (last access, size, path)
+    removed = 0
+    now = time.time()
+    for folder in os.scandir(CACHE_FOLDER):
+        if not folder.is_dir():
+            continue
+        for entry in os.scandir(folder.path):
+            stat = entry.stat()
+            if '_temp' in entry.name:
+                if now - stat.st_mtime > TEMP_FILE_AGE:
+                    _remove(entry.path)
+            elif keep_hashes is not None and entry.name[:-len('.bin')] not in keep_hashes and _remove(entry.path):
+                removed += 1
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    size = sum(entry[1] for entry in entries)
+    if size > max_size:
+        entries.sort()
+        for _, entry_size, path in entries:
+            if _remove(path):
+                removed += 1
+                size -= entry_size
+            if size <= max_size:
+                break
+
+    if removed > 0:
+        logger.info(f'Removed {removed} entries from the event cache ({size/1024**2:.0f} MB left)')
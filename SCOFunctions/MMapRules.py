@@ -0,0 +1,84 @@
+"""
+Map-specific rules for the replay analysis: players on Amon's side and bonus objectives.
+
+Rules for a replay are resolved once from its map name with `get_map_rules`.
+Bonus objectives completed by a kill are indexed by unit type, so each death checks only rules for the killed unit on that map.
+
+"""
+from SCOFunctions.SC2Dictionaries import amon_player_ids
+
+
+class BonusKill:
+    """ Bonus objective completed when a unit of one of `unit_types` owned by `losing_player` dies.
+    `by_players` requires the kill to be done by players (to prevent despawns from counting).
+    `delay` is subtracted from the timing. `condition(event, time, bonus_timings, amon_units)` is an additional check. """
+    def __init__(self, unit_types, losing_player, by_players=False, delay=0, condition=None):
+        self.unit_types = set(unit_types)
+        self.losing_player = losing_player
+        self.by_players = by_players
+        self.delay = delay
+        self.condition = condition
+
+    def check(self, event, losing_player, killing_player, time, bonus_timings, amon_units):
+        return losing_player == self.losing_player and (not self.by_players or killing_player in {1, 2}) and (self.condition is None or self.condition(
+            event, time, bonus_timings, amon_units))
+
+
+class MapRules:
+    """ Rules for one map. Maps are matched by a substring of the map name (any of `names`). """
+    def __init__(self, name, names=None, bonus_kills=(), warp_prism_bonus=False, ownership_bonus=False):
+        self.name = name
+        self.names = names if names is not None else (name, )
+        self.amon_players = {3, 4} | amon_player_ids.get(name, set())
+        self.warp_prism_bonus = warp_prism_bonus  # Bonus completed when a warp prism of player 11 starts phasing
+        self.ownership_bonus = ownership_bonus  # Bonus tracked by changes of ownership (Malwarfare)
+        self.bonus_kills = dict()  # unit type: list of BonusKill
+        for rule in bonus_kills:
+            for unit_type in rule.unit_types:
+                self.bonus_kills.setdefault(unit_type, list()).append(rule)
+
+    def matches(self, map_name):
+        return any(name in map_name for name in self.names)
+
+    def bonus_kill(self, event, killed_unit_type, losing_player, killing_player, time, bonus_timings, amon_units):
+        """ Returns the timing of a bonus objective completed by this death, or None """
+        for rule in self.bonus_kills.get(killed_unit_type, ()):
+            if rule.check(event, losing_player, killing_player, time, bonus_timings, amon_units):
+                return round(time - rule.delay, 0)
+        return None
+
+
+def part_and_parcel_train(event, time, bonus_timings, amon_units):
+    """ Trains are killed by nobody, so the position is checked. Trains at these positions weren't destroyed by players. """
+    return not round(time, 0) in bonus_timings and len(bonus_timings) < 2 and not (event['m_x'] == 169 and event['m_y'] == 99) and not (event['m_x'] == 38
+                                                                                                                                      and event['m_y'] == 178)
+
+
+map_rules = (
+    MapRules('Chain of Ascension', bonus_kills=(BonusKill({'SlaynElemental'}, 10, by_players=True), )),
+    MapRules('Cradle of Death', bonus_kills=(BonusKill({'LogisticsHeadquarters'}, 3, delay=8), )),  # The explosion is delayed
+    MapRules('Dead of Night', bonus_kills=(BonusKill({'ACVirophage'}, 7, by_players=True), )),
+    MapRules('Lock & Load', names=('Lock & Load', '[MM] LnL', '[MM] Lnl'), bonus_kills=(BonusKill({'XelNagaConstruct'}, 3), )),
+    MapRules('Malwarfare', ownership_bonus=True),
+    MapRules('Miner Evacuation',
+             bonus_kills=(BonusKill({'Blightbringer'}, 5, by_players=True),
+                          BonusKill({'NovaEradicator'}, 9, by_players=True, condition=lambda event, time, bonus_timings, amon_units: amon_units['NovaEradicator'][1] == 1))),
+    MapRules('Mist Opportunities', bonus_kills=(BonusKill({'COOPTerrazineTank'}, 3, by_players=True), )),
+    MapRules('Oblivion Express', bonus_kills=(BonusKill({'TarsonisEngineFast'}, 7, condition=lambda event, time, bonus_timings, amon_units: event['m_x'] < 196), )),
+    MapRules('Part and Parcel', bonus_kills=(BonusKill({'Caboose', 'TarsonisEngine'}, 8, condition=part_and_parcel_train), )),
+    MapRules('Rifts to Korhal', bonus_kills=(BonusKill({'ACPirateCapitalShip'}, 8, by_players=True), )),
+    MapRules('Scythe of Amon', warp_prism_bonus=True),
+    MapRules('Temple of the Past', bonus_kills=(BonusKill({'ZenithStone'}, 8), )),
+    MapRules('The Vermillion Problem', bonus_kills=(BonusKill({'RedstoneSalamander', 'RedstoneSalamanderBurrowed'}, 9, by_players=True), )),
+    MapRules('Void Launch'),
+    MapRules('Void Thrashing', bonus_kills=(BonusKill({'ArchAngelCoopFighter', 'ArchAngelCoopAssault'}, 5), )),
+)
+default_rules = MapRules('')
+resolved_rules = dict()  # map name: MapRules
+
+
+def get_map_rules(map_name):
+    """ Returns `MapRules` for a map name. Maps without special rules get the default rules. """
+    if map_name not in resolved_rules:
+        resolved_rules[map_name] = next((rules for rules in map_rules if rules.matches(map_name)), default_rules)
+    return resolved_rules[map_name]
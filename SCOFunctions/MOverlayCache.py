@@ -0,0 +1,129 @@
+"""
+Cache of overlay payloads for replays shown with older/newer hotkeys.
+
+Payloads are kept in LRU order and limited by their approximate size (length of their JSON).
+Replays next to the one shown are loaded in the background, so moving to them doesn't wait for parsing.
+Background loads are low priority (paused during games), only the replay being shown is loaded with high priority.
+
+"""
+import os
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from SCOFunctions.MLogging import logclass
+from SCOFunctions.MWorkerPool import HIGH, LOW
+
+logger = logclass('OVCA', 'INFO')
+
+
+def fingerprint(file):
+    """ Returns (size, mtime) of a file, or None if it doesn't exist """
+    try:
+        stat = os.stat(file)
+        return stat.st_size, stat.st_mtime_ns
+    except OSError:
+        return None
+
+
+class OverlayCache:
+    """ LRU cache of overlay payloads for replay files.
+    `loader(file, priority)` is used to get payloads. It returns a dictionary, or anything else if it fails.
+    `priority` is the worker pool priority to use if the replay has to be analysed. """
+    def __init__(self, loader, max_size=32 * 1024 * 1024, prefetch_workers=2):
+        self.loader = loader
+        self.max_size = max_size
+        self.entries = OrderedDict()  # file: (fingerprint, payload, size)
+        self.size = 0
+        self.pending = dict()  # file: (Future, priority)
+        self.generation = 0  # Increased with each `clear`, payloads loaded before that aren't added
+        self.executor = ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix='overlay_prefetch')
+        self.lock = threading.Lock()
+
+    def get(self, file):
+        """ Returns cached payload for a file, or None if it's not cached or the file changed """
+        fp = fingerprint(file)
+        with self.lock:
+            entry = self.entries.get(file)
+            if entry is None:
+                return None
+            if entry[0] != fp:
+                self._remove(file)
+                return None
+            self.entries.move_to_end(file)
+            return entry[1]
+
+    def put(self, file, payload, generation=None):
+        """ Adds a payload, removes least recently used payloads over the size limit """
+        try:
+            size = len(json.dumps(payload))
+        except Exception:
+            logger.error(f'Failed to get the size of overlay data ({file})')
+            return
+
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._remove(file)
+            if size > self.max_size:
+                return
+            self.entries[file] = (fingerprint(file), payload, size)
+            self.size += size
+            while self.size > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, file):
+        entry = self.entries.pop(file, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def _load(self, file, future, priority):
+        generation = self.generation
+        try:
+            payload = self.loader(file, priority)
+        except Exception as e:
+            payload = e
+            logger.error(f'Failed to load overlay data ({file})')
+        if isinstance(payload, dict):
+            self.put(file, payload, generation)
+        with self.lock:
+            if self.pending.get(file, (None, ))[0] is future:
+                del self.pending[file]
+        future.set_result(payload)
+
+    def load(self, file):
+        """ Returns payload for a file. Waits for it if it's being loaded in the background. """
+        payload = self.get(file)
+        if payload is not None:
+            return payload
+
+        # A prefetch can be waiting for background work, don't wait for it and load the replay with high priority
+        with self.lock:
+            future, priority = self.pending.get(file, (None, None))
+            owner = priority != HIGH
+            if owner:
+                future = Future()
+                self.pending[file] = (future, HIGH)
+
+        if owner:
+            self._load(file, future, HIGH)
+        return future.result()
+
+    def prefetch(self, file):
+        """ Loads payload for a file in the background, unless it's cached or already loading """
+        if self.get(file) is not None:
+            return
+        with self.lock:
+            if file in self.pending:
+                return
+            future = Future()
+            self.pending[file] = (future, LOW)
+        self.executor.submit(self._load, file, future, LOW)
+
+    def clear(self):
+        """ Removes all payloads, e.g. when main player handles change """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.generation += 1
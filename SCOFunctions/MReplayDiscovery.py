@@ -0,0 +1,177 @@
+"""
+Finds replays, player handles and names in the StarCraft II folder.
+
+The folder is scanned once with `os.scandir` and kept as a snapshot persisted between sessions.
+Each directory is stored with its modification time. Adding, removing or renaming a file changes
+the modification time of its directory, so on the next start only changed directories are listed again.
+Unchanged directories are taken from the snapshot, which only costs one `os.stat` per directory.
+
+"""
+import os
+import time
+import pickle
+import threading
+import traceback
+from typing import NamedTuple
+
+from SCOFunctions.MFilePath import truePath
+from SCOFunctions.MLogging import logclass
+
+logger = logclass('DISC', 'INFO')
+
+SNAPSHOT_VERSION = 1
+RACY_TIME = 2_000_000_000  # ns, directories changed more recently than this are listed again next time
+
+
+class DirectoryEntry(NamedTuple):
+    mtime: int  # st_mtime_ns of the directory, None if it has to be listed again
+    directories: tuple  # subdirectory names
+    replays: dict  # replay name: modification time
+    links: tuple  # names of .lnk files
+
+
+def is_replay(name):
+    return name.endswith('.SC2Replay')
+
+
+def top_folder(folder):
+    """ Walks up from `folder` as far as possible while staying in the StarCraft folder """
+    folder = os.path.normpath(folder)
+    while True:
+        parent = os.path.dirname(folder)
+        if 'StarCraft' in parent and parent != folder:
+            folder = parent
+        else:
+            return folder
+
+
+def list_directory(directory, mtime):
+    """ Lists a directory and returns `DirectoryEntry` """
+    directories = list()
+    replays = dict()
+    links = list()
+    racy = time.time_ns() - mtime < RACY_TIME
+
+    with os.scandir(directory) as it:
+        for entry in it:
+            try:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        directories.append(entry.name)
+                elif is_replay(entry.name):
+                    stat = entry.stat()
+                    replays[entry.name] = stat.st_mtime
+                    # Replay might still be written, its modification time isn't final
+                    racy = racy or time.time_ns() - stat.st_mtime_ns < RACY_TIME
+                elif entry.name.endswith('.lnk'):
+                    links.append(entry.name)
+            except OSError:  # File was removed or is a broken link
+                continue
+
+    return DirectoryEntry(None if racy else mtime, tuple(directories), replays, tuple(links))
+
+
+class DirectorySnapshot:
+    """ Persistent snapshot of directories in the StarCraft folder """
+    def __init__(self, file):
+        self.file = file
+        self.directories = dict()  # path: DirectoryEntry
+        self.scanned = dict()  # folder: time of the last scan
+        self.changed = False
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        """ Loads the snapshot from the disk """
+        self.loaded = True
+        try:
+            if os.path.isfile(self.file):
+                with open(self.file, 'rb') as f:
+                    data = pickle.load(f)
+                if data.get('version') == SNAPSHOT_VERSION:
+                    self.directories = data['directories']
+        except Exception:
+            logger.error(f'Failed to load directory snapshot\n{traceback.format_exc()}')
+
+    def save(self):
+        """ Saves the snapshot if there are any changes """
+        with self.lock:
+            if not self.changed:
+                return
+            try:
+                temp_file = f"{self.file}_temp"
+                with open(temp_file, 'wb') as f:
+                    pickle.dump({'version': SNAPSHOT_VERSION, 'directories': self.directories}, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(temp_file, self.file)
+                self.changed = False
+            except Exception:
+                logger.error(f'Failed to save directory snapshot\n{traceback.format_exc()}')
+
+    def _update(self, directory, visited, listed):
+        """ Updates a directory and its subdirectories. Lists only directories that changed. """
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:  # Directory was removed
+            return
+
+        visited.add(directory)
+        entry = self.directories.get(directory)
+        if entry is None or entry.mtime != mtime:
+            try:
+                entry = list_directory(directory, mtime)
+            except OSError:
+                return
+            self.directories[directory] = entry
+            self.changed = True
+            listed.append(directory)
+
+        for name in entry.directories:
+            self._update(os.path.join(directory, name), visited, listed)
+
+    def scan(self, folder, max_age=10):
+        """ Brings the snapshot up to date with the StarCraft folder containing `folder`.
+        Nothing is done if it was scanned in the last `max_age` seconds. """
+        root = top_folder(folder)
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            if time.monotonic() - self.scanned.get(root, -max_age) < max_age:
+                return
+
+            start = time.time()
+            visited = set()
+            listed = list()
+            self._update(root, visited, listed)
+
+            # Remove directories that don't exist anymore
+            prefix = os.path.join(root, '')
+            for directory in list(self.directories):
+                if directory not in visited and (directory == root or directory.startswith(prefix)):
+                    del self.directories[directory]
+                    self.changed = True
+
+            self.scanned[root] = time.monotonic()
+            logger.info(f'Checked {len(visited)} directories and listed {len(listed)} of them in {time.time()-start:.3f}s')
+        self.save()
+
+    def walk(self, folder):
+        """ Returns a list of `(directory, DirectoryEntry)` for `folder` and all its subdirectories """
+        result = list()
+        with self.lock:
+            stack = [os.path.normpath(folder)]
+            while stack:
+                directory = stack.pop()
+                entry = self.directories.get(directory)
+                if entry is None:
+                    continue
+                result.append((directory, entry))
+                stack.extend(os.path.join(directory, name) for name in reversed(entry.directories))
+        return result
+
+    def replays(self, folder):
+        """ Returns a dictionary of all replays in `folder` with their modification times """
+        self.scan(folder)
+        return {os.path.join(directory, name): mtime for directory, entry in self.walk(folder) for name, mtime in entry.replays.items()}
+
+
+snapshot = DirectorySnapshot(truePath('cache_directories'))
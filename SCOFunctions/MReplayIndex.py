@@ -0,0 +1,52 @@
+"""
+Index of replays ordered by their modification time.
+
+Used for moving between replays on the overlay. Positions are found with binary search,
+and replays found later are inserted at their place, so the order holds for the whole session.
+
+"""
+import bisect
+
+
+class ReplayIndex:
+    """ Replays sorted by modification time (and path for equal times).
+    Behaves like a dictionary of `path: {'created': mtime}` in that order. """
+    def __init__(self, replays=None):
+        self.created = dict()  # path: modification time
+        self.order = list()  # (modification time, path), sorted
+        if replays is not None:
+            self.created = dict(replays)
+            self.order = sorted((mtime, path) for path, mtime in self.created.items())
+
+    def add(self, path, created):
+        """ Adds a replay and returns its position. Replays already in the index aren't moved. """
+        if path in self.created:
+            return self.position(path)
+        self.created[path] = created
+        key = (created, path)
+        position = bisect.bisect_left(self.order, key)
+        self.order.insert(position, key)
+        return position
+
+    def position(self, path):
+        """ Returns the position of a replay """
+        return bisect.bisect_left(self.order, (self.created[path], path))
+
+    def path(self, position):
+        """ Returns the replay at given position """
+        return self.order[position][1]
+
+    def __contains__(self, path):
+        return path in self.created
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        return (path for _, path in self.order)
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        return ((path, {'created': created}) for created, path in self.order)
@@ -0,0 +1,444 @@
+"""
+Columnar on-disk store for replay data (`replay_data`).
+
+Scalar fields are stored as typed arrays or dictionary encoded columns.
+Heavy fields (units, player stats, amon units and messages) are stored in a separate blob file
+and are loaded only when they are actually used (see `LazyValue`).
+
+The column file is an append-only log of segments. Each segment contains columns for a batch of new or changed
+replays and hashes of removed replays. Segments are checksummed, an incomplete segment at the end is ignored.
+The log is compacted into a single segment when it grows too much.
+The blob file is append-only as well, unused blobs are removed when the store is loaded.
+
+"""
+import os
+import pickle
+import struct
+import threading
+import traceback
+import zlib
+from array import array
+
+from SCOFunctions.MLogging import logclass
+from SCOFunctions.MReplayData import replay_data
+
+logger = logclass('STOR', 'INFO')
+
+MAGIC = b'SCOSTORE1\n'
+SEGMENT_HEADER = struct.Struct('<QI')  # payload size, crc32
+MAX_SEGMENTS = 200
+COMPACTION_SLACK = 500  # Replaced records tolerated before compaction
+COMPACTION_SLACK_BYTES = 10 * 1024**2  # Unused blob data tolerated before compaction
+
+TYPED_FIELDS = {'accurate_length': 'd', 'length': 'q', 'brutal_plus': 'q', 'extension': 'b', 'full_analysis': 'b', 'weekly': 'b'}
+BOOL_FIELDS = {'extension', 'full_analysis', 'weekly'}
+CATEGORICAL_FIELDS = {'map_name', 'difficulty', 'region', 'result', 'enemy_race', 'ext_difficulty', 'form_alength', 'comp'}
+HEAVY_FIELDS = ('messages', 'amon_units', 'player_stats')
+HEAVY_PLAYERS = (1, 2)  # Players whose units are stored in the blob file
+
+NONE = -1  # Blob offset for `None` values
+ABSENT = -2  # Blob offset for player units that aren't there
+_absent = object()
+
+
+def _identity(value):
+    return value
+
+
+class LazyValue:
+    """ Value stored in the blob file. It's loaded on first use and then kept.
+    Behaves like the loaded value for iteration, indexing, `len`, `in`, `str` and attribute access.
+    Pickling it pickles the loaded value. Use `materialize` before sending data to json. """
+    __slots__ = ('_store', '_offset', '_size', '_value')
+    _missing = object()
+
+    def __init__(self, store, offset, size):
+        self._store = store
+        self._offset = offset
+        self._size = size
+        self._value = self._missing
+
+    def load(self):
+        if self._value is self._missing:
+            self._value = self._store.read_blob(self._offset, self._size)
+        return self._value
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+    def __contains__(self, item):
+        return item in self.load()
+
+    def __bool__(self):
+        return bool(self.load())
+
+    def __eq__(self, other):
+        return self.load() == (other.load() if isinstance(other, LazyValue) else other)
+
+    def __repr__(self):
+        return repr(self.load())
+
+    def __str__(self):
+        return str(self.load())
+
+    def __reduce__(self):
+        return (_identity, (self.load(), ))
+
+
+def unwrap(value):
+    """ Returns the loaded value if it's lazy """
+    return value.load() if isinstance(value, LazyValue) else value
+
+
+def materialize(r):
+    """ Returns replay data with all lazy values loaded """
+    players = list()
+    for player in r.players:
+        if isinstance(player.get('units'), LazyValue):
+            player = {**player, 'units': player['units'].load()}
+        players.append(player)
+
+    return r._replace(players=tuple(players), **{field: unwrap(getattr(r, field)) for field in HEAVY_FIELDS})
+
+
+def _encode_date(date):
+    """ '2021:03:05:18:03:12' -> 20210305180312 """
+    return int(date.replace(':', ''))
+
+
+def _decode_date(number):
+    s = str(number).zfill(14)
+    return f'{s[0:4]}:{s[4:6]}:{s[6:8]}:{s[8:10]}:{s[10:12]}:{s[12:14]}'
+
+
+class ReplayStore:
+    """ Columnar store of replay data, see the module docstring. """
+    def __init__(self, file):
+        self.file = file
+        self.generation = 0  # Blob file generation, increased by blob compaction
+        self.lock = threading.RLock()
+        self._reader = None
+        self.end = None  # End of valid data in the column file
+        self.segments = 0
+        self.records = 0  # Records in the column file including replaced ones
+
+    def exists(self):
+        return os.path.isfile(self.file)
+
+    def blob_path(self, generation):
+        return f'{self.file}_blobs' if generation == 0 else f'{self.file}_blobs{generation}'
+
+    @property
+    def blob_file(self):
+        return self.blob_path(self.generation)
+
+    def close(self):
+        """ Closes the blob reader """
+        with self.lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+    # Blobs
+    def read_blob(self, offset, size):
+        with self.lock:
+            if self._reader is None:
+                self._reader = open(self.blob_file, 'rb')
+            self._reader.seek(offset)
+            data = self._reader.read(size)
+        return pickle.loads(zlib.decompress(data))
+
+    def _write_heavy(self, f, value):
+        """ Writes a heavy value into the opened blob file. Returns its offset and size.
+        Values already in the blob file aren't written again. """
+        if value is _absent:
+            return ABSENT, 0
+        if value is None:
+            return NONE, 0
+        if isinstance(value, LazyValue) and value._store is self:
+            return value._offset, value._size
+
+        data = zlib.compress(pickle.dumps(unwrap(value), protocol=pickle.HIGHEST_PROTOCOL))
+        offset = f.tell()
+        f.write(data)
+        return offset, len(data)
+
+    # Columns
+    def _encode_segment(self, replays, blobs):
+        """ Creates columns for a list of replays. Heavy values are written into `blobs` file. """
+        columns = dict()
+        for field in replay_data._fields:
+            values = [getattr(r, field) for r in replays]
+
+            if field in TYPED_FIELDS:
+                try:
+                    columns[field] = array(TYPED_FIELDS[field], values)
+                except (TypeError, OverflowError):
+                    columns[field] = values
+
+            elif field in CATEGORICAL_FIELDS:
+                try:
+                    categories = dict()
+                    codes = array('L', (categories.setdefault(v, len(categories)) for v in values))
+                    columns[field] = (tuple(categories), codes)
+                except TypeError:
+                    columns[field] = values
+
+            elif field == 'date':
+                try:
+                    encoded = array('q', (_encode_date(v) for v in values))
+                    if all(_decode_date(n) == v for n, v in zip(encoded, values)):
+                        columns[field] = encoded
+                    else:
+                        columns[field] = values
+                except (TypeError, ValueError, AttributeError):
+                    columns[field] = values
+
+            elif field in HEAVY_FIELDS:
+                columns[field] = self._encode_heavy((self._write_heavy(blobs, v) for v in values))
+
+            elif field == 'players':
+                light = list()
+                for r in replays:
+                    light.append(tuple({k: v for k, v in player.items() if not (idx in HEAVY_PLAYERS and k == 'units')}
+                                       for idx, player in enumerate(r.players)))
+                columns[field] = light
+
+                for p in HEAVY_PLAYERS:
+                    units = (r.players[p].get('units', _absent) if len(r.players) > p else _absent for r in replays)
+                    columns[f'units{p}'] = self._encode_heavy((self._write_heavy(blobs, v) for v in units))
+
+            else:
+                columns[field] = values
+
+        return {'count': len(replays), 'columns': columns, 'blobs': self.generation}
+
+    @staticmethod
+    def _encode_heavy(locations):
+        offsets, sizes = array('q'), array('q')
+        for offset, size in locations:
+            offsets.append(offset)
+            sizes.append(size)
+        return (offsets, sizes)
+
+    def _heavy_value(self, offset, size):
+        if offset == NONE:
+            return None
+        return LazyValue(self, offset, size)
+
+    def _decode_segment(self, segment):
+        """ Returns replay data from a decoded segment """
+        count = segment['count']
+        columns = segment['columns']
+        decoded = dict()
+
+        for field in replay_data._fields:
+            if field not in columns:
+                decoded[field] = [replay_data._field_defaults.get(field)] * count
+                continue
+
+            column = columns[field]
+            if field in CATEGORICAL_FIELDS and isinstance(column, tuple):
+                categories, codes = column
+                decoded[field] = [categories[c] for c in codes]
+            elif field in BOOL_FIELDS and isinstance(column, array):
+                decoded[field] = [bool(v) for v in column]
+            elif field == 'date' and isinstance(column, array):
+                decoded[field] = [_decode_date(n) for n in column]
+            elif field in HEAVY_FIELDS:
+                decoded[field] = [self._heavy_value(o, s) for o, s in zip(*column)]
+            elif field == 'players':
+                players = [[dict(p) for p in light] for light in column]
+                for p in HEAVY_PLAYERS:
+                    if f'units{p}' not in columns:
+                        continue
+                    for i, (offset, size) in enumerate(zip(*columns[f'units{p}'])):
+                        if offset != ABSENT:
+                            players[i][p]['units'] = self._heavy_value(offset, size)
+                decoded[field] = [tuple(p) for p in players]
+            else:
+                decoded[field] = list(column)
+
+        return [replay_data(*values) for values in zip(*(decoded[field] for field in replay_data._fields))]
+
+    def _write_segment(self, f, segment):
+        payload = zlib.compress(pickle.dumps(segment, protocol=pickle.HIGHEST_PROTOCOL))
+        f.write(SEGMENT_HEADER.pack(len(payload), zlib.crc32(payload)))
+        f.write(payload)
+
+    def _read_segments(self):
+        """ Yields decoded segments from the column file.
+        Reading stops at the first incomplete or corrupted segment (e.g. after a crash while appending).
+        `self.end` is set to the end of the last valid segment. """
+        with open(self.file, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('Not a replay store file')
+            self.end = f.tell()
+            self.segments = 0
+
+            while True:
+                header = f.read(SEGMENT_HEADER.size)
+                if len(header) < SEGMENT_HEADER.size:
+                    break
+                size, crc = SEGMENT_HEADER.unpack(header)
+                payload = f.read(size) if size <= file_size - f.tell() else b''
+                if len(payload) < size or zlib.crc32(payload) != crc:
+                    logger.error(f'Ignoring incomplete data at the end of the cache ({file_size - self.end} bytes)')
+                    break
+
+                self.end = f.tell()
+                self.segments += 1
+                segment = pickle.loads(zlib.decompress(payload))
+                self.generation = segment.get('blobs', 0)
+                yield segment
+
+    # Public interface
+    def load(self):
+        """ Returns a list of all stored replays.
+        Replays appended later replace all earlier replays with the same hash (the first keeps its position),
+        so replays with the same hash saved together are all kept. Removed replays are skipped.
+        The blob file is compacted if it contains too much unused data. """
+        with self.lock:
+            replays = list()
+            positions = dict()  # hash: positions in `replays`
+            self.records = 0
+            for segment in self._read_segments():
+                for rhash in segment.get('removed', tuple()):
+                    for i in positions.pop(rhash, tuple()):
+                        replays[i] = None
+
+                new_positions = dict()
+                for r in self._decode_segment(segment):
+                    if r.hash is None:  # Replays without hash can't be replaced
+                        replays.append(r)
+                        continue
+                    old = positions.pop(r.hash, None)
+                    if old is not None:
+                        replays[old[0]] = r
+                        for i in old[1:]:
+                            replays[i] = None
+                        new_positions.setdefault(r.hash, list()).append(old[0])
+                    else:
+                        new_positions.setdefault(r.hash, list()).append(len(replays))
+                        replays.append(r)
+                positions.update(new_positions)
+                self.records += segment['count']
+
+            replays = [r for r in replays if r is not None]
+            self._compact_blobs(replays)
+            return replays
+
+    def needs_compaction(self, live):
+        """ Returns True if the column file has too many segments or replaced records """
+        return self.segments > MAX_SEGMENTS or self.records > 2 * live + COMPACTION_SLACK
+
+    def write(self, replays):
+        """ Rewrites the column file with given replays (compaction).
+        Heavy values that are already in the blob file aren't written again. """
+        with self.lock:
+            with open(self.blob_file, 'ab') as blobs:
+                segment = self._encode_segment(replays, blobs)
+
+            temp_file = f'{self.file}_temp'
+            with open(temp_file, 'wb') as f:
+                f.write(MAGIC)
+                self._write_segment(f, segment)
+                end = f.tell()
+            os.replace(temp_file, self.file)
+
+            self.end = end
+            self.segments = 1
+            self.records = len(replays)
+
+    def append(self, replays, removed=tuple()):
+        """ Appends changed replays and hashes of removed replays as a new segment.
+        A crash while appending leaves an incomplete segment that is ignored (and overwritten) later. """
+        if len(replays) == 0 and len(removed) == 0:
+            return
+
+        with self.lock:
+            if not self.exists():
+                self.write(replays)
+                return
+
+            if self.end is None:
+                for _ in self._read_segments():
+                    pass
+
+            # Blobs are written first, so a valid segment never points to missing blobs
+            with open(self.blob_file, 'ab') as blobs:
+                segment = self._encode_segment(replays, blobs)
+            segment['removed'] = tuple(removed)
+
+            with open(self.file, 'r+b') as f:
+                f.seek(self.end)
+                self._write_segment(f, segment)
+                f.truncate()
+                self.end = f.tell()
+
+            self.segments += 1
+            self.records += len(replays)
+
+    def _compact_blobs(self, replays):
+        """ Rewrites the blob file with only blobs used by `replays`, if it contains too much unused data.
+        This has to run before lazy values are shared elsewhere, since their offsets change.
+        Blobs are copied into a file of the next generation, which is used once the column file is replaced. """
+        if not os.path.isfile(self.blob_file):
+            return
+
+        values = list()
+        for r in replays:
+            values.extend(getattr(r, field) for field in HEAVY_FIELDS)
+            values.extend(player.get('units') for player in r.players)
+        values = [v for v in values if isinstance(v, LazyValue) and v._store is self]
+
+        used = sum(v._size for v in values)
+        if os.path.getsize(self.blob_file) <= 2 * used + COMPACTION_SLACK_BYTES:
+            return
+
+        self.close()
+        old_file = self.blob_file
+        new_locations = dict()
+        with open(old_file, 'rb') as old, open(self.blob_path(self.generation + 1), 'wb') as new:
+            for v in values:
+                if (v._offset, v._size) not in new_locations:
+                    old.seek(v._offset)
+                    new_locations[(v._offset, v._size)] = new.tell()
+                    new.write(old.read(v._size))
+
+        for v in values:
+            v._offset = new_locations[(v._offset, v._size)]
+        self.generation += 1
+        self.write(replays)
+
+        try:
+            os.remove(old_file)
+        except OSError:
+            logger.error(f'Failed to remove old blob file\n{traceback.format_exc()}')
+        logger.info(f'Compacted replay cache blobs ({used / 1024**2:.1f} MB used)')
+
+    def migrate(self, pickle_file):
+        """ Creates the store from the old pickled list of replays. Returns loaded replays. """
+        with open(pickle_file, 'rb') as f:
+            loaded = pickle.load(f)
+
+        if len(loaded) > 0 and type(loaded[0]) != replay_data:
+            logger.error(f"Cache not migrated. Old data type.")
+            return list()
+
+        try:
+            self.write(loaded)
+            logger.info(f'Migrated {len(loaded)} replays into the new cache')
+        except Exception:
+            logger.error(f'Failed to migrate cache\n{traceback.format_exc()}')
+        return loaded
@@ -0,0 +1,214 @@
+"""
+Watches the account folder for new replays.
+
+On Linux inotify is used, so new replays are reported as soon as they are written.
+Elsewhere directories are checked for changes of their modification time and only changed
+directories are scanned again. Adding a file changes the modification time of its directory.
+Both start from the directory snapshot (`MReplayDiscovery`), so the folder isn't listed again.
+
+"""
+import os
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+import platform
+from collections import deque
+
+from SCOFunctions.MLogging import logclass
+from SCOFunctions.MReplayDiscovery import is_replay, snapshot
+
+logger = logclass('WTCH', 'INFO')
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class DirectoryScanner:
+    """ Finds new replays by scanning directories that changed since the last check.
+    Directories are checked at most once per `scan_interval` seconds. """
+    def __init__(self, folder, scan_interval=1.5):
+        self.folder = folder
+        self.scan_interval = scan_interval
+        self.next_scan = 0
+        self.directories = dict()  # directory: modification time
+        self.files = set()
+
+    def _scan(self, directory):
+        """ Scans a directory, returns new replays and scans new subdirectories """
+        new = list()
+        try:
+            self.directories[directory] = os.stat(directory).st_mtime_ns
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.path not in self.directories:
+                            new.extend(self._scan(entry.path))
+                    elif is_replay(entry.name) and entry.path not in self.files:
+                        self.files.add(entry.path)
+                        new.append(entry.path)
+        except OSError:  # Directory was removed
+            self.directories.pop(directory, None)
+        return new
+
+    def _from_snapshot(self):
+        """ Takes directories and replays from the directory snapshot, returns replays """
+        new = list()
+        for directory, entry in snapshot.walk(self.folder):
+            # Directories without modification time changed recently, they are scanned with the next check
+            self.directories[directory] = entry.mtime if entry.mtime is not None else -1
+            for name in entry.replays:
+                path = os.path.join(directory, name)
+                if path not in self.files:
+                    self.files.add(path)
+                    new.append(path)
+        return new
+
+    def _initial_scan(self, timeout):
+        """ Gets the whole folder. Waits if the folder doesn't exist (yet). """
+        snapshot.scan(self.folder)
+        new = self._from_snapshot()
+        if not self.directories:
+            time.sleep(timeout)
+        return new
+
+    def check(self, timeout):
+        """ Returns new replays. Waits until the next scan if it is due, but at most `timeout` seconds. """
+        if not self.directories:
+            return self._initial_scan(timeout)
+
+        # Wait for the next scan, but no longer than `timeout`
+        remaining = self.next_scan - time.time()
+        if remaining > 0:
+            time.sleep(min(timeout, remaining))
+            return list()
+        self.next_scan = time.time() + self.scan_interval
+
+        new = list()
+        for directory, mtime in list(self.directories.items()):
+            try:
+                changed = os.stat(directory).st_mtime_ns != mtime
+            except OSError:
+                self.directories.pop(directory, None)
+                continue
+            if changed:
+                new.extend(self._scan(directory))
+
+        return new
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(DirectoryScanner):
+    """ Finds new replays with inotify. Replays are reported when they are closed after writing. """
+    def __init__(self, folder, scan_interval=1.5):
+        super().__init__(folder, scan_interval)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = dict()  # watch descriptor: directory
+        self.watched = set()
+
+    def _watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        if wd >= 0:
+            self.watches[wd] = directory
+            self.watched.add(directory)
+
+    def _scan(self, directory):
+        # Watch before scanning, so nothing created in between is missed
+        self._watch(directory)
+        return super()._scan(directory)
+
+    def _initial_scan(self, timeout):
+        snapshot.scan(self.folder)
+        for directory, _ in snapshot.walk(self.folder):
+            self._watch(directory)
+
+        # Check the snapshot again for changes from before the watches were added
+        snapshot.scan(self.folder, max_age=0)
+        new = self._from_snapshot()
+        for directory in list(self.directories):
+            if directory not in self.watched:
+                new.extend(self._scan(directory))
+
+        if not self.directories:
+            time.sleep(timeout)
+        return new
+
+    def check(self, timeout):
+        if not self.directories:
+            return self._initial_scan(timeout)
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return list()
+
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return list()
+
+        new = list()
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+
+            # Events were lost, check all directories
+            if mask & IN_Q_OVERFLOW:
+                for directory in list(self.directories):
+                    new.extend(self._scan(directory))
+                continue
+
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+
+            if mask & IN_ISDIR:
+                if path not in self.directories:
+                    new.extend(self._scan(path))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and is_replay(path) and path not in self.files:
+                self.files.add(path)
+                new.append(path)
+        return new
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ReplayWatcher:
+    """ Reports new replays in `folder` one by one. The first replays reported are the ones already there.
+    `scan_interval` is the time between directory scans when inotify isn't available. """
+    def __init__(self, folder, scan_interval=1.5):
+        self.folder = folder
+        self.queue = deque()
+        self.watcher = None
+        if platform.system() == 'Linux':
+            try:
+                self.watcher = InotifyWatcher(os.path.normpath(folder), scan_interval)
+            except Exception:
+                logger.error('Failed to use inotify, falling back to scanning directories')
+        if self.watcher is None:
+            self.watcher = DirectoryScanner(os.path.normpath(folder), scan_interval)
+
+    def get(self, timeout=0.5):
+        """ Returns the path of a new replay, or None if there isn't any after `timeout` seconds """
+        if not self.queue:
+            self.queue.extend(os.path.normpath(path) for path in self.watcher.check(timeout))
+        return self.queue.popleft() if self.queue else None
+
+    def close(self):
+        self.watcher.close()
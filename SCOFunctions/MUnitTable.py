@@ -0,0 +1,168 @@
+"""
+Table of units in a replay, used by the analysis to track unit types and owners.
+
+Units are stored in preallocated arrays indexed by their unit tag index, so there is no list or dictionary entry for each unit.
+The unit ID (`recycle * INDEX_LIMIT + index`) is stored as well, it tells if the slot holds the same unit or one with a recycled index.
+Units replaced by a unit with the same index are moved aside to parallel arrays, they can still be looked up (e.g. as killers of other units).
+
+"""
+from array import array
+
+from SCOFunctions.MUnitTypes import unit_types
+
+INDEX_LIMIT = 100000  # Unit tag indexes are assumed to be lower (usually they are < 1000)
+
+# Unit flags
+MURVAR_SPAWN = 1
+GLEVIG_SPAWN = 2
+BROODLORD_BROODLING = 4  # Broodlings spawned by Brood Lords
+MIND_CONTROLLED = 8
+DEHAKA_DRAG = 16  # Units dragged by Amon's Dehaka (mutator)
+ZAGARA_DUMMY_ZERGLING = 32  # Zerglings created and killed when Zagara's Banelings finish morphing
+BIOMASS_LOCUST = 64  # Abathur's locusts spawned from biomass
+
+
+def unitid(event, killer=False, creator=False):
+    """ Returns and unique integer as unit id.
+    `killer`=True for killer unique id, `creator`=True for creator unique id, otherwise normal unit. """
+    if killer:
+        index = event.get('m_killerUnitTagIndex')
+        recycle = event.get('m_killerUnitTagRecycle')
+    elif creator:  # Not in init events
+        index = event.get('m_creatorUnitTagIndex')
+        recycle = event.get('m_creatorUnitTagRecycle')
+    else:
+        index = event.get('m_unitTagIndex')
+        recycle = event.get('m_unitTagRecycle')
+
+    if index is None or recycle is None:
+        return None
+    return recycle * INDEX_LIMIT + index
+
+
+class UnitTable:
+    """ Units in a replay. For each unit stores type ID (see `MUnitTypes`), owner and flags.
+    Lookups of units that aren't in the table raise KeyError, same as a dictionary. """
+    def __init__(self, size=1024):
+        self.ids = array('q', [-1]) * size
+        self.types = array('i', [0]) * size
+        self.owners = array('h', [0]) * size
+        self.flags = array('B', [0]) * size
+        # Units replaced in their slot are kept in rows of separate arrays
+        self.replaced = dict()  # unit ID: row
+        self.replaced_types = array('i')
+        self.replaced_owners = array('h')
+        self.replaced_flags = array('B')
+        self.free_rows = list()
+        self.type_names = unit_types.types
+
+    def _grow(self, index):
+        extra = max(len(self.ids), index + 1 - len(self.ids))
+        self.ids.extend(array('q', [-1]) * extra)
+        self.types.extend(array('i', [0]) * extra)
+        self.owners.extend(array('h', [0]) * extra)
+        self.flags.extend(array('B', [0]) * extra)
+
+    def _slot(self, unit_id):
+        """ Returns the slot of a unit, or -1 if it isn't there """
+        try:
+            index = unit_id % INDEX_LIMIT
+            if self.ids[index] == unit_id:
+                return index
+        except (TypeError, IndexError):  # None or not allocated yet
+            pass
+        return -1
+
+    def _replaced(self, unit_id):
+        """ Returns the row of a replaced unit """
+        try:
+            return self.replaced[unit_id]
+        except KeyError:
+            raise KeyError(unit_id) from None
+
+    def _move_aside(self, index):
+        """ Moves the unit in a slot to a row of replaced units """
+        if self.free_rows:
+            row = self.free_rows.pop()
+            self.replaced_types[row] = self.types[index]
+            self.replaced_owners[row] = self.owners[index]
+            self.replaced_flags[row] = self.flags[index]
+        else:
+            row = len(self.replaced_types)
+            self.replaced_types.append(self.types[index])
+            self.replaced_owners.append(self.owners[index])
+            self.replaced_flags.append(self.flags[index])
+        self.replaced[self.ids[index]] = row
+
+    def add(self, unit_id, type_id, owner):
+        """ Adds a unit. Flags are kept if the unit is already in the table. """
+        if unit_id is None:
+            return
+        index = unit_id % INDEX_LIMIT
+        if index >= len(self.ids):
+            self._grow(index)
+
+        if self.ids[index] != unit_id:
+            if self.ids[index] != -1:
+                self._move_aside(index)
+            row = self.replaced.pop(unit_id, None)
+            if row is None:
+                self.flags[index] = 0
+            else:
+                self.flags[index] = self.replaced_flags[row]
+                self.free_rows.append(row)
+            self.ids[index] = unit_id
+
+        self.types[index] = type_id
+        self.owners[index] = owner
+
+    def get(self, unit_id):
+        """ Returns `(UnitType, owner, flags)` of a unit, or None if it isn't in the table """
+        slot = self._slot(unit_id)
+        if slot >= 0:
+            return self.type_names[self.types[slot]], self.owners[slot], self.flags[slot]
+        row = self.replaced.get(unit_id)
+        if row is None:
+            return None
+        return self.type_names[self.replaced_types[row]], self.replaced_owners[row], self.replaced_flags[row]
+
+    def __contains__(self, unit_id):
+        return self._slot(unit_id) >= 0 or unit_id in self.replaced
+
+    def type(self, unit_id):
+        """ Returns the name of unit type """
+        slot = self._slot(unit_id)
+        return self.type_names[self.types[slot] if slot >= 0 else self.replaced_types[self._replaced(unit_id)]].name
+
+    def set_type(self, unit_id, type_id):
+        slot = self._slot(unit_id)
+        if slot >= 0:
+            self.types[slot] = type_id
+        else:
+            self.replaced_types[self._replaced(unit_id)] = type_id
+
+    def owner(self, unit_id):
+        slot = self._slot(unit_id)
+        return self.owners[slot] if slot >= 0 else self.replaced_owners[self._replaced(unit_id)]
+
+    def set_owner(self, unit_id, owner):
+        slot = self._slot(unit_id)
+        if slot >= 0:
+            self.owners[slot] = owner
+        else:
+            self.replaced_owners[self._replaced(unit_id)] = owner
+
+    def flags_of(self, unit_id):
+        """ Returns flags of a unit, 0 for units not in the table """
+        slot = self._slot(unit_id)
+        if slot >= 0:
+            return self.flags[slot]
+        row = self.replaced.get(unit_id)
+        return 0 if row is None else self.replaced_flags[row]
+
+    def set_flag(self, unit_id, flag):
+        slot = self._slot(unit_id)
+        if slot >= 0:
+            self.flags[slot] |= flag
+        else:
+            self.replaced_flags[self._replaced(unit_id)] |= flag
@@ -0,0 +1,109 @@
+"""
+Registry of unit types seen in replays.
+
+Each raw unit type name gets a small integer ID and a `UnitType` with precomputed attributes (name shown in stats,
+where kills are added, whether it's a wave unit or should be skipped, base costs). Names in events are decoded and looked up once per type,
+so the analysis doesn't repeat that (nor string lowering for skip strings, nor dictionary lookups) for every event.
+IDs are stable for the session, types not in dictionaries are added when first seen.
+
+"""
+import sys
+import threading
+from typing import NamedTuple, Optional
+
+from SCOFunctions.SC2Dictionaries import UnitNameDict, UnitAddKillsTo, UnitsInWaves, unit_base_costs
+
+skip_strings = ('placement', 'placeholder', 'dummy', 'cocoon', 'droppod', "colonist hut", "bio-dome", "amon's train", "warp conduit")
+do_not_count_kills = {'FuelCellPickupUnit', 'ForceField', 'Scarab'}
+cost_suffixes = (('Burrowed', ''), ('Phasing', ''), ('Uprooted', ''), ('Sieged', ''), ('SiegeMode', ''), ('Fighter', 'Assault'))
+
+
+def get_base_costs(name):
+    """ Returns base costs of a unit for all commanders. Morphed units (burrowed, sieged...) cost the same as the base unit. """
+    base_costs = dict()
+    for commander, costs in unit_base_costs.items():
+        cost = costs.get(name)
+        if cost is None:
+            for suffix, replacement in cost_suffixes:
+                if name.endswith(suffix) and name.replace(suffix, replacement) in costs:
+                    cost = costs[name.replace(suffix, replacement)]
+                    break
+        if cost is not None:
+            base_costs[commander] = cost
+    return base_costs
+
+
+def contains_skip_strings(name):
+    """ Checks if any of skip strings is in the name """
+    lowered_name = name.lower()
+    return any(item in lowered_name for item in skip_strings)
+
+
+class UnitType(NamedTuple):
+    id: int
+    name: str  # Name used in replays
+    display_name: str  # Name shown in stats
+    kills_to: Optional[str]  # Kills are added to this unit (locusts, broodlings, interceptors)
+    in_waves: bool  # Used in enemy waves
+    skip: bool  # Placeholders, cocoons, etc. (contains one of skip strings)
+    no_kills: bool  # Killing this unit isn't counted
+    named: bool  # Has a name in `UnitNameDict`
+    base_costs: dict  # commander: base cost (minerals, vespene), only commanders that have the unit
+
+
+class UnitTypeRegistry:
+    """ Maps unit type names to `UnitType`. Types can be looked up by name, raw name from events or ID. """
+    def __init__(self, names=()):
+        self.types = list()  # id: UnitType
+        self.by_name = dict()  # name: UnitType
+        self.by_raw = dict()  # name as bytes: UnitType
+        self.lock = threading.Lock()
+        for name in names:
+            self.get(name)
+
+    def _add(self, name):
+        name = sys.intern(name)
+        unit_type = UnitType(len(self.types), name, UnitNameDict.get(name, name), UnitAddKillsTo.get(name), name in UnitsInWaves,
+                             contains_skip_strings(name), name in do_not_count_kills, name in UnitNameDict, get_base_costs(name))
+        self.types.append(unit_type)
+        self.by_name[name] = unit_type
+        return unit_type
+
+    def get(self, name: str) -> UnitType:
+        """ Returns unit type for a name, adds it if it's new """
+        unit_type = self.by_name.get(name)
+        if unit_type is None:
+            with self.lock:
+                unit_type = self.by_name.get(name)
+                if unit_type is None:
+                    unit_type = self._add(name)
+        return unit_type
+
+    def is_skipped(self, name: str) -> bool:
+        """ Checks if a name contains one of skip strings. Unlike `get`, names that aren't registered (e.g. display names) aren't added. """
+        unit_type = self.by_name.get(name)
+        return unit_type.skip if unit_type is not None else contains_skip_strings(name)
+
+    def decode(self, raw: bytes) -> UnitType:
+        """ Returns unit type for a name from an event (bytes) """
+        unit_type = self.by_raw.get(raw)
+        if unit_type is None:
+            unit_type = self.get(raw.decode())
+            with self.lock:
+                self.by_raw[raw] = unit_type
+        return unit_type
+
+    def __getitem__(self, type_id: int) -> UnitType:
+        return self.types[type_id]
+
+    def __len__(self):
+        return len(self.types)
+
+    def base_cost(self, name: str, commander: str) -> tuple:
+        """ Returns base cost of a unit for a commander (precomputed when the type is added) """
+        if commander not in unit_base_costs:
+            raise KeyError(commander)
+        return self.get(name).base_costs.get(commander, (0, 0))
+
+
+unit_types = UnitTypeRegistry((*UnitNameDict, *UnitAddKillsTo, *UnitsInWaves))
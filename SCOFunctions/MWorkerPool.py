@@ -0,0 +1,253 @@
+"""
+Shared pool of worker processes used for all replay parsing.
+
+Workers are started once and kept alive for the whole session. Each worker imports parsing modules,
+protocols and dictionaries when it starts, so jobs don't pay that cost.
+Jobs are submitted into two lanes. High priority jobs (a game that just ended, overlay requests)
+are sent to workers before any queued background work (initial parsing, full analysis).
+Background work is paused while a game is running (see `WorkerPool.set_in_game`).
+
+"""
+import os
+import platform
+import threading
+import traceback
+import multiprocessing
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import psutil
+
+from SCOFunctions.MLogging import logclass
+
+logger = logclass('POOL', 'INFO')
+
+HIGH = 0
+LOW = 1
+
+if platform.system() == 'Windows':
+    PRIORITY_LOW = psutil.IDLE_PRIORITY_CLASS
+else:
+    PRIORITY_LOW = 19
+
+
+def can_restore_priority():
+    """ Checks if workers can get their priority back after it's lowered. That's always possible on Windows.
+    Elsewhere increasing priority requires root or a high enough RLIMIT_NICE. """
+    if platform.system() == 'Windows':
+        return True
+    if os.geteuid() == 0:
+        return True
+    try:
+        import resource
+        limit = resource.getrlimit(resource.RLIMIT_NICE)[0]
+        return limit == resource.RLIM_INFINITY or 20 - limit <= psutil.Process().nice()
+    except Exception:
+        return False
+
+
+def _initialize_worker(workers):
+    """ Reports the process ID and priority of a new worker process to `workers` (queue) and
+    loads everything needed for parsing and analysis """
+    try:
+        workers.put((os.getpid(), psutil.Process().nice()))
+    except Exception:
+        logger.error(f'Failed to report a new worker\n{traceback.format_exc()}')
+
+    try:
+        from s2protocol import versions
+        import SCOFunctions.ReplayAnalysis
+        import SCOFunctions.SC2Dictionaries
+
+        for file in versions.list_all():
+            versions.build(int(file[8:13]))
+    except Exception:
+        logger.error(f'Failed to pre-load modules in a worker\n{traceback.format_exc()}')
+
+
+def _warm_up():
+    """ Empty job used to start worker processes """
+    return os.getpid()
+
+
+class WorkerPool:
+    """ Long-lived process pool with high and low priority lanes.
+    At most `max_workers` jobs are sent to the processes at once, the rest waits here in its lane.
+    Background (low priority) jobs are further limited by `background_limit`.
+    `submit` returns a future that can be cancelled until the job is sent to a process."""
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers if max_workers is not None else max(1, os.cpu_count() or 1)
+        self.executor = None
+        self.lanes = {HIGH: deque(), LOW: deque()}
+        self.running = 0
+        self.running_low = 0
+        self.background_limit = self.max_workers
+        self.in_game = False
+        self.lower_priority = can_restore_priority()  # Priority isn't lowered if it can't be restored after the game
+        self.worker_queue = None  # New workers report themselves here
+        self.workers = dict()  # pid: original priority
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def _get_executor(self):
+        if self.executor is None:
+            self.worker_queue = multiprocessing.SimpleQueue()
+            self.workers = dict()
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=_initialize_worker, initargs=(self.worker_queue, ))
+        return self.executor
+
+    def _update_workers(self):
+        """ Adds workers that reported themselves since the last call """
+        while self.worker_queue is not None and not self.worker_queue.empty():
+            pid, priority = self.worker_queue.get()
+            self.workers[pid] = priority
+
+    def start(self):
+        """ Starts all worker processes, so they are ready before the first job """
+        with self.lock:
+            if self.closed:
+                return
+            executor = self._get_executor()
+        for _ in range(self.max_workers):
+            executor.submit(_warm_up)
+
+    def submit(self, fn, *args, priority=LOW, **kwargs):
+        """ Submits a job to the pool and returns its future """
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('Worker pool is shut down')
+            self.lanes[priority].append((future, priority, fn, args, kwargs))
+        self._dispatch()
+        return future
+
+    def stream(self, fn, jobs, window=None, priority=LOW):
+        """ Runs `fn(*args, **kwargs)` for each `(key, args, kwargs)` in `jobs` and yields `(key, result)` in the order jobs finish.
+        Jobs are taken from `jobs` lazily, at most `window` of them are submitted at once (two per worker by default).
+        Exceptions are yielded as results. Closing the generator cancels jobs that haven't started yet."""
+        window = window if window is not None else 2 * self.max_workers
+        jobs = iter(jobs)
+        pending = dict()  # future: key
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < window:
+                    try:
+                        key, args, kwargs = next(jobs)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending[self.submit(fn, *args, priority=priority, **kwargs)] = key
+
+                if not pending:
+                    return
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = e
+                    yield key, result
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _next_jobs(self):
+        """ Takes jobs from lanes (high priority first) while there are free workers """
+        jobs = list()
+        with self.lock:
+            while self.running < self.max_workers:
+                if self.lanes[HIGH]:
+                    lane = self.lanes[HIGH]
+                elif self.lanes[LOW] and self.running_low < self.background_limit:
+                    lane = self.lanes[LOW]
+                else:
+                    break
+                job = lane.popleft()
+                # Skip jobs cancelled while waiting
+                if not job[0].set_running_or_notify_cancel():
+                    continue
+                self.running += 1
+                if job[1] == LOW:
+                    self.running_low += 1
+                jobs.append(job)
+            executor = self._get_executor() if jobs else None
+        return executor, jobs
+
+    def _dispatch(self):
+        executor, jobs = self._next_jobs()
+        for future, priority, fn, args, kwargs in jobs:
+            try:
+                inner = executor.submit(fn, *args, **kwargs)
+            except Exception as e:
+                self._finish(future, priority, executor, None, e)
+                continue
+            inner.add_done_callback(lambda inner, future=future, priority=priority: self._finish(future, priority, executor, inner))
+
+    def _finish(self, future, priority, executor, inner, exception=None):
+        """ Passes the result from the process pool to our future and sends the next job """
+        if inner is not None:
+            exception = inner.exception() if not inner.cancelled() else RuntimeError('Job cancelled')
+        if exception is None:
+            future.set_result(inner.result())
+        else:
+            future.set_exception(exception)
+
+        with self.lock:
+            self.running -= 1
+            if priority == LOW:
+                self.running_low -= 1
+            # A worker died. Replace the whole process pool, it can't be used anymore.
+            if isinstance(exception, BrokenProcessPool) and self.executor is executor:
+                logger.error('Worker process terminated abruptly, restarting workers')
+                self.executor.shutdown(wait=False)
+                self.executor = None
+        if not self.closed:
+            self._dispatch()
+
+    def set_in_game(self, in_game):
+        """ Pauses background jobs and lowers the priority of workers while a game is running.
+        Outside of games background jobs are allowed again gradually, one more worker with each call.
+        Priority is changed only where it can be restored afterwards (see `can_restore_priority`). """
+        with self.lock:
+            if in_game:
+                self.background_limit = 0
+            else:
+                self.background_limit = min(self.max_workers, self.background_limit + 1)
+            changed = in_game != self.in_game
+            self.in_game = in_game
+            self._update_workers()
+            workers = dict(self.workers) if changed and self.lower_priority else dict()
+
+        if changed:
+            logger.info(f'{"Pausing" if in_game else "Resuming"} background replay analysis')
+        for pid, priority in workers.items():
+            try:
+                psutil.Process(pid).nice(PRIORITY_LOW if in_game else priority)
+            except psutil.NoSuchProcess:
+                with self.lock:
+                    self.workers.pop(pid, None)
+            except Exception:
+                logger.error(f'Failed to change priority of a worker ({pid})')
+        self._dispatch()
+
+    def shutdown(self, wait=False):
+        """ Cancels waiting jobs and stops worker processes """
+        with self.lock:
+            self.closed = True
+            jobs = [job for lane in self.lanes.values() for job in lane]
+            for lane in self.lanes.values():
+                lane.clear()
+            executor = self.executor
+            self.executor = None
+
+        for future, *_ in jobs:
+            future.cancel()
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+worker_pool = WorkerPool()
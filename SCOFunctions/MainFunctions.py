@@ -17,9 +17,14 @@ import websockets
 from websockets.legacy.server import serve as websockets_serve  # This direct import is required for Pyinstaller and Nuitka to find it correctly
 
 from SCOFunctions.MLogging import logclass
-from SCOFunctions.ReplayAnalysis import parse_and_analyse_replay
+from SCOFunctions.ReplayAnalysis import parse_and_analyse_replay, get_replay_card
 from SCOFunctions.IdentifyMap import identify_map
 from SCOFunctions.HelperFunctions import get_hash
+from SCOFunctions.MWorkerPool import worker_pool, HIGH
+from SCOFunctions.MReplayWatcher import ReplayWatcher
+from SCOFunctions.MReplayDiscovery import snapshot, top_folder
+from SCOFunctions.MReplayIndex import ReplayIndex
+from SCOFunctions.MOverlayCache import OverlayCache
 from SCOFunctions.Settings import Setting_manager as SM
 
 OverlayMessages = []  # Storage for all messages
@@ -28,7 +33,7 @@ lock = threading.Lock()
 logger = logclass('MAIN', 'INFO')
 initMessage = {'initEvent': True, 'colors': ['null', 'null', 'null', 'null'], 'duration': 60, 'show_charts': True}
 ReplayPosition = 0
-AllReplays = dict()
+AllReplays = ReplayIndex()
 player_winrate_data = dict()
 PLAYER_HANDLES = set()  # Set of handles of the main player
 PLAYER_NAMES = set()  # Set of names of the main player generated from handles and used in winrate notification
@@ -38,6 +43,7 @@ APP_CLOSING = False
 session_games = {'Victory': 0, 'Defeat': 0}
 WEBPAGE = None
 RNG_COMMANDER = dict()
+replay_watcher = None
 session = requests.Session()
 
 
@@ -110,26 +116,21 @@ def resend_init_message():
 def find_names_and_handles(ACCOUNTDIR, replays=None):
     """ Finds player handles and names from the account directory (or its subfolder) """
     # First walk up as far as possible in-case the user has selected one the of subfolders.
-    folder = ACCOUNTDIR
-    while True:
-        parent = os.path.dirname(folder)
-        if 'StarCraft' in parent:
-            folder = parent
-        else:
-            break
+    folder = top_folder(ACCOUNTDIR)
 
     # Find handles & names
     handles = set()
     names = set()
 
-    for root, directories, files in os.walk(folder):
-        for directory in directories:
+    snapshot.scan(folder)
+    for root, entry in snapshot.walk(folder):
+        for directory in entry.directories:
             if directory.count(
                     '-') >= 3 and not r'\Banks' in root and not 'Crash' in directory and not 'Desync' in directory and not 'Error' in directory:
                 handles.add(directory)
 
-        for file in files:
-            if file.endswith('.lnk') and '_' in file and '@' in file:
+        for file in entry.links:
+            if '_' in file and '@' in file:
                 names.add(file.split('_')[0])
 
     # Fallbacks for finding player names: settings, replays, winrates
@@ -205,6 +206,8 @@ def update_names_and_handles(ACCOUNTDIR, AllReplays):
         logger.info(f'Found {len(handles)} player handles: {handles}')
         with lock:
             PLAYER_HANDLES = handles
+        # Overlay data depends on which player is the main one
+        overlay_cache.clear()
     else:
         logger.error('No player handles found!')
 
@@ -218,23 +221,14 @@ def update_names_and_handles(ACCOUNTDIR, AllReplays):
 
 def find_replays(directory):
     """ Finds all replays in a directory. Returns a set."""
-    replays = set()
-    for root, directories, files in os.walk(directory):
-        for file in files:
-            if file.endswith('.SC2Replay'):
-                file_path = os.path.join(root, file)
-                file_path = os.path.normpath(file_path)
-                replays.add(file_path)
-    return replays
+    return set(snapshot.replays(directory))
 
 
 def initialize_AllReplays(ACCOUNTDIR):
-    """ Creates a sorted dictionary of all replays with their last modified times """
+    """ Creates an index of all replays sorted by their last modified times """
+    AllReplays = ReplayIndex()
     try:
-        AllReplays = find_replays(ACCOUNTDIR)
-        # Get dictionary of all replays with their last modification time
-        AllReplays = ((rep, os.path.getmtime(rep)) for rep in AllReplays)
-        AllReplays = {k: {'created': v} for k, v in sorted(AllReplays, key=lambda x: x[1])}
+        AllReplays = ReplayIndex(snapshot.replays(ACCOUNTDIR))
     except Exception:
         logger.error(f'Error during replay initialization\n{traceback.format_exc()}')
     finally:
@@ -268,78 +262,108 @@ def check_names_handles():
         logger.error(f'Error when finding player handles:\n{traceback.format_exc()}')
 
 
+def get_replay_watcher():
+    """ Returns the replay watcher for the current account folder """
+    global replay_watcher
+    folder = SM.settings['account_folder']
+    if replay_watcher is None or replay_watcher.folder != folder:
+        if replay_watcher is not None:
+            replay_watcher.close()
+        # Without inotify the folder is scanned every `replay_check_interval` half-seconds
+        replay_watcher = ReplayWatcher(folder, scan_interval=SM.settings['replay_check_interval'] * 0.5)
+    return replay_watcher
+
+
+def new_replay_event(replay_dict):
+    """ Returns overlay data for a new replay with session and randomized commander info """
+    out = replay_dict.copy()
+    out['newReplay'] = True
+    if SM.settings.get('show_session', False):
+        out.update(session_games)
+    if SM.settings.get('show_random_on_overlay', False) and len(RNG_COMMANDER) > 0:
+        out.update(RNG_COMMANDER)
+    out['fastest'] = False
+    return out
+
+
 def check_replays():
-    """ Checks every few seconds for new replays """
+    """ Waits for new replays and analyses them. Returns after a new replay is analysed. """
     global AllReplays
     global session_games
     global ReplayPosition
 
     while True:
-        logger.debug('Checking for replays....')
-        # Check for new replays
-        current_time = time.time()
-        for root, directories, files in os.walk(SM.settings['account_folder']):
-            for file in files:
-                file_path = os.path.join(root, file)
-                file_path = os.path.normpath(file_path)
+        # Wait for a new replay while checking if the thread should end early
+        file_path = get_replay_watcher().get(timeout=0.5)
+        if APP_CLOSING:
+            return None
 
-                if not file.endswith('.SC2Replay') or file_path in AllReplays:
-                    continue
+        if file_path is None or file_path in AllReplays:
+            continue
+
+        file = os.path.basename(file_path)
+        try:
+            created = os.path.getmtime(file_path)
+        except OSError:
+            continue
+
+        with lock:
+            position = AllReplays.add(file_path, created)
+            # Keep the same replay selected if this one was inserted before it
+            if position <= ReplayPosition:
+                ReplayPosition += 1
+
+        if time.time() - created >= 60:
+            continue
+
+        logger.info(f'New replay: {file_path}')
+        replay_dict = dict()
+        counted = False
+        try:
+            # Basic data from the replay card are shown right away, the full analysis fills in the rest
+            card_future = worker_pool.submit(get_replay_card, file_path, PLAYER_HANDLES, priority=HIGH)
+            analysis_future = worker_pool.submit(parse_and_analyse_replay, file_path, PLAYER_HANDLES, priority=HIGH)
 
+            card = card_future.result()
+            if card.get('mainCommander') or card.get('allyCommander'):
                 with lock:
-                    AllReplays[file_path] = {'created': os.path.getmtime(file_path)}
-
-                if current_time - os.path.getmtime(file_path) >= 60:
-                    continue
-
-                logger.info(f'New replay: {file_path}')
-                replay_dict = dict()
-                try:
-                    replay_dict = parse_and_analyse_replay(file_path, PLAYER_HANDLES)
-
-                    # First check if any commander found
-                    if not replay_dict.get('mainCommander') and not replay_dict.get('allyCommander'):
-                        logger.info('No commanders found, wont show replay')
-                    # Then check if we have good
-                    elif len(replay_dict) > 1:
-                        logger.debug('Replay analysis result looks good, appending...')
-                        with lock:
-                            session_games[replay_dict['result']] += 1
-
-                        # What to send
-                        out = replay_dict.copy()
-                        out['newReplay'] = True
-                        if SM.settings.get('show_session', False):
-                            out.update(session_games)
-                        if SM.settings.get('show_random_on_overlay', False) and len(RNG_COMMANDER) > 0:
-                            out.update(RNG_COMMANDER)
-
-                        out['fastest'] = False
-                        if CAnalysis is not None and not '[MM]' in file and replay_dict['parser']['isBlizzard']:
-                            out['fastest'] = CAnalysis.check_for_record(replay_dict)
-
-                        sendEvent(out)
-
-                    # No output
-                    else:
-                        logger.error(f'ERROR: No output from replay analysis ({file})')
+                    session_games[card['result']] += 1
+                counted = True
+                sendEvent(new_replay_event(card))
+
+            replay_dict = analysis_future.result()
+
+            # First check if any commander found
+            if not replay_dict.get('mainCommander') and not replay_dict.get('allyCommander'):
+                logger.info('No commanders found, wont show replay')
+            # Then check if we have good
+            elif len(replay_dict) > 1:
+                logger.debug('Replay analysis result looks good, appending...')
+                if not counted:
                     with lock:
-                        ReplayPosition = len(AllReplays) - 1
+                        session_games[replay_dict['result']] += 1
 
-                except Exception:
-                    logger.error(traceback.format_exc())
+                # What to send
+                out = new_replay_event(replay_dict)
+                if CAnalysis is not None and not '[MM]' in file and replay_dict['parser']['isBlizzard']:
+                    out['fastest'] = CAnalysis.check_for_record(replay_dict)
 
-                finally:
-                    if len(replay_dict) > 1:
-                        upload_to_aom(file_path, replay_dict)
-                        # return just parser
-                        return replay_dict
+                sendEvent(out)
 
-        # Wait while checking if the thread should end early
-        for i in range(int(SM.settings['replay_check_interval'])):
-            time.sleep(0.5)
-            if APP_CLOSING:
-                return None
+            # No output
+            else:
+                logger.error(f'ERROR: No output from replay analysis ({file})')
+            with lock:
+                ReplayPosition = AllReplays.position(file_path)
+
+        except Exception:
+            logger.error(traceback.format_exc())
+
+        finally:
+            if len(replay_dict) > 1:
+                upload_to_aom(file_path, replay_dict)
+                # return just parser
+                return replay_dict
 
 
 def upload_to_aom(file_path, replay_dict):
@@ -371,27 +395,19 @@ def upload_to_aom(file_path, replay_dict):
         logger.error(f'Failed to upload replay\n{traceback.format_exc()}')
 
 
-def show_overlay(file, add_replay=True):
-    """ Shows overlay. If it wasn't analysed before, analyse now."""
-    global ReplayPosition
-
-    if file in AllReplays.keys():
-        with lock:
-            ReplayPosition = list(AllReplays.keys()).index(file)
-
+def get_overlay_data(file, priority=HIGH, add_replay=True):
+    """ Returns data to show on the overlay. If it wasn't analysed before, analyse now with given worker pool priority."""
     # Try to find if the replay is analysed in CAnalysis
     rhash = get_hash(file)
     if CAnalysis is not None:
         data = CAnalysis.get_data_for_overlay(rhash)
         if data is not None:
-            sendEvent(data)
             return data
 
     # Didn't find the replay, analyse
     try:
-        replay_dict = parse_and_analyse_replay(file, PLAYER_HANDLES)
+        replay_dict = worker_pool.submit(parse_and_analyse_replay, file, PLAYER_HANDLES, rhash, priority=priority).result()
         if len(replay_dict) > 1:
-            sendEvent(replay_dict)
             if CAnalysis is not None and add_replay:
                 CAnalysis.add_parsed_replay(replay_dict)
             return replay_dict
@@ -402,6 +418,37 @@ def show_overlay(file, add_replay=True):
         return 'Error'
 
 
+overlay_cache = OverlayCache(get_overlay_data)
+
+
+def prefetch_neighbours(position, distance=2):
+    """ Prepares overlay data for replays around the position in the background, the closest first """
+    with lock:
+        positions = (position + sign * d for d in range(1, distance + 1) for sign in (-1, 1))
+        files = [AllReplays.path(p) for p in positions if 0 <= p < len(AllReplays)]
+    for file in files:
+        overlay_cache.prefetch(file)
+
+
+def show_overlay(file, add_replay=True):
+    """ Shows overlay. If it wasn't analysed before, analyse now."""
+    global ReplayPosition
+
+    position = None
+    if file in AllReplays:
+        with lock:
+            ReplayPosition = position = AllReplays.position(file)
+
+    # Replays not added to the analysis are shown without caching
+    data = overlay_cache.load(file) if add_replay else get_overlay_data(file, add_replay=False)
+    if isinstance(data, dict):
+        sendEvent(data)
+
+    if position is not None:
+        prefetch_neighbours(position)
+    return data
+
+
 async def manager(websocket, path):
     """ Manages websocket connection for each client """
     overlayMessagesSent = globalOverlayMessagesSent
@@ -460,7 +507,7 @@ def move_in_AllReplays(delta):
         return
 
     # Get replay_dict of given replay
-    file = list(AllReplays.keys())[newPosition]
+    file = AllReplays.path(newPosition)
     result = show_overlay(file)
     if result == 'Error':
         move_in_AllReplays(delta)
@@ -525,7 +572,8 @@ def wait_for_wake():
 
 def check_for_new_game(progress_callback):
     global most_recent_playerdata
-    """ Thread checking for a new game and sending signals to the overlay with player winrate stats"""
+    """ Thread checking for a new game and sending signals to the overlay with player winrate stats.
+    It also pauses background replay analysis while a game is running, so it doesn't take resources from StarCraft II."""
     # Wait a bit for the replay initialization to complete
     time.sleep(4)
     """
@@ -538,6 +586,8 @@ def check_for_new_game(progress_callback):
     last_replay_amount = 0
     last_replay_amount_flowing = len(AllReplays)  # This helps identify when a replay has been parsed
     last_replay_time = 0  # Time when we got the last replay parsed
+    last_pool_check = 0  # Time when the worker pool was updated
+    last_pool_game_time = None  # Game time from the last worker pool update
 
     while True:
         time.sleep(0.5)
@@ -545,18 +595,49 @@ def check_for_new_game(progress_callback):
         if APP_CLOSING:
             break
 
-        # Skip if winrate data not showing OR no new replay analysed, meaning it's the same game (excluding the first game)
-        if len(player_winrate_data) == 0 or len(AllReplays) == last_replay_amount:
+        # Update the worker pool every two seconds. Check players if winrate data are showing AND a new replay was analysed,
+        # otherwise it's the same game (excluding the first game)
+        check_pool = time.time() - last_pool_check >= 2
+        check_players = SM.settings['show_player_winrates'] and len(player_winrate_data) > 0 and len(AllReplays) != last_replay_amount
+        if not check_pool and not check_players:
             continue
 
         # When we get a new replay, mark the time
-        if len(AllReplays) > last_replay_amount_flowing:
+        if check_players and len(AllReplays) > last_replay_amount_flowing:
             last_replay_amount_flowing = len(AllReplays)
             last_replay_time = time.time()
 
+        # Request player data from the game
+        resp = None
         try:
-            # Request player data from the game
             resp = session.get('http://localhost:6119/game', timeout=6).json()
+
+        except requests.exceptions.ConnectionError:
+            logger.debug(f'SC2 request failed. Game not running.')
+
+        except json.decoder.JSONDecodeError:
+            logger.info('SC2 request json decoding failed (SC2 is starting or closing)')
+
+        except requests.exceptions.ReadTimeout:
+            logger.info('SC2 request timeout')
+
+        except Exception:
+            logger.info(traceback.format_exc())
+
+        # Game time changes only in a running game, it's constant in menus and after the game ends
+        if check_pool:
+            last_pool_check = time.time()
+            game_time = resp.get('displayTime', 0) if isinstance(resp, dict) else None
+            in_game = isinstance(resp, dict) and not resp.get('isReplay', True) and len(resp.get('players', list())) > 0 and game_time not in {
+                0, last_pool_game_time
+            }
+            last_pool_game_time = game_time
+            worker_pool.set_in_game(in_game)
+
+        if not check_players or not isinstance(resp, dict):
+            continue
+
+        try:
             players = resp.get('players', list())
 
             # Don't show in if all players are type user - versus game
@@ -630,14 +711,5 @@ def check_for_new_game(progress_callback):
             except Exception:
                 logger.error(traceback.format_exc())
 
-        except requests.exceptions.ConnectionError:
-            logger.debug(f'SC2 request failed. Game not running.')
-
-        except json.decoder.JSONDecodeError:
-            logger.info('SC2 request json decoding failed (SC2 is starting or closing)')
-
-        except requests.exceptions.ReadTimeout:
-            logger.info('SC2 request timeout')
-
         except Exception:
             logger.info(traceback.format_exc())
\ No newline at end of file
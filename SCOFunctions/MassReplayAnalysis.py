@@ -5,25 +5,29 @@ This module is used for generating overall stats from a list of replays (and pla
 import os
 import time
 import json
-import pickle
+import bisect
+from array import array
 import fnmatch
 import pathlib
 import traceback
 import statistics
 import threading
 from pprint import pprint
-from concurrent.futures import ProcessPoolExecutor
 
 import s2protocol
 
+import SCOFunctions.MEventCache as EC
 from SCOFunctions.MFilePath import truePath
 from SCOFunctions.MLogging import logclass, catch_exceptions
 from SCOFunctions.S2Parser import s2_parse_replay
-from SCOFunctions.ReplayAnalysis import analyse_parsed_replay, parse_replay_file
-from SCOFunctions.HelperFunctions import get_hash
+from SCOFunctions.ReplayAnalysis import analyse_parsed_replay, parse_replay_file, analysis_events
+from SCOFunctions.HelperFunctions import get_hash, hash_index
 from SCOFunctions.MainFunctions import find_names_and_handles, find_replays, names_fallback
 from SCOFunctions.SC2Dictionaries import bonus_objectives, mc_units, prestige_names, map_names, units_to_stats
 from SCOFunctions.MReplayData import replay_data
+from SCOFunctions.MReplayStore import ReplayStore, materialize
+from SCOFunctions.MWorkerPool import worker_pool, LOW
+from SCOFunctions.Settings import Setting_manager as SM
 
 logger = logclass('MASS', 'INFO')
 lock = threading.Lock()
@@ -49,79 +53,153 @@ def guarded_parse_replay_file(*args, **kwargs):
         return e
 
 
+def remove_useless_keys(pdict):
+    """ Removes keys from the dictionary that are no longer useful"""
+    to_remove = ('start_time', 'end_time', 'isBlizzard', 'last_deselect_event')
+    for k in to_remove:
+        if k in pdict:
+            del pdict[k]
+
+
 @catch_exceptions(logger)
-def calculate_difficulty_data(ReplayData):
-    """ Calculates the number of wins and losses for each difficulty"""
-    DifficultyData = dict()
+def format_data(full_data, rhash=None):
+    """ Formats data returned by replay analysis into a single datastructure used here"""
+    parsed_data = full_data['parser']
+    parsed_data['accurate_length'] = full_data['length'] * 1.4
+    parsed_data['bonus'] = full_data['bonus']
+    parsed_data['comp'] = full_data['comp']
+    parsed_data['full_analysis'] = True
+    parsed_data['hash'] = rhash if rhash is not None else parsed_data.get('hash', get_hash(full_data['file']))
+    parsed_data['amon_units'] = full_data['amon_units']
+    parsed_data['player_stats'] = full_data['player_stats']
+    remove_useless_keys(parsed_data)
+    parsed_data['players'] = tuple(parsed_data['players'][:3])
+    main = full_data['positions']['main']
+    for p in (1, 2):
+        parsed_data['players'][p]['kills'] = full_data['mainkills'] if p == main else full_data['allykills']
+        parsed_data['players'][p]['icons'] = full_data['mainIcons'] if p == main else full_data['allyIcons']
+        parsed_data['players'][p]['units'] = full_data['mainUnits'] if p == main else full_data['allyUnits']
+    return replay_data(**parsed_data)
+
+
+def guarded_full_analysis(filepath, rhash, main_handles):
+    """ Parses, analyses and formats a replay. Meant to run in a worker process, so only the final
+    `replay_data` is sent back instead of all decoded events.
+    Returns None if the replay couldn't be analysed, or an exception if one occurred."""
+    try:
+        replay = s2_parse_replay(filepath, return_events=True, event_filter=analysis_events, cache_hash=rhash)
+        full_data = analyse_parsed_replay(filepath, replay, main_handles)
+        if len(full_data) < 2:
+            return None
+        return format_data(full_data, rhash)
+    except Exception as e:
+        return e
 
-    for r in ReplayData:
+
+class DifficultyStats:
+    """ Number of wins and losses for each difficulty. Replays are added one by one with `add`."""
+    def __init__(self, ReplayData=()):
+        self.data = dict()
+        for r in ReplayData:
+            self.add(r)
+
+    def add(self, r):
         diff = r.ext_difficulty
         # Skip mixed difficulties
         if '/' in diff:
-            continue
+            return
         # Add empty dict
-        if not diff in DifficultyData:
-            DifficultyData[diff] = {'Victory': 0, 'Defeat': 0}
+        if not diff in self.data:
+            self.data[diff] = {'Victory': 0, 'Defeat': 0}
 
-        DifficultyData[diff][r.result] += 1
+        self.data[diff][r.result] += 1
 
-    for diff in DifficultyData:
-        DifficultyData[diff]['Winrate'] = DifficultyData[diff]['Victory'] / (DifficultyData[diff]['Victory'] + DifficultyData[diff]['Defeat'])
-
-    return DifficultyData
+    @catch_exceptions(logger)
+    def result(self):
+        DifficultyData = dict()
+        for diff, d in self.data.items():
+            DifficultyData[diff] = {'Victory': d['Victory'], 'Defeat': d['Defeat'], 'Winrate': d['Victory'] / (d['Victory'] + d['Defeat'])}
+        return DifficultyData
 
 
 @catch_exceptions(logger)
-def calculate_map_data(ReplayData):
-    """ Calculates the number of wins and losses for each map """
-    MapData = dict()
+def calculate_difficulty_data(ReplayData):
+    """ Calculates the number of wins and losses for each difficulty"""
+    return DifficultyStats(ReplayData).result()
+
+
+def _bonus_fraction(r):
+    """ Returns a fraction of bonus objectives completed or None """
+    try:
+        return len(r.bonus) / bonus_objectives[r.map_name]
+    except KeyError:  # Incorrect map name
+        lower_name = r.map_name.lower()
+        for m in map_names:
+            if m.lower() in lower_name:
+                eng_name = map_names[m]['EN']
+                return len(r.bonus) / bonus_objectives[eng_name]
+    except Exception:
+        logger.error(traceback.format_exc())
+    return None
 
-    for r in ReplayData:
-        if not r.map_name in MapData:
-            MapData[r.map_name] = {'Victory': 0, 'Defeat': 0, 'Fastest': {'length': 999999}, 'average_victory_time': list(), 'bonus': list()}
 
-        MapData[r.map_name][r.result] += 1
+class MapStats:
+    """ Number of wins and losses, victory times, bonus objectives and fastest clears for each map"""
+    def __init__(self, ReplayData=()):
+        self.data = dict()
+        self.games = 0
+        for r in ReplayData:
+            self.add(r)
+
+    def add(self, r):
+        self.games += 1
+        if not r.map_name in self.data:
+            self.data[r.map_name] = {'Victory': 0, 'Defeat': 0, 'Fastest': {'length': 999999}, 'victory_time': 0, 'bonus': 0, 'bonus_games': 0}
+
+        d = self.data[r.map_name]
+        d[r.result] += 1
 
         if r.result == 'Victory':
-            MapData[r.map_name]['average_victory_time'].append(r.accurate_length)
+            d['victory_time'] += r.accurate_length
 
-            # Append a fraction of bonus completed
+            # Add a fraction of bonus completed
             if r.bonus is not None:
-                try:
-                    MapData[r.map_name]['bonus'].append(len(r.bonus) / bonus_objectives[r.map_name])
-                except KeyError:  # Incorrect map name
-                    lower_name = r.map_name.lower()
-                    for m in map_names:
-                        if m.lower() in lower_name:
-                            eng_name = map_names[m]['EN']
-                            MapData[r.map_name]['bonus'].append(len(r.bonus) / bonus_objectives[eng_name])
-                            break
-                except Exception:
-                    logger.error(traceback.format_exc())
-
-        # Fastest clears
-        if r.result == 'Victory' and r.accurate_length < MapData[r.map_name]['Fastest']['length']:
-            MapData[r.map_name]['Fastest']['length'] = r.accurate_length
-            MapData[r.map_name]['Fastest']['file'] = r.file
-            MapData[r.map_name]['Fastest']['players'] = r.players[1:3]
-            MapData[r.map_name]['Fastest']['enemy_race'] = r.enemy_race
-            MapData[r.map_name]['Fastest']['date'] = r.date
-            MapData[r.map_name]['Fastest']['difficulty'] = r.ext_difficulty
-
-    for m in MapData:
-        MapData[m]['frequency'] = (MapData[m]['Victory'] + MapData[m]['Defeat']) / len(ReplayData)
-        MapData[m]['winrate'] = MapData[m]['Victory'] / (MapData[m]['Victory'] + MapData[m]['Defeat'])
-        if len(MapData[m]['average_victory_time']) > 0:
-            MapData[m]['average_victory_time'] = statistics.mean(MapData[m]['average_victory_time'])
-        else:
-            MapData[m]['average_victory_time'] = 999999
+                bonus = _bonus_fraction(r)
+                if bonus is not None:
+                    d['bonus'] += bonus
+                    d['bonus_games'] += 1
+
+            # Fastest clears
+            if r.accurate_length < d['Fastest']['length']:
+                d['Fastest'] = {
+                    'length': r.accurate_length,
+                    'file': r.file,
+                    'players': r.players[1:3],
+                    'enemy_race': r.enemy_race,
+                    'date': r.date,
+                    'difficulty': r.ext_difficulty
+                }
 
-        if len(MapData[m]['bonus']) > 0:
-            MapData[m]['bonus'] = sum(MapData[m]['bonus']) / len(MapData[m]['bonus'])
-        else:
-            MapData[m]['bonus'] = 0
+    @catch_exceptions(logger)
+    def result(self):
+        MapData = dict()
+        for m, d in self.data.items():
+            MapData[m] = {
+                'Victory': d['Victory'],
+                'Defeat': d['Defeat'],
+                'Fastest': dict(d['Fastest']),
+                'average_victory_time': d['victory_time'] / d['Victory'] if d['Victory'] > 0 else 999999,
+                'bonus': d['bonus'] / d['bonus_games'] if d['bonus_games'] > 0 else 0,
+                'frequency': (d['Victory'] + d['Defeat']) / self.games,
+                'winrate': d['Victory'] / (d['Victory'] + d['Defeat'])
+            }
+        return MapData
 
-    return MapData
+
+@catch_exceptions(logger)
+def calculate_map_data(ReplayData):
+    """ Calculates the number of wins and losses for each map """
+    return MapStats(ReplayData).result()
 
 
 def get_masterises(replay, player):
@@ -136,172 +214,122 @@ def get_masterises(replay, player):
     return masteries
 
 
-@catch_exceptions(logger)
-def calculate_commander_data(ReplayData, main_handles):
-    """ Calculates the number of wins and losses for each commander
-    Returns separate objects for players with handles in MainHandles (capitalization not important) and those that are not"""
-    CommanderData = dict()
-    AllyCommanderData = dict()
-    games = 0
-    CommanderData['any'] = {'Victory': 0, 'Defeat': 0, 'MedianAPM': list(), 'KillFraction': list()}
-    AllyCommanderData['any'] = {'Victory': 0, 'Defeat': 0, 'MedianAPM': list(), 'KillFraction': list()}
+def _median(values):
+    """ Returns the median of a sorted list """
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2
 
-    for r in ReplayData:
+
+class CommanderStats:
+    """ Number of wins and losses, APM, kills, masteries and prestiges for each commander.
+    Players with handles in `main_handles` are kept separately from the rest.
+    APM and kill fractions are kept sorted, so medians don't require sorting."""
+    def __init__(self, main_handles, ReplayData=()):
+        self.main_handles = main_handles
+        self.main = {'any': self._empty()}
+        self.ally = {'any': self._empty()}
+        self.games = 0
+        for r in ReplayData:
+            self.add(r)
+
+    @staticmethod
+    def _empty():
+        return {'Victory': 0, 'Defeat': 0, 'MedianAPM': list(), 'Prestige': dict(), 'Mastery': [0, 0, 0, 0, 0, 0], 'KillFraction': list()}
+
+    def add(self, r):
         total_kills = r.players[1].get('kills', 0) + r.players[2].get('kills', 0)
         for p in (1, 2):
             commander = r.players[p]['commander']
-            if r.players[p]['handle'] in main_handles:
-                if not commander in CommanderData:
-                    CommanderData[commander] = {
-                        'Victory': 0,
-                        'Defeat': 0,
-                        'MedianAPM': list(),
-                        'Prestige': list(),
-                        'Mastery': list(),
-                        'KillFraction': list()
-                    }
-
-                CommanderData[commander][r.result] += 1
-                CommanderData[commander]['MedianAPM'].append(r.players[p]['apm'])
-                CommanderData['any'][r.result] += 1
-                CommanderData['any']['MedianAPM'].append(r.players[p]['apm'])
-
+            data = self.main if r.players[p]['handle'] in self.main_handles else self.ally
+            if data is self.main:
+                self.games += 1
+            if not commander in data:
+                data[commander] = self._empty()
+
+            for d in (data[commander], data['any']):
+                d[r.result] += 1
+                bisect.insort(d['MedianAPM'], r.players[p]['apm'])
                 if total_kills > 0:
-                    CommanderData[commander]['KillFraction'].append(r.players[p]['kills'] / total_kills)
-                    CommanderData['any']['KillFraction'].append(r.players[p]['kills'] / total_kills)
+                    bisect.insort(d['KillFraction'], r.players[p]['kills'] / total_kills)
 
-                games += 1
+            # Count prestige only after they were released
+            if int(r.date.replace(':', '')) > 20200726000000:
+                prestige = r.players[p]['prestige']
+                data[commander]['Prestige'][prestige] = data[commander]['Prestige'].get(prestige, 0) + 1
 
-                # Count prestige only after they were released
-                if int(r.date.replace(':', '')) > 20200726000000:
-                    CommanderData[commander]['Prestige'].append(r.players[p]['prestige'])
+            # Add masteries, use relative values to properly reflect player preferences
+            masteries = get_masterises(r, p)
+            mastery_sum = sum(masteries) / 3
+            masteries = [m / mastery_sum for m in masteries] if mastery_sum != 0 else masteries
+            for idx, m in enumerate(masteries):
+                data[commander]['Mastery'][idx] += m
 
-                # Add masteries, use relative values to properly reflect player preferences
-                masteries = get_masterises(r, p)
-                mastery_sum = sum(masteries) / 3
-                masteries = [m / mastery_sum for m in masteries] if mastery_sum != 0 else masteries
-                CommanderData[commander]['Mastery'].append(masteries)
+    @staticmethod
+    def _finalize(d):
+        """ Returns winrate, median APM and kill fraction, normalized masteries and prestige frequencies """
+        com_games = len(d['MedianAPM'])
+        out = {
+            'Victory': d['Victory'],
+            'Defeat': d['Defeat'],
+            'MedianAPM': 0 if com_games == 0 else _median(d['MedianAPM']),
+            'KillFraction': _median(d['KillFraction']) if len(d['KillFraction']) > 0 else 0,
+            'Winrate': 0 if com_games == 0 else d['Victory'] / com_games
+        }
 
-            else:
-                if not commander in AllyCommanderData:
-                    AllyCommanderData[commander] = {
-                        'Victory': 0,
-                        'Defeat': 0,
-                        'MedianAPM': list(),
-                        'Prestige': list(),
-                        'Mastery': list(),
-                        'KillFraction': list()
-                    }
-
-                AllyCommanderData[commander][r.result] += 1
-                AllyCommanderData[commander]['MedianAPM'].append(r.players[p]['apm'])
-                if total_kills > 0:
-                    AllyCommanderData[commander]['KillFraction'].append(r.players[p]['kills'] / total_kills)
-                    AllyCommanderData['any']['KillFraction'].append(r.players[p]['kills'] / total_kills)
-
-                # Count prestige only after they were released
-                if int(r.date.replace(':', '')) > 20200726000000:
-                    AllyCommanderData[commander]['Prestige'].append(r.players[p]['prestige'])
-
-                AllyCommanderData['any'][r.result] += 1
-                AllyCommanderData['any']['MedianAPM'].append(r.players[p]['apm'])
-
-                # Add masteries, use relative values to properly reflect player preferences
-                masteries = get_masterises(r, p)
-                mastery_sum = sum(masteries) / 3
-                masteries = [m / mastery_sum for m in masteries] if mastery_sum != 0 else masteries
-                AllyCommanderData[commander]['Mastery'].append(masteries)
-
-    # Main player
-    for commander in CommanderData:
-        com_games = len(CommanderData[commander]['MedianAPM'])
-        CommanderData[commander]['Frequency'] = 0 if games == 0 else com_games / games
-        CommanderData[commander]['Winrate'] = 0 if com_games == 0 else CommanderData[commander]['Victory'] / len(
-            CommanderData[commander]['MedianAPM'])
-        CommanderData[commander]['MedianAPM'] = 0 if com_games == 0 else statistics.median(CommanderData[commander]['MedianAPM'])
-
-        # Fraction kills
-        if len(CommanderData[commander]['KillFraction']) > 0:
-            CommanderData[commander]['KillFraction'] = statistics.median(CommanderData[commander]['KillFraction'])
-        else:
-            CommanderData[commander]['KillFraction'] = 0
-
-        if commander != 'any':
-            # Mastery (sum list of lists, normalize)
-            mastery_summed = {0: 0, 1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
-            for i in CommanderData[commander]['Mastery']:
-                for idx, m in enumerate(i):
-                    mastery_summed[idx] += m
-
-            # Normalize mastery choices
-            mastery_summed_copy = mastery_summed.copy()
-            for idx, m in enumerate(mastery_summed):
-                divisor = (mastery_summed_copy[(idx // 2) * 2] + mastery_summed_copy[(idx // 2) * 2 + 1])
-                mastery_summed[idx] = 0 if divisor == 0 else mastery_summed[idx] / divisor
-
-            CommanderData[commander]['Mastery'] = mastery_summed
-
-            # Prestige
-            if len(CommanderData[commander]['Prestige']) > 0:
-                CommanderData[commander]['Prestige'] = {
-                    i: CommanderData[commander]['Prestige'].count(i) / len(CommanderData[commander]['Prestige'])
-                    for i in (0, 1, 2, 3)
-                }
-            else:
-                CommanderData[commander]['Prestige'] = {0: 0, 1: 0, 2: 0, 3: 0}
+        # Normalize mastery choices
+        mastery = d['Mastery']
+        out['Mastery'] = dict()
+        for idx, m in enumerate(mastery):
+            divisor = mastery[(idx // 2) * 2] + mastery[(idx // 2) * 2 + 1]
+            out['Mastery'][idx] = 0 if divisor == 0 else m / divisor
 
-    # Ally
-    would_be_observed_games_total = 0
-    for commander in AllyCommanderData:
-        com_games = len(AllyCommanderData[commander]['MedianAPM'])
+        # Prestige
+        prestige_games = sum(d['Prestige'].values())
+        out['Prestige'] = {i: 0 if prestige_games == 0 else d['Prestige'].get(i, 0) / prestige_games for i in (0, 1, 2, 3)}
+        return out
 
-        # Fraction kills
-        if len(AllyCommanderData[commander]['KillFraction']) > 0:
-            AllyCommanderData[commander]['KillFraction'] = statistics.median(AllyCommanderData[commander]['KillFraction'])
-        else:
-            AllyCommanderData[commander]['KillFraction'] = 0
-
-        # Winrate
-        AllyCommanderData[commander]['Winrate'] = 0 if com_games == 0 else AllyCommanderData[commander]['Victory'] / com_games
-
-        # APM
-        AllyCommanderData[commander]['MedianAPM'] = 0 if com_games == 0 else statistics.median(AllyCommanderData[commander]['MedianAPM'])
-
-        if commander != 'any':
-            # Mastery (sum list of lists, normalize)
-            mastery_summed = {0: 0, 1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
-            for i in AllyCommanderData[commander]['Mastery']:
-                for idx, m in enumerate(i):
-                    mastery_summed[idx] += m
-
-            # Normalize mastery choices
-            mastery_summed_copy = mastery_summed.copy()
-            for idx, m in enumerate(mastery_summed):
-                divisor = (mastery_summed_copy[(idx // 2) * 2] + mastery_summed_copy[(idx // 2) * 2 + 1])
-                mastery_summed[idx] = 0 if divisor == 0 else mastery_summed[idx] / divisor
-
-            AllyCommanderData[commander]['Mastery'] = mastery_summed
-
-            # Prestige
-            if len(AllyCommanderData[commander]['Prestige']) > 0:
-                AllyCommanderData[commander]['Prestige'] = {
-                    i: AllyCommanderData[commander]['Prestige'].count(i) / len(AllyCommanderData[commander]['Prestige'])
-                    for i in (0, 1, 2, 3)
-                }
-            else:
-                AllyCommanderData[commander]['Prestige'] = {0: 0, 1: 0, 2: 0, 3: 0}
+    @catch_exceptions(logger)
+    def result(self):
+        """ Returns separate objects for main players and allies """
+        # Main player
+        CommanderData = dict()
+        for commander, d in self.main.items():
+            CommanderData[commander] = self._finalize(d)
+            CommanderData[commander]['Frequency'] = 0 if self.games == 0 else len(d['MedianAPM']) / self.games
+            if commander == 'any':
+                del CommanderData[commander]['Mastery']
+                del CommanderData[commander]['Prestige']
+
+        # Ally
+        AllyCommanderData = dict()
+        would_be_observed_games_total = 0
+        for commander, d in self.ally.items():
+            AllyCommanderData[commander] = self._finalize(d)
+            if commander == 'any':
+                del AllyCommanderData[commander]['Mastery']
+                del AllyCommanderData[commander]['Prestige']
+                continue
 
             # For ally correct frequency for the main player selecting certain commander (1/(1-f)) factor and rescale
-            would_be_observed_games = (1 / (1 - CommanderData.get(commander, {'Frequency': 0})['Frequency'])) * com_games
+            would_be_observed_games = (1 / (1 - CommanderData.get(commander, {'Frequency': 0})['Frequency'])) * len(d['MedianAPM'])
             AllyCommanderData[commander]['Frequency'] = would_be_observed_games
             would_be_observed_games_total += would_be_observed_games
 
-    AllyCommanderData['any']['Frequency'] = would_be_observed_games_total
-    for commander in AllyCommanderData:
-        AllyCommanderData[commander][
-            'Frequency'] = 0 if would_be_observed_games_total == 0 else AllyCommanderData[commander]['Frequency'] / would_be_observed_games_total
+        AllyCommanderData['any']['Frequency'] = would_be_observed_games_total
+        for commander in AllyCommanderData:
+            AllyCommanderData[commander][
+                'Frequency'] = 0 if would_be_observed_games_total == 0 else AllyCommanderData[commander]['Frequency'] / would_be_observed_games_total
+
+        return CommanderData, AllyCommanderData
 
-    return CommanderData, AllyCommanderData
+
+@catch_exceptions(logger)
+def calculate_commander_data(ReplayData, main_handles):
+    """ Calculates the number of wins and losses for each commander
+    Returns separate objects for players with handles in MainHandles (capitalization not important) and those that are not"""
+    return CommanderStats(main_handles, ReplayData).result()
 
 
 def calculate_prestige_estimate(data: dict, commander: str, handle: str, region: str) -> int:
@@ -366,33 +394,79 @@ def calculate_unlocked_prestiges(ReplayData: list, main_handles: set) -> dict:
     return out
 
 
-@catch_exceptions(logger)
-def calculate_region_data(ReplayData, main_handles):
-    """ Calculates region data - frequency, wins, losses, winrate, max ascension level, leveled commanders """
-    dRegion = dict()
-    for r in ReplayData:
-        if not r.region in dRegion:
-            dRegion[r.region] = {'Victory': 0, 'Defeat': 0, 'max_asc': 0, 'max_com': set(), 'prestiges': dict()}
+class RegionStats:
+    """ Region data - frequency, wins, losses, winrate, max ascension level, leveled commanders and unlocked prestiges.
+    Prestige estimates are recalculated only for commanders with new games."""
+    def __init__(self, main_handles, ReplayData=()):
+        self.main_handles = main_handles
+        self.data = dict()
+        self.games = 0
+        self.prestige_games = dict()  # (commander, handle, region): sorted list of (date, level, prestige)
+        self.prestige_estimates = dict()
+        self.outdated = set()  # keys with outdated prestige estimates
+        for r in ReplayData:
+            self.add(r)
 
-        dRegion[r.region][r.result] += 1
+    def add(self, r):
+        self.games += 1
+        if not r.region in self.data:
+            self.data[r.region] = {'Victory': 0, 'Defeat': 0, 'max_asc': 0, 'max_com': set()}
+
+        d = self.data[r.region]
+        d[r.result] += 1
 
         for p in (1, 2):
-            if r.players[p]['handle'] in main_handles:
+            if r.players[p]['handle'] in self.main_handles:
                 # Add leveled commanders:
                 if r.players[p]['commander_level'] == 15:
-                    dRegion[r.region]['max_com'].add(r.players[p]['commander'])
+                    d['max_com'].add(r.players[p]['commander'])
                 # Track max ascension
-                if r.players[p]['commander_mastery_level'] > dRegion[r.region]['max_asc']:
-                    dRegion[r.region]['max_asc'] = r.players[p]['commander_mastery_level']
+                if r.players[p]['commander_mastery_level'] > d['max_asc']:
+                    d['max_asc'] = r.players[p]['commander_mastery_level']
+
+        # Save data for prestige estimates in format date-level-prestige
+        date = int(r.date.replace(':', ''))
+        for p in r.players:
+            if p['pid'] in {1, 2} and p['handle'] in self.main_handles:
+                key = (p['commander'], p['handle'], r.region)
+                bisect.insort(self.prestige_games.setdefault(key, list()), (date, p['commander_level'], p['prestige']))
+                self.outdated.add(key)
+
+    def unlocked_prestiges(self):
+        """ Returns estimates for unlocked prestiges for each region and commander"""
+        for key in self.outdated:
+            self.prestige_estimates[key] = calculate_prestige_estimate(self.prestige_games, *key)
+        self.outdated = set()
+
+        out = dict()
+        for (commander, handle, region), estimate_prestige in self.prestige_estimates.items():
+            if region not in out:
+                out[region] = dict()
+            if commander not in out[region] or estimate_prestige > out[region][commander]:
+                out[region][commander] = estimate_prestige
+        return out
 
-    prestige_data = calculate_unlocked_prestiges(ReplayData, main_handles)
+    @catch_exceptions(logger)
+    def result(self):
+        prestige_data = self.unlocked_prestiges()
+        dRegion = dict()
+        for region, d in self.data.items():
+            dRegion[region] = {
+                'Victory': d['Victory'],
+                'Defeat': d['Defeat'],
+                'max_asc': d['max_asc'],
+                'max_com': set(d['max_com']),
+                'prestiges': prestige_data.get(region, dict()),
+                'winrate': d['Victory'] / (d['Victory'] + d['Defeat']),
+                'frequency': (d['Victory'] + d['Defeat']) / self.games
+            }
+        return dRegion
 
-    for region in dRegion:
-        dRegion[region]['winrate'] = dRegion[region]['Victory'] / (dRegion[region]['Victory'] + dRegion[region]['Defeat'])
-        dRegion[region]['frequency'] = (dRegion[region]['Victory'] + dRegion[region]['Defeat']) / len(ReplayData)
-        dRegion[region]['prestiges'] = prestige_data.get(region, dict())
 
-    return dRegion
+@catch_exceptions(logger)
+def calculate_region_data(ReplayData, main_handles):
+    """ Calculates region data - frequency, wins, losses, winrate, max ascension level, leveled commanders """
+    return RegionStats(main_handles, ReplayData).result()
 
 
 def _add_units(unit_data: dict, r: dict, p: int):
@@ -434,19 +508,19 @@ def _add_units(unit_data: dict, r: dict, p: int):
             else:
                 unit_data[commander][unit][s] = r.players[p]['units'][unit][i]
 
-        # Add bonus kills to mind-controlling unit
+        # Add bonus kills to mind-controlling unit. Kill fractions are kept sorted for medians.
         if mc_unit_bonus_kills > 0 and unit == mc_units[commander]:
             unit_data[commander][unit]['kills'] += mc_unit_bonus_kills
             kills_ingame = r.players[p]['units'][unit][2] + mc_unit_bonus_kills
             if r.players[p]['kills'] > 0:
-                unit_data[commander][unit]['kill_percentage'].append(kills_ingame / r.players[p]['kills'])
+                bisect.insort(unit_data[commander][unit]['kill_percentage'], kills_ingame / r.players[p]['kills'])
             else:
-                unit_data[commander][unit]['kill_percentage'].append(1)
+                bisect.insort(unit_data[commander][unit]['kill_percentage'], 1)
             mc_unit_bonus_kills = 0
 
         # Calculate kill fraction for the rest
         elif r.players[p]['kills'] > 0:
-            unit_data[commander][unit]['kill_percentage'].append(r.players[p]['units'][unit][2] / r.players[p]['kills'])
+            bisect.insort(unit_data[commander][unit]['kill_percentage'], r.players[p]['units'][unit][2] / r.players[p]['kills'])
 
 
 def _add_units_amon(unit_data: dict, r: dict):
@@ -509,7 +583,7 @@ def _process_dict_amon(unit_data: dict):
 
 
 def _process_dict(unit_data: dict):
-    """ Calculates median kill percentages, K/D, lost_percent"""
+    """ Calculates median kill percentages (from sorted lists), K/D, lost_percent"""
     for commander in unit_data:
         total = {'created': 0, 'lost': 0, 'kills': 0, 'kill_percentage': 1}
         units_to_delete = set()
@@ -530,7 +604,7 @@ def _process_dict(unit_data: dict):
 
             # Calculate median of kills
             if len(unit_data[commander][unit]['kill_percentage']) > 0:
-                unit_data[commander][unit]['kill_percentage'] = statistics.median(unit_data[commander][unit]['kill_percentage'])
+                unit_data[commander][unit]['kill_percentage'] = _median(unit_data[commander][unit]['kill_percentage'])
             else:
                 unit_data[commander][unit]['kill_percentage'] = 0
 
@@ -582,28 +656,60 @@ def _process_dict(unit_data: dict):
         unit_data[commander]['sum'] = total
 
 
-@catch_exceptions(logger)
-def calculate_unit_stats(ReplayData, main_handles):
-    """ Calculates stats for each unit type for player, allies and Amon.
-    This includes number of kills, created and lost for all unit types and sum"""
+class UnitStats:
+    """ Stats for each unit type for player, allies and Amon. Processing is done on copies, so more replays can be added later.
+    Processed stats are kept and only commanders changed since the last result are processed again."""
+    def __init__(self, main_handles, ReplayData=()):
+        self.main_handles = main_handles
+        self.main = dict()
+        self.ally = dict()
+        self.amon = dict()
+        self.processed = {'main': dict(), 'ally': dict(), 'amon': None}
+        self.changed = {'main': set(), 'ally': set()}  # Commanders changed since the last result
+        self.amon_changed = True
+        for r in ReplayData:
+            self.add(r)
+
+    def add(self, r):
+        if r.amon_units is not None:
+            _add_units_amon(self.amon, r)
+            self.amon_changed = True
+        for p in (1, 2):
+            if not 'units' in r.players[p]:
+                continue
+            kind = 'main' if r.players[p]['handle'] in self.main_handles else 'ally'
+            _add_units(getattr(self, kind), r, p)
+            self.changed[kind].add(r.players[p]['commander'])
 
-    main_unit_data = dict()
-    ally_unit_data = dict()
-    amon_unit_data = dict()
+    @staticmethod
+    def _copy(unit_data):
+        return {unit: dict(value) if isinstance(value, dict) else value for unit, value in unit_data.items()}
 
-    for r in ReplayData:
-        _add_units_amon(amon_unit_data, r)
-        for p in (1, 2):
-            if r.players[p]['handle'] in main_handles:
-                _add_units(main_unit_data, r, p)
-            else:
-                _add_units(ally_unit_data, r, p)
+    @catch_exceptions(logger)
+    def result(self):
+        for kind in ('main', 'ally'):
+            unit_data = getattr(self, kind)
+            changed = {commander: self._copy(unit_data[commander]) for commander in self.changed[kind]}
+            _process_dict(changed)
+            self.processed[kind].update(changed)
+            self.changed[kind] = set()
+
+        if self.amon_changed:
+            self.processed['amon'] = _process_dict_amon(self._copy(self.amon))
+            self.amon_changed = False
+
+        return {
+            'main': {commander: self.processed['main'][commander] for commander in self.main},
+            'ally': {commander: self.processed['ally'][commander] for commander in self.ally},
+            'amon': self.processed['amon']
+        }
 
-    _process_dict(main_unit_data)
-    _process_dict(ally_unit_data)
-    amon_unit_data = _process_dict_amon(amon_unit_data)
 
-    return {'main': main_unit_data, 'ally': ally_unit_data, 'amon': amon_unit_data}
+@catch_exceptions(logger)
+def calculate_unit_stats(ReplayData, main_handles):
+    """ Calculates stats for each unit type for player, allies and Amon.
+    This includes number of kills, created and lost for all unit types and sum"""
+    return UnitStats(main_handles, ReplayData).result()
 
 
 def calculate_words(ReplayData):
@@ -622,6 +728,92 @@ def calculate_words(ReplayData):
     return {k: v for k, v in sorted(words.items(), key=lambda x: x[1], reverse=True)}
 
 
+class ReplayStats:
+    """ All stats shown in the stats tab. Each stat is kept as an accumulator, so replays accepted by filters
+    can be added one by one without going over previous replays again."""
+    def __init__(self, main_handles):
+        self.games = 0
+        self.difficulty = DifficultyStats()
+        self.maps = MapStats()
+        self.commanders = CommanderStats(main_handles)
+        self.regions = RegionStats(main_handles)
+        self.units = UnitStats(main_handles)
+
+    @catch_exceptions(logger)
+    def add(self, r):
+        self.games += 1
+        for stats in (self.difficulty, self.maps, self.commanders, self.regions, self.units):
+            stats.add(r)
+
+    def result(self, unit_data=True):
+        CommanderData, AllyCommanderData = self.commanders.result()
+        return {
+            'UnitData': self.units.result() if unit_data else None,
+            'RegionData': self.regions.result(),
+            'DifficultyData': self.difficulty.result(),
+            'MapData': self.maps.result(),
+            'CommanderData': CommanderData,
+            'AllyCommanderData': AllyCommanderData,
+            'games': self.games
+        }
+
+
+class ReplayColumns:
+    """ Precomputed columns of replay data for fast filtering in `analyse_replays`.
+    Columns are aligned with `ReplayDataAll` of the analysis. Dates are integers, categorical
+    values (difficulty, region) are stored as codes, and main player flags are computed once."""
+    def __init__(self, analysis):
+        self.analysis = analysis
+        self.main_handles = set(analysis.main_handles)
+        self.files = list()
+        self.dates = array('q')
+        self.lengths = array('d')
+        self.extension = array('b')
+        self.victory = array('b')
+        self.brutal_plus = array('q')
+        self.sub_15 = array('b')
+        self.both_main = array('b')
+        self.names = list()
+        self.difficulty = array('L')
+        self.difficulties = list()  # Difficulty values for codes
+        self.region = array('L')
+        self.regions = list()  # Region values for codes
+        self._codes = {'difficulty': dict(), 'region': dict()}
+
+        for r in analysis.ReplayDataAll:
+            self.append(r)
+
+    def _code(self, kind, value, values):
+        codes = self._codes[kind]
+        if value not in codes:
+            codes[value] = len(values)
+            values.append(value)
+        return codes[value]
+
+    def _row(self, r):
+        return (r.file, int(r.date.replace(':', '')), r.accurate_length, r.extension, r.result == 'Victory', r.brutal_plus,
+                self.analysis.main_player_is_sub_15(r), bool(self.analysis.both_main_players(r)),
+                {p["name"].lower() for p in r.players if "name" in p}, self._code('difficulty', r.difficulty, self.difficulties),
+                self._code('region', r.region, self.regions))
+
+    def append(self, r):
+        """ Adds a replay to the end """
+        for column, value in zip(self._columns(), self._row(r)):
+            column.append(value)
+
+    def set(self, i, r):
+        """ Replaces replay at position `i` """
+        for column, value in zip(self._columns(), self._row(r)):
+            column[i] = value
+
+    def _columns(self):
+        return (self.files, self.dates, self.lengths, self.extension, self.victory, self.brutal_plus, self.sub_15, self.both_main, self.names,
+                self.difficulty, self.region)
+
+    def __len__(self):
+        return len(self.files)
+
+
 class mass_replay_analysis:
     """ Class for mass replay analysis"""
     def __init__(self, ACCOUNTDIR):
@@ -633,7 +825,19 @@ class mass_replay_analysis:
         self.parsed_replays = set()
         self.ReplayData = list()
         self.ReplayDataAll = list()
-        self.cachefile = truePath('cache_overall_stats')
+        self.hash_index = dict()  # hash: index in ReplayDataAll
+        self.columns = None  # ReplayColumns for filtering, created when needed
+        self.show_all = False
+        self.stats = None  # ReplayStats for the last filters
+        self.stats_columns = None  # ReplayColumns the stats were calculated from
+        self.stats_filters = None
+        self.stats_size = 0  # Number of replays (positions) in ReplayDataAll that went through filters
+        self.map_lengths = dict()  # map name: sorted list of accurate lengths
+        self.cachefile = truePath('cache_overall_stats')  # Old pickled cache, only used for migration
+        self.store = ReplayStore(truePath('cache_replays'))
+        self.unsaved_hashes = set()  # Replays added or changed since the last save
+        self.removed_hashes = set()  # Replays removed since the last save
+        self.rewrite_cache = False  # Whether the whole cache has to be written on the next save
         self.winrate_data = dict()
         self.current_replays = find_replays(ACCOUNTDIR)
         self.closing = False
@@ -673,82 +877,122 @@ class mass_replay_analysis:
 
         return sorted(replays, key=lambda x: int(getattr(x, 'date').replace(':', '')), reverse=True)
 
+    def rebuild_indexes(self):
+        """ Rebuilds hash and map length indexes from `self.ReplayDataAll` """
+        self.columns = None
+        self.hash_index = dict()
+        self.map_lengths = dict()
+        for i, r in enumerate(self.ReplayDataAll):
+            self.hash_index.setdefault(r.hash, i)
+            self.map_lengths.setdefault(r.map_name, list()).append(r.accurate_length)
+
+        for lengths in self.map_lengths.values():
+            lengths.sort()
+
+    def index_replay(self, i, r):
+        """ Adds replay at position `i` to indexes """
+        if self.columns is not None:
+            if i == len(self.columns):
+                self.columns.append(r)
+            else:
+                self.columns.set(i, r)
+        self.hash_index.setdefault(r.hash, i)
+        bisect.insort(self.map_lengths.setdefault(r.map_name, list()), r.accurate_length)
+
+    def unindex_replay(self, r):
+        """ Removes replay's length from the map index """
+        lengths = self.map_lengths.get(r.map_name, list())
+        idx = bisect.bisect_left(lengths, r.accurate_length)
+        if idx < len(lengths) and lengths[idx] == r.accurate_length:
+            del lengths[idx]
+
+    def replace_replay(self, i, r):
+        """ Replaces replay at position `i` and updates indexes """
+        old = self.ReplayDataAll[i]
+        self.stats = None  # Stats can't remove replays, they have to be calculated again
+        self.unsaved_hashes.add(r.hash)
+        self.unindex_replay(old)
+        self.ReplayDataAll[i] = r
+        if old.hash != r.hash and self.hash_index.get(old.hash) == i:
+            del self.hash_index[old.hash]
+        self.index_replay(i, r)
+
     def get_data_for_overlay(self, rhash):
         """ Looks if we have data to show for overlay.
             If not returns None"""
-        for r in self.ReplayDataAll:
-            if r.hash == rhash:
-                if r.full_analysis:
-                    new = r._asdict()
-                    new['replaydata'] = True
-
-                    main, ally = 1, 2
-                    if r.players[2]['handle'] in self.main_handles:
-                        main, ally = 2, 1
-
-                    new['main'] = r.players[main]['name']
-                    new['mainAPM'] = r.players[main]['apm']
-                    new['mainCommander'] = r.players[main]['commander']
-                    new['mainCommanderLevel'] = r.players[main]['commander_level']
-                    new['mainIcons'] = r.players[main]['icons']
-                    new['mainMasteries'] = r.players[main]['masteries']
-                    if r.players[main]['prestige'] != 0:
-                        new['mainPrestige'] = prestige_names.get(r.players[main]['commander'], {}).get(r.players[main]['prestige'])
-                    else:
-                        new['mainPrestige'] = ''
-                    new['mainUnits'] = r.players[main]['units']
-                    new['mainkills'] = r.players[main]['kills']
-
-                    new['ally'] = r.players[ally]['name']
-                    new['allyAPM'] = r.players[ally]['apm']
-                    new['allyCommander'] = r.players[ally]['commander']
-                    new['allyCommanderLevel'] = r.players[ally]['commander_level']
-                    new['allyIcons'] = r.players[ally]['icons']
-                    new['allyMasteries'] = r.players[ally]['masteries']
-                    if r.players[ally]['prestige'] != 0:
-                        new['allyPrestige'] = prestige_names.get(r.players[ally]['commander'], {}).get(r.players[ally]['prestige'])
-                    else:
-                        new['allyPrestige'] = ''
-                    new['allyUnits'] = r.players[ally]['units']
-                    new['allykills'] = r.players[ally]['kills']
-
-                    #Charts
-                    new['player_stats'] = r.player_stats
-
-                    # Difficulty
-                    new['B+'] = r.brutal_plus
-                    diff_1 = new['difficulty'][0]
-                    diff_2 = new['difficulty'][1]
-                    if diff_1 == diff_2:
-                        new['difficulty'] = diff_1
-                    elif main == 1:
-                        new['difficulty'] = f'{diff_1}/{diff_2}'
-                    else:
-                        new['difficulty'] = f'{diff_2}/{diff_1}'
-
-                    # Other
-                    new['length'] = new['accurate_length'] / 1.4
-                    del new['players']
-
-                    return new
-                else:
-                    return None
-        return None
+        with lock:
+            i = self.hash_index.get(rhash)
+            if i is None or not self.ReplayDataAll[i].full_analysis:
+                return None
+            r = self.ReplayDataAll[i]
+
+        r = materialize(r)
+        new = r._asdict()
+        new['replaydata'] = True
+
+        main, ally = 1, 2
+        if r.players[2]['handle'] in self.main_handles:
+            main, ally = 2, 1
+
+        new['main'] = r.players[main]['name']
+        new['mainAPM'] = r.players[main]['apm']
+        new['mainCommander'] = r.players[main]['commander']
+        new['mainCommanderLevel'] = r.players[main]['commander_level']
+        new['mainIcons'] = r.players[main]['icons']
+        new['mainMasteries'] = r.players[main]['masteries']
+        if r.players[main]['prestige'] != 0:
+            new['mainPrestige'] = prestige_names.get(r.players[main]['commander'], {}).get(r.players[main]['prestige'])
+        else:
+            new['mainPrestige'] = ''
+        new['mainUnits'] = r.players[main]['units']
+        new['mainkills'] = r.players[main]['kills']
+
+        new['ally'] = r.players[ally]['name']
+        new['allyAPM'] = r.players[ally]['apm']
+        new['allyCommander'] = r.players[ally]['commander']
+        new['allyCommanderLevel'] = r.players[ally]['commander_level']
+        new['allyIcons'] = r.players[ally]['icons']
+        new['allyMasteries'] = r.players[ally]['masteries']
+        if r.players[ally]['prestige'] != 0:
+            new['allyPrestige'] = prestige_names.get(r.players[ally]['commander'], {}).get(r.players[ally]['prestige'])
+        else:
+            new['allyPrestige'] = ''
+        new['allyUnits'] = r.players[ally]['units']
+        new['allykills'] = r.players[ally]['kills']
+
+        #Charts
+        new['player_stats'] = r.player_stats
+
+        # Difficulty
+        new['B+'] = r.brutal_plus
+        diff_1 = new['difficulty'][0]
+        diff_2 = new['difficulty'][1]
+        if diff_1 == diff_2:
+            new['difficulty'] = diff_1
+        elif main == 1:
+            new['difficulty'] = f'{diff_1}/{diff_2}'
+        else:
+            new['difficulty'] = f'{diff_2}/{diff_1}'
+
+        # Other
+        new['length'] = new['accurate_length'] / 1.4
+        del new['players']
+
+        return new
 
     def load_cache(self):
         """ Try to load previously parsed replays """
         try:
-            if os.path.isfile(self.cachefile):
-                with open(self.cachefile, 'rb') as f:
-                    loaded = pickle.load(f)
-                if len(loaded) > 0 and type(loaded[0]) == replay_data:
-                    self.ReplayDataAll = loaded
-                elif len(loaded) > 0:
-                    logger.error(f"Cache not loaded. Old data type.")
-
-                self.parsed_replays = {r.hash for r in self.ReplayDataAll}
+            if self.store.exists():
+                self.ReplayDataAll = self.store.load()
+            elif os.path.isfile(self.cachefile):
+                self.ReplayDataAll = self.store.migrate(self.cachefile)
+
+            self.parsed_replays = {r.hash for r in self.ReplayDataAll}
+            self.rebuild_indexes()
         except Exception:
             logger.error(traceback.format_exc())
+            self.rewrite_cache = True
 
     def add_replays(self, replays, progress_callback=None):
         """ Parses and adds new replays. Doesn't parse already parsed replays. """
@@ -757,29 +1001,32 @@ class mass_replay_analysis:
         out = list()
         new_hashes = set()
         new_files = set()
-        pool = ProcessPoolExecutor()
-        results = []
 
-        # Submit parsing jobs for replays
+        # Find replays that weren't parsed yet
+        pending = list()
         for r in replays:
             rhash = get_hash(r)
             if not rhash in self.parsed_replays:
-                results.append((rhash, r, pool.submit(guarded_parse_replay_file, r, parse_events=False, onlyBlizzard=True,
-                                                      withoutRecoverEnabled=True)))
-
-        # Go over results
-        for idx, (rhash, r, future) in enumerate(results):
+                pending.append((rhash, r))
+
+        # Parse replays. Jobs are submitted gradually and results come in the order they finish.
+        jobs = ((idx, (r, ), {
+            'parse_events': False,
+            'onlyBlizzard': True,
+            'withoutRecoverEnabled': True,
+            'cache_hash': rhash
+        }) for idx, (rhash, r) in enumerate(pending))
+        results = worker_pool.stream(guarded_parse_replay_file, jobs, priority=LOW)
+
+        for done, (idx, replay) in enumerate(results, 1):
             # Interrupt the analysis if the app is closing
             if self.closing:
-                for (_, _, f) in results:
-                    f.cancel()
-                pool.shutdown(True)
+                results.close()
                 break
 
-            # Wait for the result
-            replay = future.result()
+            rhash, r = pending[idx]
             if progress_callback is not None:
-                progress_callback.emit((idx, len(results)))
+                progress_callback.emit((done, len(pending)))
 
             # Manage exceptions
             if isinstance(replay, Exception):
@@ -789,19 +1036,21 @@ class mass_replay_analysis:
 
             if replay is not None:
                 replay['hash'] = rhash
-                self.remove_useless_keys(replay)
+                remove_useless_keys(replay)
                 replay = replay_data(**replay)
                 if self.replay_entry_valid(replay):
-                    out.append(replay)
+                    out.append((idx, replay))
             new_hashes.add(rhash)
             new_files.add(r)
 
-        pool.shutdown(True)
-        out += self.ReplayDataAll
-        out = [r for r in out if r is not None]
+        # Keep the order in which replays were found
+        out.sort(key=lambda x: x[0])
+        out = [r for _, r in out]
 
         with lock:
-            self.ReplayDataAll = out
+            self.unsaved_hashes.update(r.hash for r in out)
+            self.ReplayDataAll = out + self.ReplayDataAll
+            self.rebuild_indexes()
             self.parsed_replays = self.parsed_replays.union(new_hashes)
             self.current_replays = self.current_replays.union(new_files)
             self.update_data()
@@ -817,6 +1066,8 @@ class mass_replay_analysis:
         self.parsed_replays = set()
         self.ReplayData = list()
         self.ReplayDataAll = list()
+        self.rebuild_indexes()
+        self.rewrite_cache = True
         self.winrate_data = dict()
         self.full_analysis_finished = False
         self.add_replays(self.current_replays)
@@ -845,18 +1096,21 @@ class mass_replay_analysis:
         if (parsed_data is not None and len(parsed_data) > 1 and not '[MM]' in parsed_data['file'] and parsed_data['isBlizzard']
                 and len(parsed_data['players']) > 2 and parsed_data['players'][1].get('commander') is not None):
 
-            formatted_data = self.format_data(input_data)
+            formatted_data = format_data(input_data)
             if not self.replay_entry_valid(formatted_data):
                 return None
 
-            # Remove replay if it was already there:
-            for i, r in enumerate(self.ReplayDataAll):
-                if r.hash == formatted_data.hash:
-                    del self.ReplayDataAll[i]
-                    break
-
             with lock:
-                self.ReplayDataAll.append(formatted_data)
+                # Remove replay if it was already there. That shifts positions, so all indexes are rebuilt.
+                i = self.hash_index.get(formatted_data.hash)
+                self.unsaved_hashes.add(formatted_data.hash)
+                if i is not None:
+                    del self.ReplayDataAll[i]
+                    self.ReplayDataAll.append(formatted_data)
+                    self.rebuild_indexes()
+                else:
+                    self.ReplayDataAll.append(formatted_data)
+                    self.index_replay(len(self.ReplayDataAll) - 1, formatted_data)
                 self.parsed_replays.add(formatted_data.hash)
                 self.current_replays.add(formatted_data.file)
                 self.update_data()
@@ -864,33 +1118,29 @@ class mass_replay_analysis:
         return formatted_data
 
     @catch_exceptions(logger)
-    def format_data(self, full_data):
-        """ Formats data returned by replay analysis into a single datastructure used here"""
-        parsed_data = full_data['parser']
-        parsed_data['accurate_length'] = full_data['length'] * 1.4
-        parsed_data['bonus'] = full_data['bonus']
-        parsed_data['comp'] = full_data['comp']
-        parsed_data['full_analysis'] = True
-        parsed_data['hash'] = parsed_data.get('hash', get_hash(full_data['file']))
-        parsed_data['amon_units'] = full_data['amon_units']
-        parsed_data['player_stats'] = full_data['player_stats']
-        self.remove_useless_keys(parsed_data)
-        parsed_data['players'] = tuple(parsed_data['players'][:3])
-        main = full_data['positions']['main']
-        for p in (1, 2):
-            parsed_data['players'][p]['kills'] = full_data['mainkills'] if p == main else full_data['allykills']
-            parsed_data['players'][p]['icons'] = full_data['mainIcons'] if p == main else full_data['allyIcons']
-            parsed_data['players'][p]['units'] = full_data['mainUnits'] if p == main else full_data['allyUnits']
-        return replay_data(**parsed_data)
+    def save_cache(self):
+        """ Saves cache. Only replays changed since the last save are appended, unless the cache needs compaction. """
+        with lock:
+            if self.rewrite_cache or not self.store.exists() or self.store.needs_compaction(len(self.ReplayDataAll)):
+                self.store.write(self.ReplayDataAll)
+            else:
+                # Appended replays replace all stored replays with the same hash, so all replays with changed hashes are saved
+                changed_hashes = self.unsaved_hashes | self.removed_hashes
+                changed = [r for r in self.ReplayDataAll if r.hash in changed_hashes]
+                removed = [h for h in self.removed_hashes if h not in self.hash_index]
+                self.store.append(changed, removed)
+
+            self.unsaved_hashes = set()
+            self.removed_hashes = set()
+            self.rewrite_cache = False
+        hash_index.save()
 
     @catch_exceptions(logger)
-    def save_cache(self):
-        """ Saves cache """
-        temp_file = f"{self.cachefile}_temp"
+    def prune_event_cache(self):
+        """ Removes decoded events of replays that are gone and keeps the event cache within its size limit """
         with lock:
-            with open(temp_file, 'wb') as f:
-                pickle.dump(self.ReplayDataAll, f, protocol=pickle.HIGHEST_PROTOCOL)
-            os.replace(temp_file, self.cachefile)
+            cached_hashes = set(self.hash_index)
+        EC.prune(cached_hashes, max_size=SM.settings['event_cache_size'] * 1024**3)
 
     def dump_all(self):
         """ Dumps all data to a json file """
@@ -906,7 +1156,7 @@ class mass_replay_analysis:
 
         # Go through current replays, get file hashes, see if they are added
         for r in self.ReplayDataAll:
-            data[r.hash] = r._asdict()
+            data[r.hash] = materialize(r)._asdict()
 
         # Save file again
         with open(file_name, 'w') as f:
@@ -920,6 +1170,8 @@ class mass_replay_analysis:
 
         self.main_names = names
         self.main_handles = handles
+        self.columns = None
+        self.stats = None
         self.add_replays(replays)
         self.current_replays = replays
         self.update_data()
@@ -928,6 +1180,7 @@ class mass_replay_analysis:
 
     def update_data(self, showAll=False):
         """ Updates current data """
+        self.show_all = showAll
         if showAll:
             self.ReplayData = self.ReplayDataAll
         else:
@@ -946,7 +1199,10 @@ class mass_replay_analysis:
 
         # Remove them for the list
         for i in to_remove:
-            self.ReplayDataAll.pop(i)
+            self.removed_hashes.add(self.ReplayDataAll.pop(i).hash)
+
+        if len(to_remove) > 0:
+            self.rebuild_indexes()
 
     @catch_exceptions(logger)
     def initialize(self, progress_callback=None):
@@ -974,14 +1230,6 @@ class mass_replay_analysis:
         """ Returns an ordered list of last `number` replays from the newest to the oldest. """
         return sorted(self.ReplayData, key=lambda x: int(getattr(x, 'date').replace(':', '')), reverse=True)[:number]
 
-    @staticmethod
-    def remove_useless_keys(pdict):
-        """ Removes keys from the dictionary that are no longer useful"""
-        to_remove = ('start_time', 'end_time', 'isBlizzard', 'last_deselect_event')
-        for k in to_remove:
-            if k in pdict:
-                del pdict[k]
-
     def run_full_analysis(self, progress_callback):
         """ Run full analysis on all replays """
         self.closing = False
@@ -994,6 +1242,7 @@ class mass_replay_analysis:
 
         if fully_parsed == len(self.ReplayDataAll):
             self.full_analysis_finished = True
+            self.prune_event_cache()
             progress_callback.emit((len(self.ReplayDataAll), len(self.ReplayDataAll),
                                     f'Full analysis completed! {len(self.ReplayDataAll)}/{len(self.ReplayDataAll)} | 100%'))
             return True
@@ -1004,21 +1253,20 @@ class mass_replay_analysis:
 
         # Start
         logger.info('Starting full analysis!')
-        pool = ProcessPoolExecutor()
-        results = []
         start = time.time()
         idx = 0
         eta = '?'
-        for i, r in enumerate(self.ReplayDataAll):
-            if not os.path.isfile(r.file):
-                continue
 
-            # Submit parsing jobs for replays that weren't fully analyzed yet
-            if not r.full_analysis:
-                filepath = r.file
-                results.append((i, filepath, pool.submit(guarded_parse_replay_file, filepath, return_events=True)))
+        # Replays that weren't fully analyzed yet
+        pending = [(r.hash, r.file) for r in self.ReplayDataAll if not r.full_analysis and os.path.isfile(r.file)]
+
+        # Jobs are submitted gradually and results come in the order they finish (already analysed and formatted in workers)
+        jobs = ((job, (filepath, rhash, self.main_handles), {}) for job, (rhash, filepath) in enumerate(pending))
+        results = worker_pool.stream(guarded_full_analysis, jobs, priority=LOW)
+
+        for job, formated in results:
+            rhash, filepath = pending[job]
 
-        for (i, filepath, future) in results:
             # Save cache every now and then
             if idx >= 50:
                 idx = 0
@@ -1026,27 +1274,18 @@ class mass_replay_analysis:
 
             # Interrupt the analysis if the app is closing
             if self.closing:
-                for (_, _, f) in results:
-                    f.cancel()
-                pool.shutdown(True)
+                results.close()
                 self.save_cache()
                 return False
 
-            # Wait for the result
-            replay = future.result()
-
             # Propagate exceptions
-            if isinstance(replay, Exception):
-                e = replay
+            if isinstance(formated, Exception):
+                e = formated
                 logger.error(f'Parsing error ({filepath})\n{traceback.format_exception(type(e), e, e.__traceback__)}')
                 continue
+            if formated is None:
+                continue
             try:
-                # Finish analyzing replays
-                full_data = analyse_parsed_replay(filepath, replay, self.main_handles)
-                full_data['full_analysis'] = True
-                if len(full_data) < 2:
-                    continue
-
                 # Update counters
                 idx += 1
                 fully_parsed += 1
@@ -1059,9 +1298,10 @@ class mass_replay_analysis:
                 # Update widget
                 with lock:
                     try:
-                        formated = self.format_data(full_data)
-                        if self.replay_entry_valid(formated):
-                            self.ReplayDataAll[i] = formated
+                        # Replays might have moved since the job was submitted, find the current position
+                        i = self.hash_index.get(rhash)
+                        if i is not None and self.replay_entry_valid(formated):
+                            self.replace_replay(i, formated)
                     except Exception:
                         logger.error(traceback.format_exc())
 
@@ -1078,11 +1318,11 @@ class mass_replay_analysis:
 
         if idx > 0:
             self.save_cache()
-        pool.shutdown(True)
         progress_callback.emit((len(self.ReplayDataAll), len(self.ReplayDataAll),
                                 f'Full analysis completed! {len(self.ReplayDataAll)}/{len(self.ReplayDataAll)} | 100%'))
         logger.info(f'Full analysis completed in {time.time()-start:.0f} seconds!')
         self.full_analysis_finished = True
+        self.prune_event_cache()
         return True
 
     def main_player_is_sub_15(self, replay):
@@ -1185,26 +1425,73 @@ class mass_replay_analysis:
         if input_data['result'] != 'Victory':
             return False
 
-        for r in self.ReplayDataAll:
-            if r.map_name == name and r.accurate_length <= length:
-                fastest = False
-                break
+        # Lengths are sorted, so only the shortest one has to be checked
+        lengths = self.map_lengths.get(name)
+        if lengths and lengths[0] <= length:
+            fastest = False
         return fastest
 
-    def analyse_replays(self,
-                        include_mutations=True,
-                        include_normal_games=True,
-                        mindate=None,
-                        maxdate=None,
-                        minlength=None,
-                        maxLength=None,
-                        difficulty_filter=None,
-                        region_filter=None,
-                        sub_15=True,
-                        over_15=True,
-                        include_both_main=True,
-                        player=None,
-                        winsonly=False):
+    def select_replays(self,
+                       positions,
+                       include_mutations=True,
+                       include_normal_games=True,
+                       mindate=None,
+                       maxdate=None,
+                       minlength=None,
+                       maxLength=None,
+                       difficulty_filter=None,
+                       region_filter=None,
+                       sub_15=True,
+                       over_15=True,
+                       include_both_main=True,
+                       player=None,
+                       winsonly=False):
+        """ Returns positions in ReplayDataAll (from `positions`) of replays that pass filters. See `analyse_replays` for arguments.
+        Has to be called with the lock acquired and `self.columns` created. """
+        c = self.columns
+
+        # Lookup tables for difficulty and region codes
+        filter_difficulty = difficulty_filter is not None and len(difficulty_filter) > 0
+        if filter_difficulty:
+            # Difficulty codes to filter away (don't filter out B+ if filtering out "Brutal")
+            removed = [any(isinstance(d, str) and d in value for d in difficulty_filter) for value in c.difficulties]
+            removed_bplus = {d for d in difficulty_filter if isinstance(d, int)}
+
+        filter_region = region_filter is not None and len(region_filter) > 0
+        if filter_region:
+            allowed = [not value in region_filter and value in {'NA', 'EU', 'KR', 'CN'} for value in c.regions]
+
+        min_seconds = minlength * 60 if minlength is not None else None
+        max_seconds = maxLength * 60 if maxLength is not None else None
+
+        # All filters are checked in a single pass over positions
+        files, extension, dates, lengths, victory = c.files, c.extension, c.dates, c.lengths, c.victory
+        current_replays = None if self.show_all else self.current_replays
+        selected = list()
+        for i in positions:
+            if current_replays is not None and not files[i] in current_replays:
+                continue
+            if (not include_mutations and extension[i]) or (not include_normal_games and not extension[i]):
+                continue
+            if (mindate is not None and not dates[i] > mindate) or (maxdate is not None and not dates[i] < maxdate):
+                continue
+            if (min_seconds is not None and not lengths[i] >= min_seconds) or (max_seconds is not None and not lengths[i] <= max_seconds):
+                continue
+            if filter_difficulty and ((removed[c.difficulty[i]] and c.brutal_plus[i] <= 0) or c.brutal_plus[i] in removed_bplus):
+                continue
+            if filter_region and not allowed[c.region[i]]:
+                continue
+            if (not sub_15 and c.sub_15[i]) or (not over_15 and not c.sub_15[i]) or (not include_both_main and c.both_main[i]):
+                continue
+            if player is not None and not fnmatch.filter(c.names[i], player):
+                continue
+            if winsonly == True and not victory[i]:
+                continue
+            selected.append(i)
+
+        return selected
+
+    def analyse_replays(self, **filters):
         """ Filters and analyses replays replay data
         `mindate` and `maxdate` has to be in a format of a long integer YYYYMMDDHHMMSS 
         `minLength` and `maxLength` in minutes 
@@ -1213,74 +1500,33 @@ class mass_replay_analysis:
         `sub_15` = False if you want to filter out games where the main player was sub-15 commander level
         `over_15` = False if you want to exclude games where the main player is 15+
         `include_both_main` = False to exclude games where both players are main players
+        `include_mutations`, `include_normal_games`, `player` (name pattern) and `winsonly` filter games as well
+
+        Stats are kept between calls. If filters didn't change, only replays added since the last call are analysed.
         """
         start = time.time()
-        data = self.ReplayData
-
-        if not include_mutations:
-            data = [r for r in data if not r.extension]
-
-        if not include_normal_games:
-            data = [r for r in data if r.extension]
-
-        if mindate is not None:
-            data = [r for r in data if int(r.date.replace(':', '')) > mindate]
-
-        if maxdate is not None:
-            data = [r for r in data if int(r.date.replace(':', '')) < maxdate]
-
-        if minlength is not None:
-            data = [r for r in data if r.accurate_length >= minlength * 60]
-
-        if maxLength is not None:
-            data = [r for r in data if r.accurate_length <= maxLength * 60]
-
-        if difficulty_filter is not None and len(difficulty_filter) > 0:
-            logger.info(f'{difficulty_filter=}')
-            for difficulty in difficulty_filter:
-                if isinstance(difficulty, str):
-                    data = [r for r in data if not difficulty in r.difficulty or r.brutal_plus > 0]  # Don't filter out B+ if filtering out "Brutal"
-
-                elif isinstance(difficulty, int):
-                    data = [r for r in data if not difficulty == r.brutal_plus]
-
-        if region_filter is not None and len(region_filter) > 0:
-            logger.info(f'{region_filter=}')
-            data = [r for r in data if not r.region in region_filter and r.region in {'NA', 'EU', 'KR', 'CN'}]
-
-        if not sub_15:
-            data = [r for r in data if not self.main_player_is_sub_15(r)]
-
-        if not over_15:
-            data = [r for r in data if self.main_player_is_sub_15(r)]
-
-        if not include_both_main:
-            data = [r for r in data if not self.both_main_players(r)]
-
-        if player is not None:
-            data = [r for r in data if fnmatch.filter({p["name"].lower() for p in r.players if "name" in p}, player)]
-
-        if winsonly == True:
-            data = [r for r in data if r.result == 'Victory']
-
-        # Analyse
-        DifficultyData = calculate_difficulty_data(data)
-        MapData = calculate_map_data(data)
-        CommanderData, AllyCommanderData = calculate_commander_data(data, self.main_handles)
-        RegionData = calculate_region_data(data, self.main_handles)
-        UnitData = None if not self.full_analysis_finished else calculate_unit_stats(data, self.main_handles)
-
-        logger.info(f'Filtering {len(self.ReplayData)} -> {len(data)} ({time.time() - start:.5f} seconds)')
-
-        return {
-            'UnitData': UnitData,
-            'RegionData': RegionData,
-            'DifficultyData': DifficultyData,
-            'MapData': MapData,
-            'CommanderData': CommanderData,
-            'AllyCommanderData': AllyCommanderData,
-            'games': len(data)
-        }
+        logger.info(f'{filters=}')
+        with lock:
+            if self.columns is None or self.columns.main_handles != set(self.main_handles):
+                self.columns = ReplayColumns(self)
+            c = self.columns
+
+            # Recalculate everything if filters or replays changed, otherwise add only new replays
+            if self.stats is None or self.stats_columns is not c or self.stats_filters != (self.show_all, filters):
+                self.stats = ReplayStats(self.main_handles)
+                self.stats_columns = c
+                self.stats_filters = (self.show_all, filters)
+                self.stats_size = 0
+
+            new_replays = len(c) - self.stats_size
+            for i in self.select_replays(range(self.stats_size, len(c)), **filters):
+                self.stats.add(self.ReplayDataAll[i])
+            self.stats_size = len(c)
+
+            analysis = self.stats.result(unit_data=self.full_analysis_finished)
+
+        logger.info(f'Filtering {new_replays} -> {analysis["games"]} games total ({time.time() - start:.5f} seconds)')
+        return analysis
 
 
 def mass_replay_analysis_thread(ACCOUNTDIR, progress_callback=None):
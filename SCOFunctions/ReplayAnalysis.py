@@ -10,13 +10,15 @@ import traceback
 from pprint import pprint
 
 from SCOFunctions.MLogging import logclass
-from SCOFunctions.S2Parser import s2_parse_replay
+from SCOFunctions.S2Parser import s2_parse_replay, wait_for_replay_file
 from SCOFunctions.StatsCounter import StatsCounter, DroneIdentifier
-from SCOFunctions.SC2Dictionaries import UnitNameDict, UnitAddKillsTo, UnitCompDict, UnitsInWaves, COMasteryUpgrades, HFTS_Units, TUS_Units, prestige_upgrades, amon_player_ids
+from SCOFunctions.SC2Dictionaries import UnitCompDict, HFTS_Units, TUS_Units, mastery_upgrade_index, prestige_upgrade_index
+from SCOFunctions.MMapRules import get_map_rules
+from SCOFunctions.MUnitTypes import unit_types
+from SCOFunctions.MUnitTable import (UnitTable, unitid, MURVAR_SPAWN, GLEVIG_SPAWN, BROODLORD_BROODLING, MIND_CONTROLLED, DEHAKA_DRAG, ZAGARA_DUMMY_ZERGLING,
+                                     BIOMASS_LOCUST)
 
-do_not_count_kills = {'FuelCellPickupUnit', 'ForceField', 'Scarab'}
 duplicating_units = {'HotSRaptor', 'MutatorAmonArtanis', 'HellbatBlackOps', 'LurkerStetmannBurrowed'}
-skip_strings = ('placement', 'placeholder', 'dummy', 'cocoon', 'droppod', "colonist hut", "bio-dome", "amon's train", "warp conduit")
 revival_types = {
     'KerriganReviveCocoon': 'K5Kerrigan',
     'AlarakReviveBeacon': 'AlarakCoop',
@@ -28,6 +30,11 @@ revival_types = {
 icon_units = {'MULE', 'Omega Worm', 'Infested Bunker', 'Mecha Infestor', 'Unbound Fanatic'}
 dont_count_morphs = {'SCVMengsk', 'TrooperMengsk', 'HellionTank', 'Hellion'}  # Don't count as unit created for these when the unit switches type
 self_killing_units = {'FenixCoop', 'FenixDragoon', 'FenixArbiter'}
+analysis_events = {  # Only these events are decoded for the analysis, the rest is skipped
+    'NNet.Game.SGameUserLeaveEvent', 'NNet.Game.SCmdEvent', 'NNet.Game.SCmdUpdateTargetUnitEvent', 'NNet.Replay.Tracker.SPlayerStatsEvent',
+    'NNet.Replay.Tracker.SUpgradeEvent', 'NNet.Replay.Tracker.SUnitBornEvent', 'NNet.Replay.Tracker.SUnitInitEvent',
+    'NNet.Replay.Tracker.SUnitDiedEvent', 'NNet.Replay.Tracker.SUnitTypeChangeEvent', 'NNet.Replay.Tracker.SUnitOwnerChangeEvent'
+}
 dont_show_created_lost = {
     "Stetmann's Top Bar", "Zeratul's Top Bar", "Vorazun's Top Bar", "Fenix's Top Bar", "Zagara's Top Bar", "Tychus' Top Bar", "Swann's Top Bar",
     "Stukov's Top Bar", "Raynor's Top Bar", "Nova's Top Bar", "Mengsk's Top Bar", "Kerrigan's Top Bar", "Karax's Top Bar", "Han and Horner's Top Bar",
@@ -108,26 +115,18 @@ logger = logclass('REPA', 'INFO')
 
 
 def contains_skip_strings(pname):
-    """ Checks if any of skip strings is in the pname """
-    lowered_name = pname.lower()
-    return any(item in lowered_name for item in skip_strings)
+    """ Checks if any of skip strings is in the pname. Used for display names as well, so they aren't added to unit types. """
+    return unit_types.is_skipped(pname)
 
 
 def upgrade_is_in_mastery_upgrades(upgrade):
     """ Checks if the upgrade is in mastery upgrades, if yes, returns the Commnader and upgrade index"""
-    for co in COMasteryUpgrades:
-        if upgrade in COMasteryUpgrades[co]:
-            return co, COMasteryUpgrades[co].index(upgrade)
-    return False, 0
+    return mastery_upgrade_index.get(upgrade, (False, 0))
 
 
 def prestige_talent_name(upgrade):
     """ Checks if the upgrade is in prestige upgrades. If yes, returns Prestige name"""
-
-    for co in prestige_upgrades:
-        if upgrade in prestige_upgrades[co]:
-            return prestige_upgrades[co][upgrade]
-    return None
+    return prestige_upgrade_index.get(upgrade)
 
 
 def switch_names(pdict):
@@ -140,8 +139,9 @@ def switch_names(pdict):
             continue
 
         # For locusts, broodlings, interceptors, add kills to the main unit. Don't add unit created/lost
-        if key in UnitAddKillsTo:
-            name = UnitAddKillsTo[key]
+        unit_type = unit_types.get(key)
+        if unit_type.kills_to is not None:
+            name = unit_type.kills_to
             added = True
             if name in temp_dict:
                 temp_dict[name][2] += pdict[key][2]
@@ -159,7 +159,7 @@ def switch_names(pdict):
 
         if not added:
             # Translate names & sum up those with the same names
-            name = UnitNameDict.get(key, key)
+            name = unit_type.display_name
             if name in temp_dict:
                 for a in range(len(temp_dict[name])):
                     temp_dict[name][a] += pdict[key][a]
@@ -213,43 +213,48 @@ def get_enemy_comp(identified_waves):
     return 'Unidentified AI'
 
 
-def unitid(event, killer=False, creator=False):
-    """ Returns and unique integer as unit id.
-    `killer`=True for killer unique id, otherwise normal unit.
-    Assuming index is less than 100000 (usually it's < 1000)
-     """
-    try:
-        if killer:
-            index = event['m_killerUnitTagIndex']
-            recycleindex = event['m_killerUnitTagRecycle']
-        elif creator:
-            index = event['m_creatorUnitTagIndex']
-            recycleindex = event['m_creatorUnitTagRecycle']
-        else:
-            index = event['m_unitTagIndex']
-            recycleindex = event['m_unitTagRecycle']
-
-        if index is None or recycleindex is None:
-            return None
-
-        return recycleindex * 100000 + index
-    except Exception:
-        return None
-
-
-def parse_replay_file(filepath):
-    """ Parses a replay with S2parser"""
-    replay = None
+def parse_replay_file(filepath, rhash=None, parse_events=True):
+    """ Parses a replay with S2parser. Decoded data are cached if `rhash` is provided.
+    `parse_events=False` parses only header, details and metadata (no events are returned). """
+    # SC2 might not have finished writing into the file yet. Parse only once it's written.
+    parsed_states = set()
+    state = wait_for_replay_file(filepath)
     for attempt in range(3):
         try:
-            replay = s2_parse_replay(filepath, return_events=True)
-            break
-        except Exception:  # You can get an error here if SC2 didn't finish writing into the file. Very rare.
-            if attempt == 2:
+            if not parse_events:
+                return s2_parse_replay(filepath, parse_events=False)
+            return s2_parse_replay(filepath, return_events=True, event_filter=analysis_events, cache_hash=rhash)
+        except Exception:
+            # Try again only if the file has changed since, the same data would fail again
+            parsed_states.add(state)
+            state = wait_for_replay_file(filepath, timeout=2)
+            if attempt == 2 or state in parsed_states:
                 raise Exception(f'Parsing error! ({filepath})')
-            time.sleep(0.3)
 
-    return replay
+
+def find_main_player(replay, main_player_handles=None):
+    """ Returns player IDs of the main player and the ally """
+    main_player = 1
+    if main_player_handles is not None and len(main_player_handles) > 0:  # Check if you can find the main player
+        for player in replay['players']:
+            if player['pid'] in {1, 2} and player.get('handle') in main_player_handles:
+                main_player = player['pid']
+                break
+
+    ally_player = 1 if main_player == 2 else 2
+    return main_player, ally_player
+
+
+def format_difficulty(replay, main_player):
+    """ Returns difficulty of the replay, with main player's side first if they differ """
+    diff_1 = replay['difficulty'][0]
+    diff_2 = replay['difficulty'][1]
+    if diff_1 == diff_2:
+        return diff_1
+    elif main_player == 1:
+        return f'{diff_1}/{diff_2}'
+    else:
+        return f'{diff_2}/{diff_1}'
 
 
 def analyse_parsed_replay(filepath, replay, main_player_handles=None):
@@ -269,30 +274,12 @@ def analyse_parsed_replay(filepath, replay, main_player_handles=None):
     unit_type_dict_ally = {}
     unit_type_dict_amon = {}
 
-    # Find Amon players
-    amon_players = set()
-    amon_players.add(3)
-    amon_players.add(4)
-
-    # Add a list of amon players written for each map
-    for m in amon_player_ids:
-        if m in replay['map_name'] or ('[MM] Lnl' in replay['map_name'] and m == 'Lock & Load'):
-            amon_players = amon_players.union(amon_player_ids[m])
-            break
+    # Map-specific rules (Amon players and bonus objectives)
+    map_rules = get_map_rules(replay['map_name'])
+    amon_players = map_rules.amon_players
 
     # Find player names and numbers
-    main_player = 1
-    main_player_found = False
-
-    if main_player_handles is not None and len(main_player_handles) > 0:  # Check if you can find the main player
-        for player in replay['players']:
-            if player['pid'] in {1, 2} and not main_player_found and player.get('handle') in main_player_handles:
-                main_player = player['pid']
-                main_player_found = True
-                break
-
-    # Ally
-    ally_player = 1 if main_player == 2 else 2
+    main_player, ally_player = find_main_player(replay, main_player_handles)
 
     # Start saving data
     replay_report_dict = dict()
@@ -311,19 +298,12 @@ def analyse_parsed_replay(filepath, replay, main_player_handles=None):
     replay_report_dict['allyIcons'] = dict()
 
     # Difficulty
-    diff_1 = replay['difficulty'][0]
-    diff_2 = replay['difficulty'][1]
-    if diff_1 == diff_2:
-        replay_report_dict['difficulty'] = diff_1
-    elif main_player == 1:
-        replay_report_dict['difficulty'] = f'{diff_1}/{diff_2}'
-    else:
-        replay_report_dict['difficulty'] = f'{diff_2}/{diff_1}'
+    replay_report_dict['difficulty'] = format_difficulty(replay, main_player)
 
     logger.debug(f'Report dict: {replay_report_dict}')
 
     # Events
-    unit_dict = {}  # Data structure is {unit_id : [UnitType, Owner]}; used to track all units
+    units = UnitTable()  # Used to track all units (type, owner, flags)
     DT_HT_Ignore = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
                     0]  # Ignore certain amount of DT/HT deaths after archon is initialized. DT_HT_Ignore[player]
     killcounts = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
@@ -341,15 +321,8 @@ def analyse_parsed_replay(filepath, replay, main_player_handles=None):
     bonus_timings = list()
     ResearchVesselLandedTiming = None
     LastBiomassPosition = [0, 0, 0]
-    AbathurKillLocusts = set()
-    MutatorDehakaDragUnitIDs = set()
     MWBonusInitialTiming = [0, 0]
-    murvar_spawns = set()
-    glevig_spawns = set()
-    broodlord_broodlings = set()
     user_leave_times = dict()
-    mind_controlled_units = set()
-    zagaras_dummy_zerglings = set()
     ally_kills_counted_toward_main = 0  # Number of kills counted from ally toward main because the ally left
     VespeneDroneIdentifier = DroneIdentifier(replay['players'][main_player].get('commander', None),
                                              replay['players'][ally_player].get('commander', None))
@@ -364,8 +337,8 @@ def analyse_parsed_replay(filepath, replay, main_player_handles=None):
                                     commander=replay['players'][ally_player].get('commander', ''),
                                     drone_counter=VespeneDroneIdentifier)
 
-    def is_broodlord_broodling(unit_type, unit_id):
-        return unit_type in {'Broodling', 'BroodlingStetmann'} and unit_id in broodlord_broodlings
+    def is_broodlord_broodling(unit_type, unit_flags):
+        return unit_type in {'Broodling', 'BroodlingStetmann'} and unit_flags & BROODLORD_BROODLING != 0
 
     if '[MM]' in filepath:
         mainStatsCounter.enable_updates = True
@@ -375,560 +348,576 @@ def analyse_parsed_replay(filepath, replay, main_player_handles=None):
     for player in range(1, 16):
         last_aoe_unit_killed[player] = [None, 0] if player in amon_players else None
 
-    for event in replay['events']:
-        # Save when user leaves
-        if event['_event'] == 'NNet.Game.SGameUserLeaveEvent':
-            user = event['_userid']['m_userId'] + 1
-            user_leave_times[user] = event['_gameloop'] / 16
+    def player_stats_event(event):
+        """ Saves player stats for graphs """
+        player = event['m_playerId']
+
+        if player == main_player:
+            mainStatsCounter.add_stats(kills=killcounts[player],
+                                       supply_used=event['m_stats']['m_scoreValueFoodUsed'] / 4096,
+                                       collection_rate=sum((event['m_stats']['m_scoreValueMineralsCollectionRate'],
+                                                            event['m_stats']['m_scoreValueVespeneCollectionRate'])))
+
+        elif player == ally_player:
+            allyStatsCounter.add_stats(kills=killcounts[player],
+                                       supply_used=event['m_stats']['m_scoreValueFoodUsed'] / 4096,
+                                       collection_rate=sum((event['m_stats']['m_scoreValueMineralsCollectionRate'],
+                                                            event['m_stats']['m_scoreValueVespeneCollectionRate'])))
+
+    def upgrade_event(event):
+        """ Handles upgrades, also used as fallback for commanders, masteries and prestige talents """
+        if event['m_playerId'] not in {1, 2}:
+            return
+
+        _upg_name = event['m_upgradeTypeName'].decode()
+        _upg_pid = event['m_playerId']
+
+        # Tychus upgrades, masteries and prestige talents for army value
+        if _upg_pid == main_player:
+            mainStatsCounter.upgrade_event(_upg_name, event['m_count'])
+        elif _upg_pid == ally_player:
+            allyStatsCounter.upgrade_event(_upg_name, event['m_count'])
+
+        # Commander fallback (used for arcade maps)
+        if _upg_name in commander_upgrades:
+            commander_fallback[_upg_pid] = commander_upgrades[_upg_name]
+            VespeneDroneIdentifier.update_commanders(_upg_pid, commander_upgrades[_upg_name])
+            if _upg_pid == main_player:
+                mainStatsCounter.update_commander(commander_upgrades[_upg_name])
+            elif _upg_pid == ally_player:
+                allyStatsCounter.update_commander(commander_upgrades[_upg_name])
+
+        # Mastery upgrade fallback (used for arcade maps)
+        mas_commander, mas_index = upgrade_is_in_mastery_upgrades(_upg_name)
+        if mas_commander:
+            logger.debug(f'Player {_upg_pid} (com: {mas_commander}) got upgrade {_upg_name} (idx: {mas_index}) (count: {event["m_count"]})')
+            mastery_fallback[_upg_pid][mas_index] = event['m_count']
+
+        # Prestige talents
+        _prestige = prestige_talent_name(_upg_name)
+        if _prestige is not None:
+            PrestigeTalents[_upg_pid] = _prestige
+
+    def unit_born_event(event):
+        """ Saves a new unit and counts it as created. Returns its type. """
+        nonlocal LastBiomassPosition
+        unit_type = unit_types.decode(event['m_unitTypeName'])
+        _unit_type = unit_type.name
+        _ability_name = event.get('m_creatorAbilityName', None)
+        _ability_name = _ability_name.decode() if _ability_name is not None else None
+        unit_id = unitid(event)
+        second = event['_gameloop'] / 16
+        _control_pid = event['m_controlPlayerId']
+        units.add(unit_id, unit_type.id, _control_pid)
+
+        # Track Murvar's spawns
+        if _unit_type in {'DehakaLocust', 'DehakaCreeperFlying', 'DehakaLocustFlying', 'DehakaCreeper'}:
+            if _ability_name == 'CoopMurvarSpawnCreepers':
+                units.set_flag(unit_id, MURVAR_SPAWN)
+
+        # Track Glevig's spawns
+        if _unit_type in {'CoopDehakaGlevigEggZergling', 'CoopDehakaGlevigEggRoach', 'CoopDehakaGlevigEggHydralisk'}:
+            units.set_flag(unit_id, GLEVIG_SPAWN)
+
+        # Kerrigan's and Stetmann's Broodlings
+        if _unit_type in {'Broodling', 'BroodlingStetmann'}:
+            creator_id = unitid(event, creator=True)
+            if creator_id is not None and units.type(creator_id) in {'BroodlingEscort', 'BroodlingEscortStetmann'}:
+                units.set_flag(unit_id, BROODLORD_BROODLING)
+
+        # Certain hero units don't die, instead lets track their revival beacons/cocoons. Let's assume they will finish reviving.
+        if _unit_type in revival_types and _control_pid in [1, 2] and second > START_TIME + 1:
+            if _control_pid == main_player:
+                unit_type_dict_main[revival_types[_unit_type]][1] += 1
+                unit_type_dict_main[revival_types[_unit_type]][0] += 1
+            if _control_pid == ally_player:
+                unit_type_dict_ally[revival_types[_unit_type]][1] += 1
+                unit_type_dict_ally[revival_types[_unit_type]][0] += 1
+
+        # Primal combat fix. For every morph we are substracting two losses from the base unit type
+        if _unit_type in primal_combat_predecessors:
+            logger.debug(f'{_unit_type} substracting from {primal_combat_predecessors[_unit_type]}\n')
+            if main_player == _control_pid:
+                unit_type_dict_main[primal_combat_predecessors[_unit_type]][1] -= 2
+            if ally_player == _control_pid:
+                unit_type_dict_ally[primal_combat_predecessors[_unit_type]][1] -= 2
 
-        # Skip events after the game ended
-        if event['_gameloop'] / 16 > END_TIME:
-            continue
+        unit_flags = units.flags_of(unit_id)
+        if not (unit_flags & (GLEVIG_SPAWN | MURVAR_SPAWN) or is_broodlord_broodling(_unit_type, unit_flags)):
+            # Save stats for units created
+            if main_player == _control_pid:
+                mainStatsCounter.unit_created_event(_unit_type, event)
+                if _unit_type in unit_type_dict_main:
+                    unit_type_dict_main[_unit_type][0] += 1
+                else:
+                    unit_type_dict_main[_unit_type] = [1, 0, 0, 0]
+
+            elif ally_player == _control_pid:
+                allyStatsCounter.unit_created_event(_unit_type, event)
+                if _unit_type in unit_type_dict_ally:
+                    unit_type_dict_ally[_unit_type][0] += 1
+                else:
+                    unit_type_dict_ally[_unit_type] = [1, 0, 0, 0]
 
-        # Counting vespene drones
-        VespeneDroneIdentifier.event(event)
+            elif _control_pid in amon_players:
+                if _ability_name == 'MutatorAmonDehakaDrag':
+                    units.set_flag(unit_id, DEHAKA_DRAG)
+                elif _unit_type in unit_type_dict_amon:
+                    unit_type_dict_amon[_unit_type][0] += 1
+                else:
+                    unit_type_dict_amon[_unit_type] = [1, 0, 0, 0]
 
-        # Save player stats for graphs
-        if event['_event'] == 'NNet.Replay.Tracker.SPlayerStatsEvent':
-            player = event['m_playerId']
+        # Outlaw order
+        if _unit_type in tychus_outlaws and _control_pid in [1, 2] and not (_unit_type in outlaw_order):
+            outlaw_order.append(_unit_type)
 
-            if player == main_player:
-                mainStatsCounter.add_stats(kills=killcounts[player],
-                                           supply_used=event['m_stats']['m_scoreValueFoodUsed'] / 4096,
-                                           collection_rate=sum((event['m_stats']['m_scoreValueMineralsCollectionRate'],
-                                                                event['m_stats']['m_scoreValueVespeneCollectionRate'])))
+        # Identifying waves
+        if _control_pid in [3, 4, 5, 6] and second > START_TIME + 60 and unit_type.in_waves:
+            if wave_units['second'] == second:
+                wave_units['units'].append(_unit_type)
+            else:
+                wave_units['second'] = second
+                wave_units['units'] = [_unit_type]
 
-            elif player == ally_player:
-                allyStatsCounter.add_stats(kills=killcounts[player],
-                                           supply_used=event['m_stats']['m_scoreValueFoodUsed'] / 4096,
-                                           collection_rate=sum((event['m_stats']['m_scoreValueMineralsCollectionRate'],
-                                                                event['m_stats']['m_scoreValueVespeneCollectionRate'])))
+            if len(wave_units['units']) > 5:
+                identified_waves[second] = wave_units['units']
 
-        if event['_event'] == 'NNet.Replay.Tracker.SUpgradeEvent' and event['m_playerId'] in [1, 2]:
-            _upg_name = event['m_upgradeTypeName'].decode()
-            _upg_pid = event['m_playerId']
+        # Abathur biomass for identifying locust
+        if _unit_type == 'BiomassPickup':
+            LastBiomassPosition = [event['m_x'], event['m_y'], event['_gameloop']]
 
-            # Tychus upgrades for army value
-            if _upg_pid == main_player:
-                mainStatsCounter.upgrade_event(_upg_name)
-            elif _upg_pid == ally_player:
-                allyStatsCounter.upgrade_event(_upg_name)
-
-            # Commander fallback (used for arcade maps)
-            if _upg_name in commander_upgrades:
-                commander_fallback[_upg_pid] = commander_upgrades[_upg_name]
-                VespeneDroneIdentifier.update_commanders(_upg_pid, commander_upgrades[_upg_name])
-                if _upg_pid == main_player:
-                    mainStatsCounter.update_commander(commander_upgrades[_upg_name])
-                elif _upg_pid == ally_player:
-                    allyStatsCounter.update_commander(commander_upgrades[_upg_name])
-
-            # Mastery upgrade fallback (used for arcade maps)
-            mas_commander, mas_index = upgrade_is_in_mastery_upgrades(_upg_name)
-            if mas_commander:
-                logger.debug(f'Player {_upg_pid} (com: {mas_commander}) got upgrade {_upg_name} (idx: {mas_index}) (count: {event["m_count"]})')
-                mastery_fallback[_upg_pid][mas_index] = event['m_count']
-
-                if _upg_pid == main_player:
-                    mainStatsCounter.update_mastery(mas_index, event['m_count'])
-                elif _upg_pid == ally_player:
-                    allyStatsCounter.update_mastery(mas_index, event['m_count'])
-
-            # Prestige talents
-            _prestige = prestige_talent_name(_upg_name)
-            if _prestige is not None:
-                PrestigeTalents[_upg_pid] = _prestige
-
-                if _upg_pid == main_player:
-                    mainStatsCounter.update_prestige(_prestige)
-                elif _upg_pid == ally_player:
-                    allyStatsCounter.update_prestige(_prestige)
-
-        if event['_event'] in ('NNet.Replay.Tracker.SUnitBornEvent', 'NNet.Replay.Tracker.SUnitInitEvent'):
-            _unit_type = event['m_unitTypeName'].decode()
-            _ability_name = event.get('m_creatorAbilityName', None)
-            _ability_name = _ability_name.decode() if _ability_name is not None else None
-            unit_id = unitid(event)
-            _control_pid = event['m_controlPlayerId']
-            unit_dict[unit_id] = [_unit_type, _control_pid]
-
-            # Track Murvar's spawns
-            if _unit_type in {'DehakaLocust', 'DehakaCreeperFlying', 'DehakaLocustFlying', 'DehakaCreeper'}:
-                if event['m_creatorAbilityName'] is not None and event['m_creatorAbilityName'].decode() == 'CoopMurvarSpawnCreepers':
-                    murvar_spawns.add(unit_id)
-
-            # Track Glevig's spawns
-            if _unit_type in {'CoopDehakaGlevigEggZergling', 'CoopDehakaGlevigEggRoach', 'CoopDehakaGlevigEggHydralisk'}:
-                glevig_spawns.add(unit_id)
+        if _unit_type == 'Locust' and [event['m_x'], event['m_y'], event['_gameloop']] == LastBiomassPosition:
+            units.set_flag(unit_id, BIOMASS_LOCUST)
 
-            # Kerrigan's and Stetmann's Broodlings
-            if _unit_type in {'Broodling', 'BroodlingStetmann'} and unitid(event, creator=True) is not None:
-                creator = unit_dict[unitid(event, creator=True)][0]
-                if creator in {'BroodlingEscort', 'BroodlingEscortStetmann'}:
-                    broodlord_broodlings.add(unit_id)
-
-            # Certain hero units don't die, instead lets track their revival beacons/cocoons. Let's assume they will finish reviving.
-            if _unit_type in revival_types and _control_pid in [1, 2] and event['_gameloop'] / 16 > START_TIME + 1:
-                if _control_pid == main_player:
-                    unit_type_dict_main[revival_types[_unit_type]][1] += 1
-                    unit_type_dict_main[revival_types[_unit_type]][0] += 1
-                if _control_pid == ally_player:
-                    unit_type_dict_ally[revival_types[_unit_type]][1] += 1
-                    unit_type_dict_ally[revival_types[_unit_type]][0] += 1
-
-            # Primal combat fix. For every morph we are substracting two losses from the base unit type
-            if _unit_type in primal_combat_predecessors:
-                logger.debug(f'{_unit_type} substracting from {primal_combat_predecessors[_unit_type]}\n')
-                if main_player == _control_pid:
-                    unit_type_dict_main[primal_combat_predecessors[_unit_type]][1] -= 2
-                if ally_player == _control_pid:
-                    unit_type_dict_ally[primal_combat_predecessors[_unit_type]][1] -= 2
+        return _unit_type
+
+    def unit_init_event(event):
+        """ Same as born event, but the unit isn't finished yet (buildings, morphs) """
+        _unit_type = unit_born_event(event)
 
-            if not (unit_id in glevig_spawns or unit_id in murvar_spawns or is_broodlord_broodling(_unit_type, unit_id)):
-                # Save stats for units created
+        # In future ignore some Dark/High Templar deaths caused by Archon merge
+        if _unit_type == "Archon":
+            DT_HT_Ignore[event['m_controlPlayerId']] += 2
+
+    def unit_type_change_event(event):
+        """ Updates unit type, morphs into different units count as created """
+        nonlocal ResearchVesselLandedTiming
+        unit_id = unitid(event)
+        unit = units.get(unit_id)
+        if unit is None:
+            return
+
+        old_unit_type, _control_pid, unit_flags = unit
+        _old_unit_type = old_unit_type.name
+        unit_type = unit_types.decode(event['m_unitTypeName'])
+        _unit_type = unit_type.name
+
+        # Void Launch bonus objective. If it lands and soon-ish after takes off, the bonus is complete.
+        if _control_pid == 7 and _unit_type == 'ResearchVesselLanded':
+            ResearchVesselLandedTiming = event['_gameloop']
+
+        if _control_pid == 7 and _unit_type == 'ResearchVessel' and ResearchVesselLandedTiming is not None and (ResearchVesselLandedTiming + 1100
+                                                                                                                > event['_gameloop']):
+            bonus_timings.append(event['_gameloop'] / 16 - START_TIME)
+            ResearchVesselLandedTiming = None
+
+        # Scythe of Amon bonus objective. If it changes to WarpPrismPhasing, the bonus is completed.
+        if map_rules.warp_prism_bonus and _control_pid == 11 and _unit_type == 'WarpPrismPhasing':
+            bonus_timings.append(event['_gameloop'] / 16 - START_TIME)
+
+        # Strange. Some units morph to egg, then the morph is created, then the egg morphs back and the unit is killed
+        if _unit_type in units_killed_in_morph:
+            return
+
+        # Update unit type
+        units.set_type(unit_id, unit_type.id)
+
+        if main_player == _control_pid:
+            mainStatsCounter.unit_change_event(_unit_type, _old_unit_type)
+        elif ally_player == _control_pid:
+            allyStatsCounter.unit_change_event(_unit_type, _old_unit_type)
+
+        # Add to created units
+        if unit_type.named and old_unit_type.named:
+
+            # When banelings finish morph for zagara, it creates new zergling and kills it  (WTF)
+            if _old_unit_type == 'BanelingCocoon' and _unit_type == 'HotSSwarmling':
+                units.set_flag(unit_id, ZAGARA_DUMMY_ZERGLING)
+                return
+
+            # Don't add into created units if it's just a morph
+            # Don't count wreckages morhping back
+            # Don't count certain unit spawns (Murvar, Glevig, Broodlings from Broodlords)
+            # Don't count mengsk trooper and labourer as new unit created when they morph
+            if (unit_type.display_name != old_unit_type.display_name and not _old_unit_type in UnitAddLossesTo
+                    and not (unit_flags & (GLEVIG_SPAWN | MURVAR_SPAWN) or is_broodlord_broodling(_unit_type, unit_flags))
+                    and not _unit_type in dont_count_morphs):
+
+                # Increase unit type created for controlling player
                 if main_player == _control_pid:
-                    mainStatsCounter.unit_created_event(_unit_type, event)
                     if _unit_type in unit_type_dict_main:
                         unit_type_dict_main[_unit_type][0] += 1
                     else:
                         unit_type_dict_main[_unit_type] = [1, 0, 0, 0]
 
                 elif ally_player == _control_pid:
-                    allyStatsCounter.unit_created_event(_unit_type, event)
                     if _unit_type in unit_type_dict_ally:
                         unit_type_dict_ally[_unit_type][0] += 1
                     else:
                         unit_type_dict_ally[_unit_type] = [1, 0, 0, 0]
 
                 elif _control_pid in amon_players:
-                    if _ability_name == 'MutatorAmonDehakaDrag':
-                        MutatorDehakaDragUnitIDs.add(unitid(event))
-                    elif _unit_type in unit_type_dict_amon:
+                    if _unit_type in unit_type_dict_amon:
                         unit_type_dict_amon[_unit_type][0] += 1
                     else:
                         unit_type_dict_amon[_unit_type] = [1, 0, 0, 0]
+            else:
+                if main_player == _control_pid and not (_unit_type in unit_type_dict_main):
+                    unit_type_dict_main[_unit_type] = [0, 0, 0, 0]
 
-            # Outlaw order
-            if _unit_type in tychus_outlaws and _control_pid in [1, 2] and not (_unit_type in outlaw_order):
-                outlaw_order.append(_unit_type)
-
-            # Identifying waves
-            if _control_pid in [3, 4, 5, 6] and event['_gameloop'] / 16 > START_TIME + 60 and _unit_type in UnitsInWaves:
-                if wave_units['second'] == event['_gameloop'] / 16:
-                    wave_units['units'].append(_unit_type)
-                else:
-                    wave_units['second'] = event['_gameloop'] / 16
-                    wave_units['units'] = [_unit_type]
-
-                if len(wave_units['units']) > 5:
-                    identified_waves[event['_gameloop'] / 16] = wave_units['units']
-
-            # Abathur biomass for identifying locust
-            if _unit_type == 'BiomassPickup':
-                LastBiomassPosition = [event['m_x'], event['m_y'], event['_gameloop']]
-
-            if _unit_type == 'Locust' and [event['m_x'], event['m_y'], event['_gameloop']] == LastBiomassPosition:
-                AbathurKillLocusts.add(unitid(event))
-
-        # In future ignore some Dark/High Templar deaths caused by Archon merge
-        if event['_event'] == 'NNet.Replay.Tracker.SUnitInitEvent' and event['m_unitTypeName'].decode() == "Archon":
-            DT_HT_Ignore[event['m_controlPlayerId']] += 2
-
-        if event['_event'] == 'NNet.Replay.Tracker.SUnitTypeChangeEvent' and unitid(event) in unit_dict:
-            _old_unit_type = unit_dict[unitid(event)][0]
-            _control_pid = unit_dict[unitid(event)][1]
-            _unit_type = event['m_unitTypeName'].decode()
-
-            # Void Launch bonus objective. If it lands and soon-ish after takes off, the bonus is complete.
-            if _control_pid == 7 and _unit_type == 'ResearchVesselLanded':
-                ResearchVesselLandedTiming = event['_gameloop']
-
-            if _control_pid == 7 and _unit_type == 'ResearchVessel' and ResearchVesselLandedTiming is not None and (ResearchVesselLandedTiming + 1100
-                                                                                                                    > event['_gameloop']):
-                bonus_timings.append(event['_gameloop'] / 16 - START_TIME)
-                ResearchVesselLandedTiming = None
-
-            # Scythe of Amon bonus objective. If it changes to WarpPrismPhasing, the bonus is completed.
-            if 'Scythe of Amon' in replay['map_name'] and _control_pid == 11 and _unit_type == 'WarpPrismPhasing':
-                bonus_timings.append(event['_gameloop'] / 16 - START_TIME)
+                if ally_player == _control_pid and not (_unit_type in unit_type_dict_ally):
+                    unit_type_dict_ally[_unit_type] = [0, 0, 0, 0]
 
-            # Strange. Some units morph to egg, then the morph is created, then the egg morphs back and the unit is killed
-            if _unit_type in units_killed_in_morph:
-                continue
+                if _control_pid in amon_players and not (_unit_type in unit_type_dict_amon):
+                    unit_type_dict_amon[_unit_type] = [0, 0, 0, 0]
 
-            # Update unit_dict
-            unit_dict[unitid(event)][0] = _unit_type
+    def unit_owner_change_event(event):
+        """ Updates ownership """
+        unit_id = unitid(event)
+        if unit_id not in units:
+            return
 
-            if main_player == _control_pid:
-                mainStatsCounter.unit_change_event(_unit_type, _old_unit_type)
-            elif ally_player == _control_pid:
-                allyStatsCounter.unit_change_event(_unit_type, _old_unit_type)
+        # Mind-controlled units
+        _losing_player = units.owner(unit_id)
 
-            # Add to created units
-            if _unit_type in UnitNameDict and _old_unit_type in UnitNameDict:
+        if event['m_controlPlayerId'] == main_player and _losing_player in amon_players:
+            units.set_flag(unit_id, MIND_CONTROLLED)
+            if not 'mc' in replay_report_dict['mainIcons']:
+                replay_report_dict['mainIcons']['mc'] = 1
+            else:
+                replay_report_dict['mainIcons']['mc'] += 1
+        elif event['m_controlPlayerId'] == ally_player and _losing_player in amon_players:
+            units.set_flag(unit_id, MIND_CONTROLLED)
+            if not 'mc' in replay_report_dict['allyIcons']:
+                replay_report_dict['allyIcons']['mc'] = 1
+            else:
+                replay_report_dict['allyIcons']['mc'] += 1
 
-                # When banelings finish morph for zagara, it creates new zergling and kills it  (WTF)
-                if _old_unit_type == 'BanelingCocoon' and _unit_type == 'HotSSwarmling':
-                    zagaras_dummy_zerglings.add(unitid(event))
-                    continue
+        # Update ownership
+        units.set_owner(unit_id, event['m_controlPlayerId'])
+
+        # Malwarfare bonus objective. First save when the bonus started, then check if it was completed sooner than 245.9375
+        if map_rules.ownership_bonus:
+            _time = event['_gameloop'] / 16 - START_TIME
+            if event['m_controlPlayerId'] == 9:
+                MWBonusInitialTiming[0] = _time
+            elif event['m_controlPlayerId'] == 10:
+                MWBonusInitialTiming[1] = _time
+            elif event['m_controlPlayerId'] == 6 and (_time - MWBonusInitialTiming[0] < 245.9375 or _time - MWBonusInitialTiming[1] < 245.9375):
+                bonus_timings.append(_time)
+
+    def unit_died_event(event):
+        """ Counts kills and losses """
+        nonlocal ally_kills_counted_toward_main
+        unit_id = unitid(event)
+        unit = units.get(unit_id)
+        second = event['_gameloop'] / 16
 
-                # Don't add into created units if it's just a morph
-                # Don't count wreckages morhping back
-                # Don't count certain unit spawns (Murvar, Glevig, Broodlings from Broodlords)
-                # Don't count mengsk trooper and labourer as new unit created when they morph
-                if (UnitNameDict[_unit_type] != UnitNameDict[_old_unit_type] and not _old_unit_type in UnitAddLossesTo
-                        and not (unit_id in glevig_spawns or unit_id in murvar_spawns or is_broodlord_broodling(_unit_type, unit_id))
-                        and not _unit_type in dont_count_morphs):
-
-                    # Increase unit type created for controlling player
-                    if main_player == _control_pid:
-                        if _unit_type in unit_type_dict_main:
-                            unit_type_dict_main[_unit_type][0] += 1
-                        else:
-                            unit_type_dict_main[_unit_type] = [1, 0, 0, 0]
-
-                    elif ally_player == _control_pid:
-                        if _unit_type in unit_type_dict_ally:
-                            unit_type_dict_ally[_unit_type][0] += 1
-                        else:
-                            unit_type_dict_ally[_unit_type] = [1, 0, 0, 0]
-
-                    elif _control_pid in amon_players:
-                        if _unit_type in unit_type_dict_amon:
-                            unit_type_dict_amon[_unit_type][0] += 1
-                        else:
-                            unit_type_dict_amon[_unit_type] = [1, 0, 0, 0]
+        # Update some kill stats
+        try:
+            killed_unit_type, _losing_player, unit_flags = unit
+            _killed_unit_type = killed_unit_type.name
+            _killing_player = event['m_killerPlayerId']
+
+            # Count kills for players
+            if _killing_player is not None and not killed_unit_type.no_kills:
+                if _killing_player in (1, 2) and not _losing_player in amon_players:
+                    pass
+                elif _killing_player in amon_players and not _losing_player in (1, 2):
+                    pass
+                # Count ally kills to the main player if ally quits early
+                elif _killing_player == ally_player and user_leave_times.get(ally_player, END_TIME) < END_TIME * 0.5:
+                    killcounts[main_player] += 1
+                    ally_kills_counted_toward_main += 1
                 else:
-                    if main_player == _control_pid and not (_unit_type in unit_type_dict_main):
-                        unit_type_dict_main[_unit_type] = [0, 0, 0, 0]
-
-                    if ally_player == _control_pid and not (_unit_type in unit_type_dict_ally):
-                        unit_type_dict_ally[_unit_type] = [0, 0, 0, 0]
-
-                    if _control_pid in amon_players and not (_unit_type in unit_type_dict_amon):
-                        unit_type_dict_amon[_unit_type] = [0, 0, 0, 0]
-
-        # Update ownership
-        if event['_event'] == 'NNet.Replay.Tracker.SUnitOwnerChangeEvent' and unitid(event) in unit_dict:
+                    killcounts[_killing_player] += 1
 
-            # Mind-controlled units
-            _losing_player = unit_dict[unitid(event)][1]
+            # Get last_aoe_unit_killed (used when player units die without a killing unit, it was likely some enemy caster casting persistent AoE spell)
+            if _killed_unit_type in aoe_units and _killing_player in [1, 2] and _losing_player in amon_players and unit_id is not None:
+                last_aoe_unit_killed[_losing_player] = [_killed_unit_type, second]
 
-            if event['m_controlPlayerId'] == main_player and _losing_player in amon_players:
-                mind_controlled_units.add(unitid(event))
-                if not 'mc' in replay_report_dict['mainIcons']:
-                    replay_report_dict['mainIcons']['mc'] = 1
-                else:
-                    replay_report_dict['mainIcons']['mc'] += 1
-            elif event['m_controlPlayerId'] == ally_player and _losing_player in amon_players:
-                mind_controlled_units.add(unitid(event))
-                if not 'mc' in replay_report_dict['allyIcons']:
-                    replay_report_dict['allyIcons']['mc'] = 1
-                else:
-                    replay_report_dict['allyIcons']['mc'] += 1
+        except Exception:
+            logger.error(traceback.format_exc())
 
-            # Update ownership
-            unit_dict[unitid(event)][1] = event['m_controlPlayerId']
+        # More kill stats
+        if unit is None:
+            return
 
-            # Malwarfare bonus objective. First save when the bonus started, then check if it was completed sooner than 245.9375
-            if 'Malwarfare' in replay['map_name']:
-                _time = event['_gameloop'] / 16 - START_TIME
-                if event['m_controlPlayerId'] == 9:
-                    MWBonusInitialTiming[0] = _time
-                elif event['m_controlPlayerId'] == 10:
-                    MWBonusInitialTiming[1] = _time
-                elif event['m_controlPlayerId'] == 6 and (_time - MWBonusInitialTiming[0] < 245.9375 or _time - MWBonusInitialTiming[1] < 245.9375):
-                    bonus_timings.append(_time)
+        try:
+            _killing_unit_id = unitid(event, killer=True)
+            killing_unit = units.get(_killing_unit_id)
+            killing_unit_flags = 0
+            _killing_player = event['m_killerPlayerId']
+            killed_unit_type, _losing_player, unit_flags = unit
+            _killed_unit_type = killed_unit_type.name
+            _commander = commander_fallback.get(_killing_player, None)
+
+            # Get killing unit
+            if killing_unit is not None and unit_id is not None:  # We have a killing unit
+                _killing_unit_type = killing_unit[0].name
+                killing_unit_flags = killing_unit[2]
+            elif _commander is not None:
+                """
+                For no-unit, check if we default to some commander no-unit like airstrike, or use 'NoUnit'
+                But lets use this only rarely. Units killed in transports count for this as well.
+                Other not counted sources: Dusk Wings lifting off, CoD explosion, ...
+                """
+                _killing_unit_type = 'NoUnit'
+                backup_units = commander_no_units.get(_commander, [])
+                d = unit_type_dict_main if _killing_player == main_player else unit_type_dict_ally
+
+                for backup_unit in backup_units:
+                    if backup_unit in d:
+                        _killing_unit_type = backup_unit
+                        break
+            else:
+                _killing_unit_type = 'NoUnit'
 
-        # Update some kill stats
-        if event['_event'] == 'NNet.Replay.Tracker.SUnitDiedEvent':
-            try:
-                _killed_unit_type = unit_dict[unitid(event)][0]
-                _losing_player = unit_dict[unitid(event)][1]
-                _killing_player = event['m_killerPlayerId']
-
-                # Count kills for players
-                if _killing_player is not None and not _killed_unit_type in do_not_count_kills:
-                    if _killing_player in (1, 2) and not _losing_player in amon_players:
-                        pass
-                    elif _killing_player in amon_players and not _losing_player in (1, 2):
-                        pass
-                    # Count ally kills to the main player if ally quits early
-                    elif _killing_player == ally_player and user_leave_times.get(ally_player, END_TIME) < END_TIME * 0.5:
-                        killcounts[main_player] += 1
-                        ally_kills_counted_toward_main += 1
-                    else:
-                        killcounts[_killing_player] += 1
+            # Killbot feed
+            if _killing_unit_type in ('MutatorKillBot', 'MutatorDeathBot', 'MutatorMurderBot') and _losing_player in [1, 2]:
+                killbot_feed[_losing_player] += 1
 
-                # Get last_aoe_unit_killed (used when player units die without a killing unit, it was likely some enemy caster casting persistent AoE spell)
-                if _killed_unit_type in aoe_units and _killing_player in [1, 2] and _losing_player in amon_players and unitid(event) is not None:
-                    last_aoe_unit_killed[_losing_player] = [_killed_unit_type, event['_gameloop'] / 16]
+            # Abathur locusts
+            if _killing_unit_type == 'Locust' and _commander == 'Abathur' and not killing_unit_flags & BIOMASS_LOCUST:
+                _killing_unit_type = 'SwarmHost'
 
-            except Exception:
-                logger.error(traceback.format_exc())
+            # Glevig's spawns
+            elif _killing_unit_type in {'DehakaZerglingLevel2', 'DehakaRoachLevel2', 'DehakaHydraliskLevel2'
+                                        } and killing_unit_flags & GLEVIG_SPAWN:
+                _killing_unit_type = 'Glevig'
 
-        # More kill stats
-        if event['_event'] == 'NNet.Replay.Tracker.SUnitDiedEvent' and unitid(event) in unit_dict:
-            try:
-                _killing_unit_id = unitid(event, killer=True)
-                _killing_player = event['m_killerPlayerId']
-                unit_id = unitid(event)
-                _killed_unit_type = unit_dict[unit_id][0]
-                _losing_player = int(unit_dict[unit_id][1])
-                _commander = commander_fallback.get(_killing_player, None)
-
-                # Get killing unit
-                if _killing_unit_id in unit_dict and unitid(event) is not None:  # We have a killing unit
-                    _killing_unit_type = unit_dict[_killing_unit_id][0]
-                elif _commander is not None:
-                    """
-                    For no-unit, check if we default to some commander no-unit like airstrike, or use 'NoUnit'
-                    But lets use this only rarely. Units killed in transports count for this as well.
-                    Other not counted sources: Dusk Wings lifting off, CoD explosion, ...
-                    """
-                    _killing_unit_type = 'NoUnit'
-                    backup_units = commander_no_units.get(_commander, [])
-                    d = unit_type_dict_main if _killing_player == main_player else unit_type_dict_ally
-
-                    for backup_unit in backup_units:
-                        if backup_unit in d:
-                            _killing_unit_type = backup_unit
-                            break
-                else:
-                    _killing_unit_type = 'NoUnit'
-
-                # Killbot feed
-                if _killing_unit_type in ('MutatorKillBot', 'MutatorDeathBot', 'MutatorMurderBot') and _losing_player in [1, 2]:
-                    killbot_feed[_losing_player] += 1
-
-                # Abathur locusts
-                if _killing_unit_type == 'Locust' and _commander == 'Abathur' and not _killing_unit_id in AbathurKillLocusts:
-                    _killing_unit_type = 'SwarmHost'
-
-                # Glevig's spawns
-                elif _killing_unit_type in {'DehakaZerglingLevel2', 'DehakaRoachLevel2', 'DehakaHydraliskLevel2'
-                                            } and _killing_unit_id in glevig_spawns:
-                    _killing_unit_type = 'Glevig'
-
-                # Murvars's spawns
-                elif _killing_unit_type in {'DehakaLocust', 'DehakaCreeperFlying', 'DehakaLocustFlying', 'DehakaCreeper'
-                                            } and _killing_unit_id in murvar_spawns:
-                    _killing_unit_type = 'Murvar'
-
-                # Kerrigan's and Stetmann's Broodlings
-                elif is_broodlord_broodling(_killing_unit_type, _killing_unit_id):
-                    if _killing_unit_type == 'Broodling':
-                        _killing_unit_type = 'BroodLord'
-                    elif _killing_unit_type == 'BroodlingStetmann':
-                        _killing_unit_type = 'BroodLordStetmann'
-
-                # Custom kill count
-                if _killing_player in [1, 2] and _losing_player in amon_players:
-                    if _killed_unit_type in HFTS_Units:
-                        if not 'hfts' in custom_kill_count:
-                            custom_kill_count['hfts'] = {1: 0, 2: 0}
-                        custom_kill_count['hfts'][_killing_player] += 1
-
-                    if _killed_unit_type in TUS_Units:
-                        if not 'tus' in custom_kill_count:
-                            custom_kill_count['tus'] = {1: 0, 2: 0}
-                        custom_kill_count['tus'][_killing_player] += 1
-
-                    elif _killed_unit_type == 'MutatorPropagator':
-                        if not 'propagators' in custom_kill_count:
-                            custom_kill_count['propagators'] = {1: 0, 2: 0}
-                        custom_kill_count['propagators'][_killing_player] += 1
-
-                    elif _killed_unit_type in {'MutatorSpiderMine', 'MutatorSpiderMineBurrowed', 'WidowMineBurrowed', 'WidowMine'}:
-                        if not 'minesweeper' in custom_kill_count:
-                            custom_kill_count['minesweeper'] = {1: 0, 2: 0}
-                        custom_kill_count['minesweeper'][_killing_player] += 1
-
-                    elif _killed_unit_type == 'MutatorVoidRift':
-                        if not 'voidrifts' in custom_kill_count:
-                            custom_kill_count['voidrifts'] = {1: 0, 2: 0}
-                        custom_kill_count['voidrifts'][_killing_player] += 1
-
-                    elif _killed_unit_type in {'MutatorTurkey', 'MutatorTurking', 'MutatorInfestedTurkey'}:
-                        if not 'turkey' in custom_kill_count:
-                            custom_kill_count['turkey'] = {1: 0, 2: 0}
-                        custom_kill_count['turkey'][_killing_player] += 1
-
-                    elif _killed_unit_type == 'MutatorVoidReanimator':
-                        if not 'voidreanimators' in custom_kill_count:
-                            custom_kill_count['voidreanimators'] = {1: 0, 2: 0}
-                        custom_kill_count['voidreanimators'][_killing_player] += 1
-
-                    elif _killed_unit_type in {'InfestableBiodome', 'JarbanInfestibleColonistHut', 'InfestedMercHaven', 'InfestableHut'}:
-                        if not 'deadofnight' in custom_kill_count:
-                            custom_kill_count['deadofnight'] = {1: 0, 2: 0}
-                        custom_kill_count['deadofnight'][_killing_player] += 1
-
-                    elif _killed_unit_type in {
-                            'MutatorMissileSplitterChild', 'MutatorMissileNuke', 'MutatorMissileSplitter', 'MutatorMissileStandard',
-                            'MutatorMissilePointDefense'
-                    }:
-                        if not 'missilecommand' in custom_kill_count:
-                            custom_kill_count['missilecommand'] = {1: 0, 2: 0}
-                        custom_kill_count['missilecommand'][_killing_player] += 1
-
-                # If an enemy mutator spider mine kills something, counts a kill for the first player who lost a unit to it
-                if _losing_player in [1, 2] and _killing_player in amon_players:
-                    if _killing_unit_type == 'MutatorSpiderMine' and not _killing_unit_id in UsedMutatorSpiderMines:
-                        UsedMutatorSpiderMines.add(_killing_unit_id)  # Count each mutator spider mine only once
-                        if not 'minesweeper' in custom_kill_count:
-                            custom_kill_count['minesweeper'] = {1: 0, 2: 0}
-                        custom_kill_count['minesweeper'][_losing_player] += 1
-                """Fix kills for some enemy area-of-effect units that kills player units after they are dead.
-                   This is the best guess, if one of aoe_units died recently, it was likely that one. """
-                if _killing_unit_type == 'NoUnit' and _killing_unit_id is None and _killing_player in amon_players and _losing_player != _killing_player:
-                    if event['_gameloop'] / 16 - last_aoe_unit_killed[_killing_player][1] < 9 and last_aoe_unit_killed[_killing_player][0] is not None:
-                        unit_type_dict_amon[last_aoe_unit_killed[_killing_player][0]][2] += 1
-                        logger.debug(
-                            f'{last_aoe_unit_killed[_killing_player][0]}({_killing_player}) killed {_killed_unit_type} | {event["_gameloop"]/16}s')
-
-                # Update unit kill stats
-                if ((_killing_unit_id in unit_dict) or _killing_unit_type in commander_no_units_values) and (
-                        _killing_unit_id != unitid(event)) and _losing_player != _killing_player and _killed_unit_type not in do_not_count_kills:
-                    if main_player == _killing_player and _losing_player in amon_players:
-                        if _killing_unit_type in unit_type_dict_main:
-                            unit_type_dict_main[_killing_unit_type][2] += 1
-                        else:
-                            unit_type_dict_main[_killing_unit_type] = [0, 0, 1, 0]
-
-                    if ally_player == _killing_player and _losing_player in amon_players:
-                        if _killing_unit_type in unit_type_dict_ally:
-                            unit_type_dict_ally[_killing_unit_type][2] += 1
-                        else:
-                            unit_type_dict_ally[_killing_unit_type] = [0, 0, 1, 0]
-
-                    if _killing_player in amon_players and _losing_player in (1, 2):
-                        if _killing_unit_type in unit_type_dict_amon:
-                            unit_type_dict_amon[_killing_unit_type][2] += 1
-                        else:
-                            unit_type_dict_amon[_killing_unit_type] = [0, 0, 1, 0]
-
-                # Update unit death stats
-                # Don't count self kills like Fenix switching suits
-                if _killed_unit_type in self_killing_units and _killing_player is None:
-                    if main_player == _losing_player:
-                        unit_type_dict_main[_killed_unit_type][0] -= 1
-                    if ally_player == _losing_player:
-                        unit_type_dict_ally[_killed_unit_type][0] -= 1
-                    continue
+            # Murvars's spawns
+            elif _killing_unit_type in {'DehakaLocust', 'DehakaCreeperFlying', 'DehakaLocustFlying', 'DehakaCreeper'
+                                        } and killing_unit_flags & MURVAR_SPAWN:
+                _killing_unit_type = 'Murvar'
 
-                # Fix for units like Raptorlings that are counted each time they jump (as death and birth)
-                if event[
-                        '_gameloop'] / 16 > 0 and _killed_unit_type in duplicating_units and _killed_unit_type == _killing_unit_type and _losing_player == _killing_player:
-                    if main_player == _losing_player:
-                        unit_type_dict_main[_killed_unit_type][0] -= 1
-                        continue
-                    if ally_player == _losing_player:
-                        unit_type_dict_ally[_killed_unit_type][0] -= 1
-                        continue
-                    if _killing_player in amon_players:
-                        unit_type_dict_amon[_killed_unit_type][0] -= 1
-                        continue
-
-                # In case of death caused by Archon merge, ignore these kills
-                if _killed_unit_type in ('HighTemplar', 'DarkTemplar') and DT_HT_Ignore[_losing_player] > 0:
-                    DT_HT_Ignore[_losing_player] -= 1
-                    continue
-                """
-                Bonus objectives
-                Mostly kills here. Sometimes checking killing player to prevent despawns from counting.
-                In case of trains, killing player is almost always None, and so I'm checking the position of the train.
+            # Kerrigan's and Stetmann's Broodlings
+            elif is_broodlord_broodling(_killing_unit_type, killing_unit_flags):
+                if _killing_unit_type == 'Broodling':
+                    _killing_unit_type = 'BroodLord'
+                elif _killing_unit_type == 'BroodlingStetmann':
+                    _killing_unit_type = 'BroodLordStetmann'
+
+            # Custom kill count
+            if _killing_player in [1, 2] and _losing_player in amon_players:
+                if _killed_unit_type in HFTS_Units:
+                    if not 'hfts' in custom_kill_count:
+                        custom_kill_count['hfts'] = {1: 0, 2: 0}
+                    custom_kill_count['hfts'][_killing_player] += 1
+
+                if _killed_unit_type in TUS_Units:
+                    if not 'tus' in custom_kill_count:
+                        custom_kill_count['tus'] = {1: 0, 2: 0}
+                    custom_kill_count['tus'][_killing_player] += 1
+
+                elif _killed_unit_type == 'MutatorPropagator':
+                    if not 'propagators' in custom_kill_count:
+                        custom_kill_count['propagators'] = {1: 0, 2: 0}
+                    custom_kill_count['propagators'][_killing_player] += 1
+
+                elif _killed_unit_type in {'MutatorSpiderMine', 'MutatorSpiderMineBurrowed', 'WidowMineBurrowed', 'WidowMine'}:
+                    if not 'minesweeper' in custom_kill_count:
+                        custom_kill_count['minesweeper'] = {1: 0, 2: 0}
+                    custom_kill_count['minesweeper'][_killing_player] += 1
+
+                elif _killed_unit_type == 'MutatorVoidRift':
+                    if not 'voidrifts' in custom_kill_count:
+                        custom_kill_count['voidrifts'] = {1: 0, 2: 0}
+                    custom_kill_count['voidrifts'][_killing_player] += 1
+
+                elif _killed_unit_type in {'MutatorTurkey', 'MutatorTurking', 'MutatorInfestedTurkey'}:
+                    if not 'turkey' in custom_kill_count:
+                        custom_kill_count['turkey'] = {1: 0, 2: 0}
+                    custom_kill_count['turkey'][_killing_player] += 1
+
+                elif _killed_unit_type == 'MutatorVoidReanimator':
+                    if not 'voidreanimators' in custom_kill_count:
+                        custom_kill_count['voidreanimators'] = {1: 0, 2: 0}
+                    custom_kill_count['voidreanimators'][_killing_player] += 1
+
+                elif _killed_unit_type in {'InfestableBiodome', 'JarbanInfestibleColonistHut', 'InfestedMercHaven', 'InfestableHut'}:
+                    if not 'deadofnight' in custom_kill_count:
+                        custom_kill_count['deadofnight'] = {1: 0, 2: 0}
+                    custom_kill_count['deadofnight'][_killing_player] += 1
+
+                elif _killed_unit_type in {
+                        'MutatorMissileSplitterChild', 'MutatorMissileNuke', 'MutatorMissileSplitter', 'MutatorMissileStandard',
+                        'MutatorMissilePointDefense'
+                }:
+                    if not 'missilecommand' in custom_kill_count:
+                        custom_kill_count['missilecommand'] = {1: 0, 2: 0}
+                    custom_kill_count['missilecommand'][_killing_player] += 1
+
+            # If an enemy mutator spider mine kills something, counts a kill for the first player who lost a unit to it
+            if _losing_player in [1, 2] and _killing_player in amon_players:
+                if _killing_unit_type == 'MutatorSpiderMine' and not _killing_unit_id in UsedMutatorSpiderMines:
+                    UsedMutatorSpiderMines.add(_killing_unit_id)  # Count each mutator spider mine only once
+                    if not 'minesweeper' in custom_kill_count:
+                        custom_kill_count['minesweeper'] = {1: 0, 2: 0}
+                    custom_kill_count['minesweeper'][_losing_player] += 1
+            """Fix kills for some enemy area-of-effect units that kills player units after they are dead.
+               This is the best guess, if one of aoe_units died recently, it was likely that one. """
+            if _killing_unit_type == 'NoUnit' and _killing_unit_id is None and _killing_player in amon_players and _losing_player != _killing_player:
+                if second - last_aoe_unit_killed[_killing_player][1] < 9 and last_aoe_unit_killed[_killing_player][0] is not None:
+                    unit_type_dict_amon[last_aoe_unit_killed[_killing_player][0]][2] += 1
+                    logger.debug(
+                        f'{last_aoe_unit_killed[_killing_player][0]}({_killing_player}) killed {_killed_unit_type} | {event["_gameloop"]/16}s')
+
+            # Update unit kill stats
+            if ((killing_unit is not None) or _killing_unit_type in commander_no_units_values) and (
+                    _killing_unit_id != unit_id) and _losing_player != _killing_player and not killed_unit_type.no_kills:
+                if main_player == _killing_player and _losing_player in amon_players:
+                    if _killing_unit_type in unit_type_dict_main:
+                        unit_type_dict_main[_killing_unit_type][2] += 1
+                    else:
+                        unit_type_dict_main[_killing_unit_type] = [0, 0, 1, 0]
 
-                """
-                if ('Void Thrashing' in replay['map_name'] and _killed_unit_type in {'ArchAngelCoopFighter','ArchAngelCoopAssault'} and _losing_player == 5) or \
-                   ('Dead of Night' in replay['map_name'] and 'ACVirophage' == _killed_unit_type and _losing_player == 7 and _killing_player in {1,2}) or \
-                   (('Lock & Load' in replay['map_name'] or '[MM] LnL' in replay['map_name']) and 'XelNagaConstruct' == _killed_unit_type and _losing_player == 3) or \
-                   ('Chain of Ascension' in replay['map_name'] and 'SlaynElemental' == _killed_unit_type and _losing_player == 10 and _killing_player in {1,2}) or \
-                   ('Rifts to Korhal' in replay['map_name'] and 'ACPirateCapitalShip' == _killed_unit_type and _losing_player == 8 and _killing_player in {1,2}) or \
-                   ('Cradle of Death' in replay['map_name'] and 'LogisticsHeadquarters' == _killed_unit_type and _losing_player == 3) or \
-                   ('Part and Parcel' in replay['map_name'] and _killed_unit_type in {'Caboose','TarsonisEngine'}
-                        and not round(event['_gameloop']/16 - START_TIME,0) in bonus_timings
-                        and len(bonus_timings) < 2
-                        and _losing_player == 8
-                        and not (event['m_x'] == 169
-                        and event['m_y'] == 99)
-                        and not (event['m_x'] == 38
-                        and event['m_y'] == 178)) or \
-                   ('Oblivion Express' in replay['map_name'] and 'TarsonisEngineFast' == _killed_unit_type and _losing_player == 7 and event['m_x'] < 196) or \
-                   ('Mist Opportunities' in replay['map_name'] and 'COOPTerrazineTank' == _killed_unit_type and _losing_player == 3 and _killing_player in {1,2}) or \
-                   ('The Vermillion Problem' in replay['map_name'] and _killed_unit_type in {'RedstoneSalamander','RedstoneSalamanderBurrowed'} and _losing_player == 9 and _killing_player in {1,2}) or \
-                   ('Miner Evacuation' in replay['map_name'] and _killed_unit_type == 'Blightbringer' and  _losing_player == 5 and _killing_player in {1,2}) or \
-                   ('Miner Evacuation' in replay['map_name'] and _killed_unit_type == 'NovaEradicator' and  _losing_player == 9 and unit_type_dict_amon[_killed_unit_type][1] == 1 and _killing_player in {1,2}) or \
-                   ('Temple of the Past' in replay['map_name'] and _killed_unit_type == 'ZenithStone' and _losing_player == 8):
-
-                    # Time offset for Cradle of Death as the explosion is delayed
-                    if 'Cradle of Death' in replay['map_name']:
-                        bonus_timings.append(round(event['_gameloop'] / 16 - START_TIME - 8, 0))
+                if ally_player == _killing_player and _losing_player in amon_players:
+                    if _killing_unit_type in unit_type_dict_ally:
+                        unit_type_dict_ally[_killing_unit_type][2] += 1
                     else:
-                        bonus_timings.append(round(event['_gameloop'] / 16 - START_TIME, 0))
-
-                    # logger.debug(
-                    #     f'-------------\nBO: {_killed_unit_type} ({_losing_player}) killed by {_killing_player} ({event["_gameloop"]/16/60:.2f})min\n{event}\n-------------'
-                    # )
-
-                # Don't save salvaged units
-                if _killed_unit_type in salvage_units and _losing_player == _killing_player:
-                    if _losing_player == main_player:
-                        mainStatsCounter.salvaged_units.append(_killed_unit_type)
-                    elif _losing_player == ally_player:
-                        allyStatsCounter.salvaged_units.append(_killed_unit_type)
-
-                # Don't include salvage and spawns
-                if (_killed_unit_type in salvage_units and _losing_player == _killing_player) \
-                    or unit_id in glevig_spawns \
-                    or unit_id in murvar_spawns \
-                    or is_broodlord_broodling(_killed_unit_type, unit_id):
-                    continue
+                        unit_type_dict_ally[_killing_unit_type] = [0, 0, 1, 0]
 
-                # Don't add losses to dummy zerglings killed when banelings are finished
-                if unit_id in zagaras_dummy_zerglings and event['m_killerPlayerId'] is None:
-                    continue
+                if _killing_player in amon_players and _losing_player in (1, 2):
+                    if _killing_unit_type in unit_type_dict_amon:
+                        unit_type_dict_amon[_killing_unit_type][2] += 1
+                    else:
+                        unit_type_dict_amon[_killing_unit_type] = [0, 0, 1, 0]
+
+            # Update unit death stats
+            # Don't count self kills like Fenix switching suits
+            if _killed_unit_type in self_killing_units and _killing_player is None:
+                if main_player == _losing_player:
+                    unit_type_dict_main[_killed_unit_type][0] -= 1
+                if ally_player == _losing_player:
+                    unit_type_dict_ally[_killed_unit_type][0] -= 1
+                return
+
+            # Fix for units like Raptorlings that are counted each time they jump (as death and birth)
+            if second > 0 and _killed_unit_type in duplicating_units and _killed_unit_type == _killing_unit_type and _losing_player == _killing_player:
+                if main_player == _losing_player:
+                    unit_type_dict_main[_killed_unit_type][0] -= 1
+                    return
+                if ally_player == _losing_player:
+                    unit_type_dict_ally[_killed_unit_type][0] -= 1
+                    return
+                if _killing_player in amon_players:
+                    unit_type_dict_amon[_killed_unit_type][0] -= 1
+                    return
+
+            # In case of death caused by Archon merge, ignore these kills
+            if _killed_unit_type in ('HighTemplar', 'DarkTemplar') and DT_HT_Ignore[_losing_player] > 0:
+                DT_HT_Ignore[_losing_player] -= 1
+                return
+            """
+            Bonus objectives
+            Mostly kills here. Sometimes checking killing player to prevent despawns from counting.
+            In case of trains, killing player is almost always None, and so I'm checking the position of the train.
+
+            """
+            bonus_timing = map_rules.bonus_kill(event, _killed_unit_type, _losing_player, _killing_player, second - START_TIME, bonus_timings,
+                                                unit_type_dict_amon)
+            if bonus_timing is not None:
+                bonus_timings.append(bonus_timing)
+
+                # logger.debug(
+                #     f'-------------\nBO: {_killed_unit_type} ({_losing_player}) killed by {_killing_player} ({event["_gameloop"]/16/60:.2f})min\n{event}\n-------------'
+                # )
+
+            # Don't save salvaged units
+            if _killed_unit_type in salvage_units and _losing_player == _killing_player:
+                if _losing_player == main_player:
+                    mainStatsCounter.salvaged_units.append(_killed_unit_type)
+                elif _losing_player == ally_player:
+                    allyStatsCounter.salvaged_units.append(_killed_unit_type)
+
+            # Don't include salvage and spawns
+            if (_killed_unit_type in salvage_units and _losing_player == _killing_player) \
+                or unit_flags & (GLEVIG_SPAWN | MURVAR_SPAWN) \
+                or is_broodlord_broodling(_killed_unit_type, unit_flags):
+                return
+
+            # Don't add losses to dummy zerglings killed when banelings are finished
+            if unit_flags & ZAGARA_DUMMY_ZERGLING and event['m_killerPlayerId'] is None:
+                return
+
+            # Don't count base Roaches morphing into Brutalisks (unlike RoachVile, these count as dead when morphing)
+            # RavagerAbathur are killed as well
+            if _killed_unit_type in {'Roach','RavagerAbathur','RoachVileBurrowed','RoachBurrowed','SwarmHostBurrowed','QueenBurrowed'} \
+                and commander_fallback.get(_losing_player) == 'Abathur' \
+                and event['m_killerPlayerId'] is None:
+                return
+
+            # Don't count Drone losses without killing player
+            if _killed_unit_type == 'Drone' and event.get('m_killerPlayerId') is None:
+                return
+
+            # Add losses
+            if main_player == _losing_player and second > 0 and second > START_TIME + 1:  # Don't count deaths on game init
+                if _killed_unit_type in unit_type_dict_main:
+                    unit_type_dict_main[_killed_unit_type][1] += 1
+                else:
+                    unit_type_dict_main[_killed_unit_type] = [0, 1, 0, 0]
 
-                # Don't count base Roaches morphing into Brutalisks (unlike RoachVile, these count as dead when morphing)
-                # RavagerAbathur are killed as well
-                if _killed_unit_type in {'Roach','RavagerAbathur','RoachVileBurrowed','RoachBurrowed','SwarmHostBurrowed','QueenBurrowed'} \
-                    and commander_fallback.get(_losing_player) == 'Abathur' \
-                    and event['m_killerPlayerId'] is None:
-                    continue
+                if unit_flags & MIND_CONTROLLED:
+                    mainStatsCounter.mindcontrolled_unit_dies(_killed_unit_type)
 
-                # Don't count Drone losses without killing player
-                if _killed_unit_type == 'Drone' and event.get('m_killerPlayerId') is None:
-                    continue
+            if ally_player == _losing_player and second > 0 and second > START_TIME + 1:
+                if _killed_unit_type in unit_type_dict_ally:
+                    unit_type_dict_ally[_killed_unit_type][1] += 1
+                else:
+                    unit_type_dict_ally[_killed_unit_type] = [0, 1, 0, 0]
 
-                # Add losses
-                if main_player == _losing_player and event['_gameloop'] / 16 > 0 and event[
-                        '_gameloop'] / 16 > START_TIME + 1:  # Don't count deaths on game init
-                    if _killed_unit_type in unit_type_dict_main:
-                        unit_type_dict_main[_killed_unit_type][1] += 1
-                    else:
-                        unit_type_dict_main[_killed_unit_type] = [0, 1, 0, 0]
+                if unit_flags & MIND_CONTROLLED:
+                    allyStatsCounter.mindcontrolled_unit_dies(_killed_unit_type)
 
-                    if unit_id in mind_controlled_units:
-                        mainStatsCounter.mindcontrolled_unit_dies(_killed_unit_type)
+            if _losing_player in amon_players and second > 0 and second > START_TIME + 1 and not unit_flags & DEHAKA_DRAG:
+                if _killed_unit_type in unit_type_dict_amon:
+                    unit_type_dict_amon[_killed_unit_type][1] += 1
+                else:
+                    unit_type_dict_amon[_killed_unit_type] = [0, 1, 0, 0]
+
+        except Exception:
+            logger.error(traceback.format_exc())
+
+    # Event types and their handlers, other events are skipped
+    event_handlers = {
+        'NNet.Game.SCmdEvent': VespeneDroneIdentifier.event,  # Counting vespene drones
+        'NNet.Game.SCmdUpdateTargetUnitEvent': VespeneDroneIdentifier.event,
+        'NNet.Replay.Tracker.SPlayerStatsEvent': player_stats_event,
+        'NNet.Replay.Tracker.SUpgradeEvent': upgrade_event,
+        'NNet.Replay.Tracker.SUnitBornEvent': unit_born_event,
+        'NNet.Replay.Tracker.SUnitInitEvent': unit_init_event,
+        'NNet.Replay.Tracker.SUnitTypeChangeEvent': unit_type_change_event,
+        'NNet.Replay.Tracker.SUnitOwnerChangeEvent': unit_owner_change_event,
+        'NNet.Replay.Tracker.SUnitDiedEvent': unit_died_event,
+    }
 
-                if ally_player == _losing_player and event['_gameloop'] / 16 > 0 and event['_gameloop'] / 16 > START_TIME + 1:
-                    if _killed_unit_type in unit_type_dict_ally:
-                        unit_type_dict_ally[_killed_unit_type][1] += 1
-                    else:
-                        unit_type_dict_ally[_killed_unit_type] = [0, 1, 0, 0]
+    for event in replay['events']:
+        event_type = event['_event']
 
-                    if unit_id in mind_controlled_units:
-                        allyStatsCounter.mindcontrolled_unit_dies(_killed_unit_type)
+        # Save when user leaves
+        if event_type == 'NNet.Game.SGameUserLeaveEvent':
+            user = event['_userid']['m_userId'] + 1
+            user_leave_times[user] = event['_gameloop'] / 16
 
-                if _losing_player in amon_players and event['_gameloop'] / 16 > 0 and event['_gameloop'] / 16 > START_TIME + 1 and not unitid(
-                        event) in MutatorDehakaDragUnitIDs:
-                    if _killed_unit_type in unit_type_dict_amon:
-                        unit_type_dict_amon[_killed_unit_type][1] += 1
-                    else:
-                        unit_type_dict_amon[_killed_unit_type] = [0, 1, 0, 0]
+        # Skip events after the game ended
+        if event['_gameloop'] / 16 > END_TIME:
+            continue
 
-            except Exception:
-                logger.error(traceback.format_exc())
+        handler = event_handlers.get(event_type)
+        if handler is not None:
+            handler(event)
 
     # pprint(unit_type_dict_main)
     # pprint(unit_type_dict_ally)
@@ -1006,7 +995,7 @@ def analyse_parsed_replay(filepath, replay, main_player_handles=None):
     for item in {'hfts', 'tus', 'propagators', 'voidrifts', 'turkey', 'voidreanimators', 'deadofnight', 'minesweeper', 'missilecommand'}:
         if item in custom_kill_count:
             # Skip if it's not a Dead of Night map
-            if item == 'deadofnight' and 'Dead of Night' not in replay['map_name']:
+            if item == 'deadofnight' and map_rules.name != 'Dead of Night':
                 continue
 
             # Skip if just mines died, not a mutation
@@ -1131,13 +1120,65 @@ def analyse_parsed_replay(filepath, replay, main_player_handles=None):
     return replay_report_dict
 
 
-def parse_and_analyse_replay(filepath, main_player_handles=None):
+def get_replay_card(filepath, main_player_handles=None):
+    """ Returns basic data about a replay for the overlay. Only header, details and metadata are decoded, so it's fast.
+    Units, kills and charts are missing, those come with the full analysis (`parse_and_analyse_replay`)."""
+    try:
+        replay = parse_replay_file(filepath, parse_events=False)
+    except Exception:
+        logger.error(f'Failed to get replay card ({filepath})\n{traceback.format_exc()}')
+        return {}
+
+    if replay is None:
+        return {}
+
+    main_player, ally_player = find_main_player(replay, main_player_handles)
+    main = replay['players'][main_player]
+    ally = replay['players'][ally_player]
+
+    card = dict()
+    card['file'] = filepath
+    card['replaydata'] = True
+    card['card'] = True
+    card['map_name'] = replay['map_name']
+    card['extension'] = replay['extension']
+    card['B+'] = replay['brutal_plus']
+    card['result'] = replay['result']
+    card['difficulty'] = format_difficulty(replay, main_player)
+    card['mutators'] = replay['mutators']
+    card['weekly'] = replay.get('weekly', False)
+    card['length'] = replay['accurate_length'] / 1.4
+    card['bonus'] = tuple()
+    card['comp'] = ''
+    card['positions'] = {'main': main_player, 'ally': ally_player}
+
+    card['main'] = main.get('name', 'None')
+    card['mainAPM'] = main.get('apm', 0)
+    card['mainCommander'] = main.get('commander', '')
+    card['mainCommanderLevel'] = main.get('commander_level', 0)
+    card['mainMasteries'] = main.get('masteries', (0, 0, 0, 0, 0, 0))
+    card['mainPrestige'] = main.get('prestige_name', '')
+    card['mainIcons'] = dict()
+    card['mainkills'] = 0
+
+    card['ally'] = ally.get('name', 'None')
+    card['allyAPM'] = ally.get('apm', 0)
+    card['allyCommander'] = ally.get('commander', '')
+    card['allyCommanderLevel'] = ally.get('commander_level', 0)
+    card['allyMasteries'] = ally.get('masteries', (0, 0, 0, 0, 0, 0))
+    card['allyPrestige'] = ally.get('prestige_name', '')
+    card['allyIcons'] = dict()
+    card['allykills'] = 0
+    return card
+
+
+def parse_and_analyse_replay(filepath, main_player_handles=None, rhash=None):
     """ Analyses the replay and returns the analysis"""
     logger.info(f'Analysing: {filepath}')
 
     # Load the replay
     try:
-        replay = parse_replay_file(filepath)
+        replay = parse_replay_file(filepath, rhash)
     except Exception:
         logger.error(f'Parsing error ({filepath})\n{traceback.format_exc()}')
 
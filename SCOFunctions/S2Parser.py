@@ -1,4 +1,7 @@
 import datetime
+import functools
+import heapq
+import importlib
 import json
 import os
 import time
@@ -6,8 +9,10 @@ import traceback
 
 import mpyq
 from s2protocol import versions
+from s2protocol.decoders import BitPackedDecoder, CorruptedError, VersionedDecoder
 from s2protocol.build import game_version as protocol_build
 
+import SCOFunctions.MEventCache as EC
 from SCOFunctions.IdentifyMutators import identify_mutators
 from SCOFunctions.SC2Dictionaries import map_names, prestige_names
 
@@ -29,26 +34,271 @@ def find_closest_values(number: int, llist: list, amount=2):
     return list(closest.values())[:amount]
 
 
-def get_last_deselect_event(events):
-    """ Returns the last deselect event in replay's events """
-    last_event = None
-    for event in events:
-        if event['_event'] == 'NNet.Game.SSelectionDeltaEvent':
-            last_event = event['_gameloop'] / 16 - 2  #16 gameloops per second, offset to coincide with speedrun timings more
+def is_start_event(event):
+    """ Checks if the game starts with the event (spray upgrade, or mineral collection as fallback) """
+    if event['_event'] == 'NNet.Replay.Tracker.SPlayerStatsEvent' and event['m_playerId'] == 1 and event['m_stats'][
+            'm_scoreValueMineralsCollectionRate'] > 0:
+        return True
+    if event['_event'] == 'NNet.Replay.Tracker.SUpgradeEvent' and event['m_playerId'] in [1, 2] and 'Spray' in event['m_upgradeTypeName'].decode():
+        return True
+    return False
 
-    return last_event
 
+# Only these events are used to identify mutators
+mutator_events = {'NNet.Replay.Tracker.SUpgradeEvent', 'NNet.Game.STriggerDialogControlEvent'}
 
-def get_start_time(events):
-    """ Returns accurate start time based on upgrades and mineral collection as fallback"""
+
+def scan_events(events):
+    """ Goes through events once. Returns start time, the last deselect event and events used to identify mutators. """
+    start_time = None
+    last_deselect_event = None
+    found_events = list()
     for event in events:
-        if event['_event'] == 'NNet.Replay.Tracker.SPlayerStatsEvent' and event[
-                'm_playerId'] == 1 and event['m_stats']['m_scoreValueMineralsCollectionRate'] > 0:
-            return event['_gameloop'] / 16
-        if event['_event'] == 'NNet.Replay.Tracker.SUpgradeEvent' and event['m_playerId'] in [1, 2
-                                                                                              ] and 'Spray' in event['m_upgradeTypeName'].decode():
-            return event['_gameloop'] / 16
-    return 0
+        if event['_event'] == 'NNet.Game.SSelectionDeltaEvent':
+            last_deselect_event = event['_gameloop'] / 16 - 2  #16 gameloops per second, offset to coincide with speedrun timings more
+        elif event['_event'] in mutator_events:
+            found_events.append(event)
+
+        if start_time is None and is_start_event(event):
+            start_time = event['_gameloop'] / 16
+
+    return start_time if start_time is not None else 0, last_deselect_event, found_events
+
+
+# Events the parser itself needs (start time, last deselect event, mutators). These are always decoded.
+parser_events = {
+    'NNet.Replay.Tracker.SPlayerStatsEvent', 'NNet.Replay.Tracker.SUpgradeEvent', 'NNet.Game.SSelectionDeltaEvent',
+    'NNet.Game.STriggerDialogControlEvent'
+}
+
+
+def _gameloop(event):
+    return event['_gameloop']
+
+
+class SkippingBitPackedDecoder(BitPackedDecoder):
+    """ Bit packed decoder that can also skip over an instance without creating it.
+    Only the bits are read, no dictionaries or lists are built."""
+    def skip(self, typeid):
+        if typeid >= len(self._typeinfos):
+            raise CorruptedError(self)
+        kind, args = self._typeinfos[typeid]
+
+        if kind == '_int':
+            self._buffer.read_bits(args[0][1])
+        elif kind == '_struct':
+            for field in args[0]:
+                self.skip(field[1])
+        elif kind == '_array':
+            for _ in range(self._int(args[0])):
+                self.skip(args[1])
+        elif kind == '_blob':
+            self._buffer.read_aligned_bytes(self._int(args[0]))
+        elif kind == '_bool':
+            self._buffer.read_bits(1)
+        elif kind == '_optional':
+            if self._buffer.read_bits(1):
+                self.skip(args[0])
+        elif kind == '_choice':
+            tag = self._int(args[0])
+            if tag not in args[1]:
+                raise CorruptedError(self)
+            self.skip(args[1][tag][1])
+        elif kind == '_bitarray':
+            self._buffer.read_bits(self._int(args[0]))
+        elif kind in ('_fourcc', '_real32'):
+            self._buffer.read_bits(32)
+        elif kind == '_real64':
+            self._buffer.read_bits(64)
+        elif kind != '_null':
+            # Unknown type, decode it normally
+            self.instance(typeid)
+
+
+def decode_event_stream(protocol, contents, game, event_filter=None):
+    """ Decodes and yields events from a game or tracker event stream.
+    Same as s2protocol's event stream decoding, except that events not in `event_filter` are skipped without being created.
+    `event_filter = None` decodes all events."""
+    if game:
+        decoder = SkippingBitPackedDecoder(contents, protocol.typeinfos)
+        eventid_typeid = protocol.game_eventid_typeid
+        event_types = protocol.game_event_types
+        skip = decoder.skip
+    else:
+        decoder = VersionedDecoder(contents, protocol.typeinfos)
+        eventid_typeid = protocol.tracker_eventid_typeid
+        event_types = protocol.tracker_event_types
+        skip = lambda typeid: decoder._skip_instance()
+
+    gameloop = 0
+    while not decoder.done():
+        start_bits = decoder.used_bits()
+
+        # Gameloop delta, userid and event id precede each event
+        gameloop += protocol._varuint32_value(decoder.instance(protocol.svaruint32_typeid))
+        if game:
+            userid = decoder.instance(protocol.replay_userid_typeid)
+
+        eventid = decoder.instance(eventid_typeid)
+        typeid, typename = event_types.get(eventid, (None, None))
+        if typeid is None:
+            raise CorruptedError(f'eventid({eventid}) at {decoder}')
+
+        if event_filter is not None and typename not in event_filter:
+            skip(typeid)
+            decoder.byte_align()
+            continue
+
+        event = decoder.instance(typeid)
+        event['_event'] = typename
+        event['_eventid'] = eventid
+        event['_gameloop'] = gameloop
+        if game:
+            event['_userid'] = userid
+
+        # The next event is byte aligned
+        decoder.byte_align()
+        event['_bits'] = decoder.used_bits() - start_bits
+
+        yield event
+
+
+class ReplayEvents:
+    """ Game and tracker events of a replay merged by their gameloop.
+
+    Only the raw streams are kept. Events are decoded while iterating, so the whole event list is never held in memory.
+    Both streams are already ordered by gameloop so they are merged with a heap instead of sorting.
+    The object can be iterated over repeatedly and it can be pickled (the protocol is stored by its module name).
+
+    `event_filter` is a set of event names to decode, other events are skipped. Events needed by the parser are always included."""
+    def __init__(self, protocol, game_data, tracker_data, event_filter=None):
+        self.protocol_name = protocol.__name__
+        self.game_data = game_data
+        self.tracker_data = tracker_data
+        self.event_filter = None if event_filter is None else frozenset(event_filter) | parser_events
+
+    @functools.cached_property
+    def protocol(self):
+        return importlib.import_module(self.protocol_name)
+
+    def __getstate__(self):
+        return {
+            'protocol_name': self.protocol_name,
+            'game_data': self.game_data,
+            'tracker_data': self.tracker_data,
+            'event_filter': self.event_filter
+        }
+
+    def parser_events(self):
+        """ Returns events of the same replay limited to events the parser needs. Raw streams are shared, other events are skipped
+        while decoding, so going over these is much cheaper than over all events. """
+        return ReplayEvents(self.protocol, self.game_data, self.tracker_data, event_filter=parser_events)
+
+    def game_events(self):
+        """ Yields game events only """
+        if self.event_filter is None:
+            return self.protocol.decode_replay_game_events(self.game_data)
+        return decode_event_stream(self.protocol, self.game_data, True, self.event_filter)
+
+    def tracker_events(self):
+        """ Yields tracker events only """
+        if self.event_filter is None:
+            return self.protocol.decode_replay_tracker_events(self.tracker_data)
+        return decode_event_stream(self.protocol, self.tracker_data, False, self.event_filter)
+
+    def __iter__(self):
+        # On equal gameloops game events go first, same as the stable sort that was used before
+        return heapq.merge(self.game_events(), self.tracker_events(), key=_gameloop)
+
+
+def replay_file_complete(archive):
+    """ Checks whether the whole MPQ archive is written. The header and hash & block tables were readable when the archive
+    was opened, all blocks from the block table have to fit into the file as well. """
+    end = max((block.offset + block.archived_size for block in archive.block_table), default=0)
+    return os.fstat(archive.file.fileno()).st_size >= archive.header['offset'] + end
+
+
+def wait_for_replay_file(file, timeout=10, interval=0.05):
+    """ Waits until a replay is written, i.e. its size and modification time don't change. Only the file is checked here,
+    whether the archive is complete is checked when it's opened for parsing (see `S2Replay`).
+    Files not modified in the last second are considered written right away.
+    Returns (size, mtime) of the file, or None if it doesn't exist. Returns after `timeout` seconds even if it's still changing. """
+    deadline = time.time() + timeout
+    last_state = None
+    while True:
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return None
+
+        state = (stat.st_size, stat.st_mtime_ns)
+        if state == last_state or time.time() - stat.st_mtime > 1 or time.time() > deadline:
+            return state
+
+        last_state = state
+        time.sleep(interval)
+
+
+class S2Replay:
+    """ Lazy view of a replay archive.
+
+    Only the header is decoded when the object is created. Each MPQ stream
+    is read and decoded the first time its accessor is used, and then cached.
+    Raises ValueError if the archive isn't completely written yet."""
+    def __init__(self, file, try_lastest=True, try_closest=False, event_filter=None):
+        self.file = file
+        self.event_filter = event_filter
+
+        # Listfile isn't needed, files are always read by their name
+        self.archive = mpyq.MPQArchive(file, listfile=False)
+        if not replay_file_complete(self.archive):
+            self.archive.file.close()
+            raise ValueError(f'Replay file is not completely written ({file})')
+        contents = self.archive.header['user_data_header']['content']
+
+        self.header = versions.latest().decode_replay_header(contents)
+        self.replay_build = self.header['m_version']['m_baseBuild']
+        self.protocol, self.used_build = self.find_protocol(self.replay_build, try_lastest, try_closest)
+
+    @staticmethod
+    def find_protocol(replay_build, try_lastest=True, try_closest=False):
+        """ Returns a protocol and its build for given replay build. Returns (None, None) if there isn't one. """
+        # If the build is in a known list of protocols that aren't included but work, replace the build by the version that works.
+        base_build = valid_protocols.get(replay_build, replay_build)
+
+        try:
+            return versions.build(base_build), base_build
+        except Exception:
+            if try_closest:
+                used_build = find_closest_values(base_build, valid_protocols)[0]
+                return versions.build(used_build), used_build
+            elif try_lastest:
+                return versions.latest(), protocol_build().split('.')[-2]
+        return None, None
+
+    @functools.cached_property
+    def details(self):
+        return self.protocol.decode_replay_details(self.archive.read_file('replay.details'))
+
+    @functools.cached_property
+    def init_data(self):
+        return self.protocol.decode_replay_initdata(self.archive.read_file('replay.initData'))
+
+    @functools.cached_property
+    def metadata(self):
+        return json.loads(self.archive.read_file('replay.gamemetadata.json'))
+
+    @functools.cached_property
+    def messages(self):
+        return list(self.protocol.decode_replay_message_events(self.archive.read_file('replay.message.events')))
+
+    @functools.cached_property
+    def events(self):
+        """ Game and tracker events merged together. Decoded lazily, see `ReplayEvents`. """
+        return ReplayEvents(self.protocol,
+                            self.archive.read_file('replay.game.events'),
+                            self.archive.read_file('replay.tracker.events'),
+                            event_filter=self.event_filter)
 
 
 def s2_parse_replay(file,
@@ -58,7 +308,9 @@ def s2_parse_replay(file,
                     withoutRecoverEnabled=False,
                     return_raw=False,
                     return_events=False,
-                    try_closest=False):
+                    try_closest=False,
+                    event_filter=None,
+                    cache_hash=None):
     """ Function parsing the replay and returning a replay class
 
     `try_lastest=False` doesn't try the lastest protocol version
@@ -67,75 +319,60 @@ def s2_parse_replay(file,
     `withoutRecoverEnabled = True` returns `None` for games with game recovery enabled
     `return_raw = True` returns raw data as well
     `return_events = True` returns events as well
+    `event_filter` is a set of event names to decode, other events are skipped (`None` decodes all)
+    `cache_hash` is the replay hash. If provided, decoded data are loaded from or saved to the event cache.
     """
 
     # Exit straight away if onlyBlizzard enforced
     if onlyBlizzard and '[MM]' in file:
         return
 
-    # Open archive
-    archive = mpyq.MPQArchive(file)
-    contents = archive.header['user_data_header']['content']
-
-    header = versions.latest().decode_replay_header(contents)
-    replay_build = header['m_version']['m_baseBuild']
+    # Use already decoded data if possible
+    archive = None
+    if cache_hash is not None:
+        archive = EC.load(cache_hash, file, event_filter, need_events=parse_events)
 
-    # If the build is in a known list of protocols that aren't included but work, replace the build by the version that works.
-    base_build = valid_protocols.get(replay_build, replay_build)
-
-    try:
-        protocol = versions.build(base_build)
-        used_build = base_build
-    except Exception:
-        if try_closest:
-            used_build = find_closest_values(base_build, valid_protocols)[0]
-            protocol = versions.build(used_build)
-        elif try_lastest:
-            protocol = versions.latest()
-            used_build = protocol_build().split('.')[-2]
-        else:
+    if archive is None:
+        # Open archive, nothing but the header is decoded yet
+        archive = S2Replay(file, try_lastest=try_lastest, try_closest=try_closest, event_filter=event_filter)
+        if archive.protocol is None:
             return
 
-    # Get player info
-    player_info = archive.read_file('replay.details')
-    player_info = protocol.decode_replay_details(player_info)
+    replay_build = archive.replay_build
+    used_build = archive.used_build
 
+    # Each part of the replay is decoded the first time it's used. Checks that can exit go first.
     # Exit if onlyBlizzard maps enforced
-    if onlyBlizzard and not player_info['m_isBlizzardMap']:
+    if onlyBlizzard and not archive.details['m_isBlizzardMap']:
         return
 
     # Check for older replays
-    if 'm_disableRecoverGame' not in player_info:
+    if 'm_disableRecoverGame' not in archive.details:
         return
 
     # Exit if game can be recovered
-    if withoutRecoverEnabled and not player_info['m_disableRecoverGame']:
+    if withoutRecoverEnabled and not archive.details['m_disableRecoverGame']:
         return
 
-    # Get detailed info
-    detailed_info = archive.read_file('replay.initData')
-    detailed_info = protocol.decode_replay_initdata(detailed_info)
-
-    # Get metadata
-    metadata = json.loads(archive.read_file('replay.gamemetadata.json'))
+    # Exit if onlyBlizzard maps enforced and there are no commanders
+    if onlyBlizzard and not any(slot['m_commander'] not in {None, b''}
+                                for slot in archive.init_data['m_syncLobbyState']['m_lobbyState']['m_slots'][:len(archive.metadata['Players'])]):
+        return
 
-    # Messages
-    messages = archive.read_file('replay.message.events')
-    messages = protocol.decode_replay_message_events(messages)
+    # Decode everything once and save it for later analysis
+    if cache_hash is not None and parse_events and isinstance(archive, S2Replay):
+        archive = EC.save(cache_hash, archive)
 
-    events = list()
-    if parse_events:
-        # Get game events
-        game_events = archive.read_file('replay.game.events')
-        game_events = protocol.decode_replay_game_events(game_events)
+    player_info = archive.details
+    detailed_info = archive.init_data
+    metadata = archive.metadata
 
-        # Get tracker events
-        tracker_events = archive.read_file('replay.tracker.events')
-        tracker_events = protocol.decode_replay_tracker_events(tracker_events)
+    # Game and tracker events are decoded only when needed
+    events = archive.events if parse_events else tuple()
 
-        # Merge them together
-        events = list(game_events) + list(tracker_events)
-        events = sorted(events, key=lambda x: x['_gameloop'])
+    # Start time and the last deselect event are needed before the analysis. They are found in a cheap first pass
+    # that decodes only events used by the parser. Events for the analysis are decoded later while it iterates over them.
+    start_time, last_deselect_event, found_mutator_events = scan_events(events.parser_events() if isinstance(events, ReplayEvents) else events)
 
     # Create output
     replay = dict()
@@ -152,8 +389,8 @@ def s2_parse_replay(file,
     replay['extension'] = detailed_info['m_syncLobbyState']['m_gameDescription']['m_hasExtensionMod']
     replay['brutal_plus'] = detailed_info['m_syncLobbyState']['m_lobbyState']['m_slots'][0].get('m_brutalPlusDifficulty', 0)
     replay['length'] = metadata['Duration']
-    replay['start_time'] = get_start_time(events)
-    replay['last_deselect_event'] = get_last_deselect_event(events)
+    replay['start_time'] = start_time
+    replay['last_deselect_event'] = last_deselect_event
     replay['last_deselect_event'] = replay['last_deselect_event'] if replay['last_deselect_event'] != None else replay['length']
     replay['result'] = 'Victory' if metadata['Players'][0]['Result'] == 'Win' or metadata['Players'][1]['Result'] == 'Win' else 'Defeat'
 
@@ -166,7 +403,7 @@ def s2_parse_replay(file,
 
     replay['mutators'] = tuple()
     try:
-        result = identify_mutators(events, extension=replay['extension'], detailed_info=detailed_info, mm='[MM]' in file)
+        result = identify_mutators(found_mutator_events, extension=replay['extension'], detailed_info=detailed_info, mm='[MM]' in file)
         replay['mutators'] = result['mutators']
         replay['weekly'] = result.get('weekly', False)
     except Exception:
@@ -190,7 +427,6 @@ def s2_parse_replay(file,
         if idx == 0:
             replay['region'] = region_dict.get(player['m_toon']['m_region'], '')
 
-    commander_found = False
     for idx, player in enumerate(detailed_info['m_syncLobbyState']['m_lobbyState']['m_slots']):
         if idx < len(replay['players']):
             replay['players'][idx]['masteries'] = tuple(player['m_commanderMasteryTalents'])
@@ -203,13 +439,6 @@ def s2_parse_replay(file,
             replay['players'][idx]['handle'] = player['m_toonHandle'].decode()
             replay['players'][idx]['difficulty'] = player['m_difficulty']
 
-            if not replay['players'][idx]['commander'] in {None, ''}:
-                commander_found = True
-
-    # Exit if onlyBlizzard maps enforced
-    if onlyBlizzard and not commander_found:
-        return
-
     # Player names
     for idx, player in enumerate(detailed_info['m_syncLobbyState']['m_userInitialData']):
         _name = player['m_name'].decode()
@@ -246,7 +475,7 @@ def s2_parse_replay(file,
 
     # Messages
     replay['messages'] = []
-    for msg in messages:
+    for msg in archive.messages:
         if msg.get('m_string', None) is not None:  # Chat message
             replay['messages'].append({'text': msg['m_string'].decode(), 'player': msg['_userid']['m_userId'] + 1, 'time': msg['_gameloop'] / 16})
         elif msg['_event'] == 'NNet.Game.SPingMessage':  # Ping
@@ -115,6 +115,17 @@ prestige_upgrades = {
     }
 }
 
+# Reverse indexes for upgrade events. Upgrade name: (commander, mastery index) | Upgrade name: prestige name
+mastery_upgrade_index = dict()
+for _co, _upgrades in COMasteryUpgrades.items():
+    for _idx, _upgrade in enumerate(_upgrades):
+        mastery_upgrade_index.setdefault(_upgrade, (_co, _idx))
+
+prestige_upgrade_index = dict()
+for _co, _upgrades in prestige_upgrades.items():
+    for _upgrade, _prestige in _upgrades.items():
+        prestige_upgrade_index.setdefault(_upgrade, _prestige)
+
 prestige_names = {
     'Abathur': {
         0: 'Evolution Master',
@@ -75,6 +75,7 @@ class CSettings:
             'chat_font_scale': 1.3,
             'webflag': 'CoverWindow',
             'full_analysis_atstart': False,
+            'event_cache_size': 20,  # GB of decoded replay events kept for faster re-analysis
             'twitchbot': {
                 'channel_name': '',
                 'bot_name': '',
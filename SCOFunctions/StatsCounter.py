@@ -19,7 +19,9 @@ a bit faster (leading to bonus army value). These spikes are removed with a addi
 """
 
 from SCOFunctions.MLogging import logclass, catch_exceptions
-from SCOFunctions.SC2Dictionaries import unit_base_costs, royal_guards, horners_units, tychus_base_upgrades, tychus_ultimate_upgrades, outlaws
+from SCOFunctions.MUnitTypes import unit_types
+from SCOFunctions.SC2Dictionaries import (royal_guards, horners_units, tychus_base_upgrades, tychus_ultimate_upgrades, outlaws, mastery_upgrade_index,
+                                          prestige_upgrade_index)
 
 logger = logclass('COUNT', 'INFO')
 debug_negative_members = set()
@@ -212,7 +214,7 @@ class StatsCounter:
             # Since it died, its value is substracted. Here compensate for it.
             self.army_value_offset += cost
 
-    def upgrade_event(self, upgrade):
+    def upgrade_event(self, upgrade: str, count: int):
         """ Tracks upgrade events"""
         # Add army value for Tychus when gear is purchased
         if upgrade in tychus_base_upgrades:
@@ -220,6 +222,12 @@ class StatsCounter:
         elif upgrade in tychus_ultimate_upgrades:
             self.army_value_offset += self.tychus_gear_cost[1]
 
+        # Masteries and prestige talents change unit costs
+        if upgrade in mastery_upgrade_index:
+            self.update_mastery(mastery_upgrade_index[upgrade][1], count)
+        if upgrade in prestige_upgrade_index:
+            self.update_prestige(prestige_upgrade_index[upgrade])
+
     def unit_created_event(self, unit_type, event):
         """ Tracking when a unit was created"""
         # Save the number of free Banelings.
@@ -317,23 +325,7 @@ class StatsCounter:
         if self.commander == '':
             return (0, 0)
 
-        if unit in unit_base_costs[self.commander]:
-            cost = unit_base_costs[self.commander][unit]
-        elif unit.endswith('Burrowed') and unit.replace('Burrowed', '') in unit_base_costs[self.commander]:
-            cost = unit_base_costs[self.commander][unit.replace('Burrowed', '')]
-        elif unit.endswith('Phasing') and unit.replace('Phasing', '') in unit_base_costs[self.commander]:
-            cost = unit_base_costs[self.commander][unit.replace('Phasing', '')]
-        elif unit.endswith('Uprooted') and unit.replace('Uprooted', '') in unit_base_costs[self.commander]:
-            cost = unit_base_costs[self.commander][unit.replace('Uprooted', '')]
-        elif unit.endswith('Sieged') and unit.replace('Sieged', '') in unit_base_costs[self.commander]:
-            cost = unit_base_costs[self.commander][unit.replace('Sieged', '')]
-        elif unit.endswith('SiegeMode') and unit.replace('SiegeMode', '') in unit_base_costs[self.commander]:
-            cost = unit_base_costs[self.commander][unit.replace('SiegeMode', '')]
-        elif unit.endswith('Fighter') and unit.replace('Fighter', 'Assault') in unit_base_costs[self.commander]:
-            cost = unit_base_costs[self.commander][unit.replace('Fighter', 'Assault')]
-        else:
-            return (0, 0)
-        return cost
+        return unit_types.base_cost(unit, self.commander)
 
     def unit_cost(self, unit: str) -> tuple:
         """ Calculate army cost for units of given type.